@@ -0,0 +1,153 @@
+"""
+Benchmark suite: loads a synthetic dump, see ``geonames.loading.fixtures``, into an empty data base and measures the
+loader phases, the name searches, the radius searches and the saves. Everything runs in a transaction rolled back
+at the end. Run it with the ``benchmarkgeonames`` management command, whose JSON report can be compared between
+commits: ops/sec, latency percentiles, number of queries and peak RSS of each benchmark.
+"""
+from collections import OrderedDict
+import platform
+import random
+import time
+
+import django
+from django.db import connection, transaction
+
+from geonames.loading.instrumentation import QueryStats, peak_rss
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class Benchmark(object):
+    """ Runs the measures and keeps their results by name """
+    def __init__(self):
+        self.results = OrderedDict()
+
+    def measure(self, name, function, calls):
+        """ Calls ``function`` with each tuple of arguments of ``calls``, recording how long each call takes """
+        latencies = []
+        counter = QueryStats()
+        try:
+            # A savepoint, so a failing benchmark does not break the following ones
+            with transaction.atomic(), connection.execute_wrapper(counter):
+                start = time.perf_counter()
+                for arguments in calls:
+                    begin = time.perf_counter()
+                    function(*arguments)
+                    latencies.append(time.perf_counter() - begin)
+                total = time.perf_counter() - start
+        except Exception as error:
+            self.results[name] = OrderedDict([('error', u'{}: {}'.format(type(error).__name__, error))])
+            print('{0:40s} ERROR {1}'.format(name, self.results[name]['error']))
+            return
+
+        result = self.results[name] = OrderedDict([
+            ('calls', len(latencies)),
+            ('seconds', total),
+            ('ops_per_second', len(latencies) / total if total else None),
+            ('p50_ms', percentile(latencies, 0.5) * 1000 if latencies else None),
+            ('p95_ms', percentile(latencies, 0.95) * 1000 if latencies else None),
+            ('p99_ms', percentile(latencies, 0.99) * 1000 if latencies else None),
+            ('max_ms', max(latencies) * 1000 if latencies else None),
+            ('queries', counter.count),
+            ('query_seconds', counter.seconds),
+            ('peak_rss_kb', peak_rss()),
+        ])
+        print('{0:40s} {1:10.1f} ops/s  p99 {2:9.2f} ms  {3:7d} queries'.format(
+            name, result['ops_per_second'] or 0, result['p99_ms'] or 0, result['queries']))
+
+
+def typo(rnd, name):
+    """ ``name`` with two contiguous letters swapped """
+    if len(name) < 3:
+        return name
+    i = rnd.randint(1, len(name) - 2)
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def run(directory, localities=5000, seed=0, iterations=100, miles=50, writer='auto'):
+    """
+    Writes the synthetic dumps of ``localities`` localities to ``directory``, loads them and runs every benchmark
+    ``iterations`` times on a sample of them. Returns the report.
+    """
+    from geonames.loading.fixtures import generate_dumps
+    from geonames.local_index import invalidate_all
+    from geonames.management.commands.loadgeonames import Command
+    from geonames.models import Admin1Code, Country, GeonamesUpdate, Locality
+    from geonames.search import get_index as get_autocomplete_index, get_trigram_index
+    from geonames.spatial_index import get_index as get_spatial_index
+
+    if Country.objects.exists() or Locality.objects.exists():
+        raise ValueError("The benchmarks need an empty data base")
+
+    rnd = random.Random(seed)
+    start = time.perf_counter()
+    generate_dumps(directory, localities=localities, seed=seed)
+    fixture_seconds = time.perf_counter() - start
+
+    benchmark = Benchmark()
+    with transaction.atomic():
+        command = Command()
+        command.data_dir = command.temp_dir_path = directory
+        command.writer = writer
+        for phase in command.load_phases():
+            benchmark.measure('load.{}'.format(phase.__name__), phase, [()])
+        GeonamesUpdate.objects.create()
+        invalidate_all()
+
+        geonameids = sorted(Locality.objects.public().values_list('geonameid', flat=True))
+        sample = Locality.objects.in_bulk(rnd.sample(geonameids, min(iterations, len(geonameids))))
+        sample = [sample[geonameid] for geonameid in sorted(sample)]
+        countries = Country.objects.in_bulk()
+        pairs = [(locality.country_id, locality.name) for locality in sample]
+
+        benchmark.measure('search.search_locality', lambda code, name: list(countries[code].search_locality(name)),
+                          pairs)
+        benchmark.measure('search.resolve_many', Locality.objects.resolve_many, [(pairs,)])
+        benchmark.measure('search.autocomplete_build', get_autocomplete_index, [()])
+        benchmark.measure('search.autocomplete', Locality.objects.autocomplete,
+                          [(name[:rnd.randint(1, 4)],) for code, name in pairs])
+        benchmark.measure('search.fuzzy_build', get_trigram_index, [()])
+        benchmark.measure('search.fuzzy_search', lambda code, name: Locality.objects.fuzzy_search(name, country=code),
+                          [(code, typo(rnd, name)) for code, name in pairs])
+
+        benchmark.measure('radius.near_localities_rough', lambda locality: locality.near_localities_rough(
+            miles).count(), [(locality,) for locality in sample])
+        benchmark.measure('radius.near_locals_nogis', lambda locality: locality.near_locals_nogis(miles),
+                          [(locality,) for locality in sample])
+        benchmark.measure('radius.near_localities', lambda locality: list(locality.near_localities(miles)),
+                          [(locality,) for locality in sample])
+        benchmark.measure('radius.spatial_index_build', get_spatial_index, [()])
+        benchmark.measure('radius.near_locals_indexed', lambda locality: locality.near_locals_indexed(miles),
+                          [(locality,) for locality in sample])
+        benchmark.measure('radius.reverse_geocode', Locality.objects.reverse_geocode,
+                          [(locality.latitude, locality.longitude) for locality in sample])
+
+        benchmark.measure('save.locality', lambda locality: locality.save(), [(locality,) for locality in sample])
+        admins1 = list(Admin1Code.objects.order_by('geonameid')[:iterations])
+
+        def rename(admin1):
+            admin1.name = u'{} {}'.format(admin1.name, admin1.pk)
+            admin1.save()
+        benchmark.measure('save.admin1_rename', rename, [(admin1,) for admin1 in admins1])
+
+        transaction.set_rollback(True)
+    invalidate_all()
+
+    return OrderedDict([
+        ('meta', OrderedDict([
+            ('localities', localities),
+            ('seed', seed),
+            ('iterations', iterations),
+            ('miles', miles),
+            ('writer', writer),
+            ('database', connection.vendor),
+            ('django', django.get_version()),
+            ('python', platform.python_version()),
+            ('fixture_seconds', fixture_seconds),
+        ])),
+        ('results', benchmark.results),
+        ('peak_rss_kb', peak_rss()),
+    ])
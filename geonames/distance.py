@@ -0,0 +1,75 @@
+"""
+Great-circle distances with the haversine formula, which stays accurate for the short distances the rounded
+``acos`` of the spherical law of cosines loses.
+
+The functions work on whole arrays of coordinates in degrees with NumPy when it is installed - ``pip install
+numpy`` - and fall back to plain python loops otherwise.
+"""
+from math import asin, cos, pi, radians, sin, sqrt
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Some constants for the geo maths
+EARTH_RADIUS_MI = 3959.0
+KM_TO_MI = 0.621371192
+DEGREES_TO_RADIANS = pi / 180.0
+
+
+def haversine(lat1, lon1, lat2, lon2, radius=EARTH_RADIUS_MI):
+    """ Distance in miles (by default ``radius``) between two points given in degrees """
+    lat1, lon1, lat2, lon2 = radians(lat1), radians(lon1), radians(lat2), radians(lon2)
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * radius * asin(min(1.0, sqrt(a)))
+
+
+def distances(latitude, longitude, latitudes, longitudes, radius=EARTH_RADIUS_MI):
+    """ Distances from the point ``latitude``, ``longitude`` to each of the points of ``latitudes``, ``longitudes`` """
+    if np is None:
+        return [haversine(latitude, longitude, lat, lon, radius) for lat, lon in zip(latitudes, longitudes)]
+    return distance_matrix([latitude], [longitude], latitudes, longitudes, radius)[0]
+
+
+def distance_matrix(latitudes1, longitudes1, latitudes2, longitudes2, radius=EARTH_RADIUS_MI):
+    """ Matrix of the distances between every point of the first arrays (rows) and of the second ones (columns) """
+    if np is None:
+        return [distances(lat, lon, latitudes2, longitudes2, radius) for lat, lon in zip(latitudes1, longitudes1)]
+    lat1 = np.radians(np.asarray(latitudes1, dtype=np.float64))[:, np.newaxis]
+    lon1 = np.radians(np.asarray(longitudes1, dtype=np.float64))[:, np.newaxis]
+    lat2 = np.radians(np.asarray(latitudes2, dtype=np.float64))[np.newaxis, :]
+    lon2 = np.radians(np.asarray(longitudes2, dtype=np.float64))[np.newaxis, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * radius * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def within_radius(latitude, longitude, ids, latitudes, longitudes, miles):
+    """
+    Returns the ``ids`` of the points within ``miles`` of ``latitude``, ``longitude`` and their distances, both
+    sorted by distance
+    """
+    return within_radius_many([latitude], [longitude], ids, latitudes, longitudes, miles)[0]
+
+
+def within_radius_many(latitudes, longitudes, ids, candidate_latitudes, candidate_longitudes, miles):
+    """
+    ``within_radius`` for many query points against the same candidates at once, returns a list with the
+    ``(ids, distances)`` of each query point
+    """
+    if len(ids) == 0:
+        return [([], []) for _ in latitudes]
+    matrix = distance_matrix(latitudes, longitudes, candidate_latitudes, candidate_longitudes)
+    results = []
+    if np is None:
+        for row in matrix:
+            near = sorted((distance, geonameid) for geonameid, distance in zip(ids, row) if distance <= miles)
+            results.append(([geonameid for distance, geonameid in near], [distance for distance, geonameid in near]))
+        return results
+
+    ids = np.asarray(ids)
+    for row in matrix:
+        near = np.flatnonzero(row <= miles)
+        near = near[np.argsort(row[near], kind='stable')]
+        results.append((ids[near].tolist(), row[near].tolist()))
+    return results
@@ -0,0 +1,3 @@
+"""
+Helpers used by the ``loadgeonames`` management command to fetch, parse and write the geonames.org dumps.
+"""
@@ -0,0 +1,94 @@
+"""
+Checkpoints of a full ``loadgeonames`` run, kept in the ``GeonamesCheckpoint`` table so an interrupted load can be
+resumed: the options it started with, the phases completed and, for the phases committing batch by batch, the
+checksum of the file they read and how many of its records are loaded. Resuming from an offset is only safe while
+the file is the same, a changed checksum stops the load.
+"""
+import hashlib
+import json
+
+from geonames.models import GeonamesCheckpoint
+
+# Phase holding the options of the load
+OPTIONS = 'load'
+
+
+def file_checksum(path, size=1024 * 1024):
+    """ SHA-256 hex digest of the file at ``path`` """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Checkpoints(object):
+    """ The ``GeonamesCheckpoint`` rows of the current load by phase """
+    def __init__(self, rows=()):
+        self.rows = dict((row.phase, row) for row in rows)
+
+    @classmethod
+    def start(cls, options):
+        """ Forgets any previous load and starts a new one with the ``options`` dict """
+        GeonamesCheckpoint.objects.all().delete()
+        checkpoints = cls()
+        checkpoints.set_state(OPTIONS, options)
+        return checkpoints
+
+    @classmethod
+    def resume(cls):
+        """ Returns the checkpoints of the interrupted load, None if there is none """
+        checkpoints = cls(GeonamesCheckpoint.objects.all())
+        if OPTIONS not in checkpoints.rows:
+            return None
+        return checkpoints
+
+    @property
+    def options(self):
+        return self.get_state(OPTIONS)
+
+    def get(self, phase):
+        if phase not in self.rows:
+            self.rows[phase] = GeonamesCheckpoint(phase=phase)
+        return self.rows[phase]
+
+    def completed(self, phase):
+        return phase in self.rows and self.rows[phase].completed
+
+    def complete(self, phase):
+        row = self.get(phase)
+        row.completed = True
+        row.save()
+
+    def get_state(self, phase):
+        if phase in self.rows and self.rows[phase].state:
+            return json.loads(self.rows[phase].state)
+        return None
+
+    def set_state(self, phase, state):
+        row = self.get(phase)
+        row.state = json.dumps(state)
+        row.save()
+
+    def position(self, phase, path):
+        """ Returns how many records of the file at ``path`` ``phase`` loaded before the interruption """
+        row = self.get(phase)
+        checksum = file_checksum(path)
+        if row.checksum and row.checksum != checksum:
+            raise Exception("ERROR {} changed since the interrupted load, run it again without --resume".format(path))
+        if not row.checksum:
+            row.checksum = checksum
+            row.offset = 0
+            row.save()
+        return row.offset
+
+    def advance(self, phase, offset):
+        """ Records that ``phase`` loaded the first ``offset`` records of its file """
+        row = self.get(phase)
+        row.offset = offset
+        row.save()
+
+    def finish(self):
+        """ Forgets the load, once completed """
+        GeonamesCheckpoint.objects.all().delete()
+        self.rows = {}
@@ -0,0 +1,113 @@
+"""
+In-process download of the geonames.org files, several at a time: a file is only fetched again when the server has
+a newer copy (``If-Modified-Since``), interrupted downloads are resumed from the partial ``.part`` file (``Range`` /
+``If-Range``) and what was received is checked against ``Content-Length`` and, for zip archives, the CRC-32 of
+every member.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+import os
+import shutil
+import urllib.error
+import urllib.request
+import zipfile
+
+TIMEOUT = 60
+BLOCK_SIZE = 1024 * 1024
+
+
+class DownloadError(Exception):
+    def __init__(self, url, reason, status=None):
+        super(DownloadError, self).__init__("ERROR fetching {}: {}".format(os.path.basename(url), reason))
+        self.url = url
+        self.status = status
+
+
+def check_file(path, expected_size=None, is_zip=None):
+    """
+    Returns the reason ``path`` is not a complete and sound download or ``None``. ``is_zip`` tells whether it is a
+    zip archive, by default when its name ends with .zip
+    """
+    if is_zip is None:
+        is_zip = path.endswith('.zip')
+    if expected_size is not None and os.path.getsize(path) != expected_size:
+        return 'received {} bytes instead of {}'.format(os.path.getsize(path), expected_size)
+    if is_zip:
+        try:
+            with zipfile.ZipFile(path) as archive:
+                bad_member = archive.testzip()
+        except zipfile.BadZipFile as error:
+            return 'corrupted archive ({})'.format(error)
+        if bad_member is not None:
+            return 'bad CRC for {}'.format(bad_member)
+    return None
+
+
+def download(url, directory, timeout=TIMEOUT):
+    """ Downloads ``url`` into ``directory`` unless the copy there is up to date, returns the file path """
+    path = os.path.join(directory, os.path.basename(url))
+    part = path + '.part'
+    request = urllib.request.Request(url)
+    if os.path.exists(path):
+        request.add_header('If-Modified-Since', formatdate(os.path.getmtime(path), usegmt=True))
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset:
+        # The partial download is resumed only if the file did not change meanwhile, the server sends it all if so
+        request.add_header('Range', 'bytes={}-'.format(offset))
+        request.add_header('If-Range', formatdate(os.path.getmtime(part), usegmt=True))
+
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as error:
+        if error.code == 304:
+            if os.path.exists(part):
+                os.remove(part)
+            return path
+        if error.code == 416:
+            # Nothing left to resume, the partial download is stale
+            os.remove(part)
+            return download(url, directory, timeout)
+        raise DownloadError(url, error.reason, error.code)
+    except (urllib.error.URLError, OSError) as error:
+        raise DownloadError(url, error)
+
+    with response:
+        if response.status != 206:
+            offset = 0
+        length = response.headers.get('Content-Length')
+        expected_size = offset + int(length) if length is not None else None
+        last_modified = response.headers.get('Last-Modified')
+        modified = parsedate_to_datetime(last_modified).timestamp() if last_modified else None
+        try:
+            with open(part, 'ab' if offset else 'wb') as fd:
+                shutil.copyfileobj(response, fd, BLOCK_SIZE)
+        except OSError as error:
+            raise DownloadError(url, error)
+        finally:
+            if modified is not None:
+                # Used as the If-Range validator when resuming
+                os.utime(part, (modified, modified))
+
+    # The .part name hides the archive extension
+    reason = check_file(part, expected_size, is_zip=path.endswith('.zip'))
+    if reason is not None:
+        # A short file is kept to resume it next time, a complete but bad one is dropped
+        if expected_size is None or os.path.getsize(part) >= expected_size:
+            os.remove(part)
+        raise DownloadError(url, reason)
+
+    os.replace(part, path)
+    if modified is not None:
+        # Used as the If-Modified-Since validator of the next download
+        os.utime(path, (modified, modified))
+    return path
+
+
+def download_all(urls, directory, workers=4, timeout=TIMEOUT):
+    """ Downloads ``urls`` into ``directory`` with ``workers`` threads, returns the file paths in ``urls`` order """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(download, url, directory, timeout) for url in urls]
+    # Raise the first error once every download is finished
+    return [future.result() for future in futures]
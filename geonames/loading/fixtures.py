@@ -0,0 +1,126 @@
+"""
+Deterministic synthetic geonames.org dumps, in the layout ``loadgeonames`` reads, for benchmarks and tests.
+
+The same ``seed`` and sizes always write the same files. Names use a few accented letters, and some localities
+share a name and admin levels or miss their time zone, so the loader takes the same paths as with the real dumps.
+"""
+import os
+import random
+import zipfile
+
+SYLLABLES = ['ba', 'ca', 'do', 'el', 'fa', 'go', 'ha', 'in', 'ju', 'ka', 'lo', 'ma', 'ne', 'or', 'pa', 'qui', 'ra',
+             'san', 'te', 'ur', 'va', 'wi', 'xa', 'yo', 'za', 'bre', 'cho', 'dri', 'ste', 'tra', 'vil', 'mon']
+ACCENTS = {'a': u'á', 'e': u'é', 'o': u'ö', 'u': u'ü', 'i': u'í'}
+LANGUAGES = [('eng', 'en', 'English'), ('spa', 'es', 'Spanish'), ('fra', 'fr', 'French'), ('deu', 'de', 'German')]
+
+
+def make_name(rnd, syllables=3):
+    name = u''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, syllables)))
+    if rnd.random() < 0.2:
+        letter = rnd.choice(list(ACCENTS))
+        name = name.replace(letter, ACCENTS[letter], 1)
+    return name.capitalize()
+
+
+def country_codes(countries):
+    codes = []
+    for i in range(countries):
+        codes.append(chr(ord('A') + i // 26 % 26) + chr(ord('A') + i % 26))
+    return codes
+
+
+def write_zip(directory, name, lines):
+    with zipfile.ZipFile(os.path.join(directory, name + '.zip'), 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(name + '.txt', u''.join(lines).encode('utf8'))
+
+
+def generate_dumps(directory, localities=5000, countries=10, admins1=5, admins2=4, alternate_names=2,
+                   localities_file='cities500', seed=0):
+    """
+    Writes to ``directory`` the dumps of ``countries`` countries with ``admins1`` Admin1Codes each, ``admins2``
+    Admin2Codes per Admin1Code, ``localities`` localities and about ``alternate_names`` alternate names per
+    locality. Returns the names of the localities written.
+    """
+    rnd = random.Random(seed)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    codes = country_codes(countries)
+    geonameid = 1000
+
+    with open(os.path.join(directory, 'iso-languagecodes.txt'), 'w', encoding='utf8') as fd:
+        fd.write('ISO 639-3\tISO 639-2\tISO 639-1\tLanguage Name\n')
+        for iso_639_3, iso_639_1, name in LANGUAGES:
+            fd.write(u'{}\t{}\t{}\t{}\n'.format(iso_639_3, iso_639_3, iso_639_1, name))
+
+    with open(os.path.join(directory, 'timeZones.txt'), 'w', encoding='utf8') as fd:
+        fd.write('CountryCode\tTimeZoneId\tGMT offset 1. Jan 2018\tDST offset 1. Jul 2018\trawOffset\n')
+        for code in codes:
+            timezone = 'Zone/{}'.format(code)
+            offset = rnd.randint(-11, 12)
+            fd.write(u'{}\t{}\t{}.0\t{}.0\t{}.0\n'.format(code, timezone, offset, offset + 1, offset))
+
+    # Each country gets a box of latitudes and longitudes its localities fall in
+    boxes = {}
+    with open(os.path.join(directory, 'countryInfo.txt'), 'w', encoding='utf8') as fd:
+        fd.write('#ISO\tISO3\tISO-Numeric\tfips\tCountry\tCapital\tArea(in sq km)\tPopulation\tContinent\ttld\t'
+                 'CurrencyCode\tCurrencyName\tPhone\tPostal Code Format\tPostal Code Regex\tLanguages\tgeonameid\t'
+                 'neighbours\tEquivalentFipsCode\n')
+        for i, code in enumerate(codes):
+            geonameid += 1
+            boxes[code] = (rnd.uniform(-60, 60), rnd.uniform(-170, 170))
+            languages = ','.join(rnd.sample([iso_639_1 for _, iso_639_1, _ in LANGUAGES], 2))
+            fd.write(u'{code}\t{code}X\t{number}\t{code}\t{name} {code}\tCapital\t1000\t1000000\tEU\t.{lower}\t'
+                     u'C{code}\tCurrency {code}\t+{number}\t\t\t{languages}\t{geonameid}\t\t\n'.format(
+                         code=code, number=i + 1, name=make_name(rnd), lower=code.lower(), languages=languages,
+                         geonameid=geonameid))
+
+    admins = {}
+    with open(os.path.join(directory, 'admin1CodesASCII.txt'), 'w', encoding='utf8') as fd1, \
+            open(os.path.join(directory, 'admin2Codes.txt'), 'w', encoding='utf8') as fd2:
+        for code in codes:
+            admins[code] = []
+            admin1_names = set()
+            for admin1 in range(1, admins1 + 1):
+                geonameid += 1
+                name = make_name(rnd)
+                while name in admin1_names:
+                    name = make_name(rnd)
+                admin1_names.add(name)
+                fd1.write(u'{}.{:02d}\t{}\t{}\t{}\n'.format(code, admin1, name, name, geonameid))
+                for admin2 in range(1, admins2 + 1):
+                    geonameid += 1
+                    name = make_name(rnd)
+                    fd2.write(u'{}.{:02d}.{:03d}\t{}\t{}\t{}\n'.format(code, admin1, admin2, name, name, geonameid))
+                    admins[code].append(('{:02d}'.format(admin1), '{:03d}'.format(admin2)))
+
+    names = []
+    lines = []
+    alternates = []
+    alternatenameid = 0
+    for i in range(localities):
+        geonameid += 1
+        code = rnd.choice(codes)
+        admin1, admin2 = rnd.choice(admins[code])
+        if names and rnd.random() < 0.02:
+            # Same name as another locality, maybe in the same admin levels
+            name = rnd.choice(names)
+        else:
+            name = make_name(rnd, 4)
+        names.append(name)
+        latitude = boxes[code][0] + rnd.uniform(0, 10)
+        longitude = boxes[code][1] + rnd.uniform(0, 10)
+        population = int(rnd.paretovariate(1.2) * 500)
+        timezone = u'Zone/{}'.format(code) if rnd.random() > 0.01 else u''
+        type = rnd.choice(['PPL'] * 8 + ['PPLA', 'PPLA2'])
+        lines.append(u'{}\t{}\t{}\t\t{:.5f}\t{:.5f}\tP\t{}\t{}\t\t{}\t{}\t\t\t{}\t\t10\t{}\t2020-01-{:02d}\n'.format(
+            geonameid, name, name, latitude, longitude, type, code, admin1, admin2, population, timezone,
+            rnd.randint(1, 28)))
+        for _ in range(rnd.randint(0, 2 * alternate_names)):
+            alternatenameid += 1
+            language = rnd.choice(LANGUAGES)[1]
+            alternates.append(u'{}\t{}\t{}\t{}\t\t\t\t\t\t\n'.format(alternatenameid, geonameid, language,
+                                                                   make_name(rnd, 4)))
+
+    write_zip(directory, localities_file, lines)
+    write_zip(directory, 'alternateNames', alternates)
+    return names
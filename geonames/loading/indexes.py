@@ -0,0 +1,108 @@
+"""
+Drops the secondary indexes and the foreign key and unique constraints of some tables before a bulk load and
+creates them again afterwards, from the definitions read in the data base catalog - so they come back exactly as the
+migrations left them. Creating an index once over all the rows is much cheaper than maintaining it row by row, and
+creating the constraints again checks every row, so nothing the load wrote is left unverified.
+
+Only PostgreSQL and SQLite are supported, where DDL is transactional: a failing phase also brings the indexes back.
+The ``dropped`` definitions can be saved to build them again from another process, e.g. when resuming a load.
+On SQLite the foreign keys are part of the table definition and are left alone. PostgreSQL builds each index with
+the parallel workers ``max_parallel_maintenance_workers`` allows.
+"""
+from django.db import DEFAULT_DB_ALIAS, connections
+
+POSTGRESQL_CONSTRAINTS = """
+    SELECT conname, contype = 'u', pg_get_constraintdef(oid) FROM pg_constraint
+    WHERE conrelid = %s::regclass AND contype IN ('f', 'u')
+"""
+# The indexes that do not back a constraint nor the primary key
+POSTGRESQL_INDEXES = """
+    SELECT i.relname, x.indisunique, pg_get_indexdef(i.oid) FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+    WHERE x.indrelid = %s::regclass AND NOT x.indisprimary AND NOT EXISTS (
+        SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid AND c.conrelid = x.indrelid)
+"""
+# Indexes created apart from the table, the automatic ones have no sql
+SQLITE_INDEXES = """
+    SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL
+"""
+
+
+class DeferredIndexes(object):
+    """
+    Indexes and constraints of the tables of ``models``, keeping the unique ones of ``keep_unique`` - the load may
+    rely on them to skip duplicates.
+    """
+    def __init__(self, models, keep_unique=(), using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.tables = [model._meta.db_table for model in models]
+        self.keep_unique = set(model._meta.db_table for model in keep_unique)
+        # (table, name, create statement) of the dropped indexes and constraints
+        self.dropped = []
+
+    @property
+    def supported(self):
+        return self.connection.vendor in ('postgresql', 'sqlite')
+
+    def deferrable(self, table):
+        """ Returns the ``(name, unique, drop statement, create statement)`` of the ``table`` objects to drop """
+        quote = self.connection.ops.quote_name
+        objects = []
+        with self.connection.cursor() as cursor:
+            if self.connection.vendor == 'postgresql':
+                cursor.execute(POSTGRESQL_CONSTRAINTS, [table])
+                for name, unique, definition in cursor.fetchall():
+                    drop = 'ALTER TABLE {} DROP CONSTRAINT {}'.format(quote(table), quote(name))
+                    create = 'ALTER TABLE {} ADD CONSTRAINT {} {}'.format(quote(table), quote(name), definition)
+                    objects.append((name, unique, drop, create))
+                cursor.execute(POSTGRESQL_INDEXES, [table])
+            else:
+                cursor.execute(SQLITE_INDEXES, [table])
+            for row in cursor.fetchall():
+                name, definition = row[0], row[-1]
+                unique = definition.upper().startswith('CREATE UNIQUE')
+                objects.append((name, unique, 'DROP INDEX {}'.format(quote(name)), definition))
+        return objects
+
+    def set_constraints(self, mode):
+        # Adding or dropping a constraint fails while deferred checks are pending
+        if self.connection.vendor == 'postgresql':
+            with self.connection.cursor() as cursor:
+                cursor.execute('SET CONSTRAINTS ALL {}'.format(mode))
+
+    def drop(self):
+        """ Drops the indexes and constraints, returns how many """
+        if not self.supported:
+            return 0
+        self.set_constraints('IMMEDIATE')
+        with self.connection.cursor() as cursor:
+            for table in self.tables:
+                for name, unique, drop, create in self.deferrable(table):
+                    if unique and table in self.keep_unique:
+                        continue
+                    cursor.execute(drop)
+                    self.dropped.append((table, name, create))
+        self.set_constraints('DEFERRED')
+        return len(self.dropped)
+
+    def restore(self):
+        """ Creates the dropped indexes, and then the constraints, again """
+        if not self.dropped:
+            return
+        self.set_constraints('IMMEDIATE')
+        with self.connection.cursor() as cursor:
+            # The indexes first, checking the constraints can use them
+            for table, name, create in sorted(self.dropped, key=lambda dropped: dropped[2].startswith('ALTER')):
+                cursor.execute(create)
+        self.set_constraints('DEFERRED')
+
+    def verify(self):
+        """ Raises an exception if any of the dropped indexes or constraints is still missing """
+        if not self.dropped:
+            return
+        present = set()
+        for table in self.tables:
+            present.update((table, name) for name, unique, drop, create in self.deferrable(table))
+        missing = ['{}.{}'.format(table, name) for table, name, create in self.dropped if (table, name) not in present]
+        if missing:
+            raise Exception("ERROR indexes missing after the load: {}".format(', '.join(missing)))
+        self.dropped = []
@@ -0,0 +1,124 @@
+"""
+Per-phase measures of the ``loadgeonames`` command: wall and CPU time, rows and rows/sec, number and time of the data
+base queries, and peak memory. Each measure is an event - a dict - logged as JSON to the ``geonames.loading`` logger,
+appended as a line to a progress file and handed to a callback, when given. Phases can also run under cProfile.
+"""
+import cProfile
+import datetime
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+from django.db import connection
+
+logger = logging.getLogger('geonames.loading')
+
+
+def peak_rss():
+    """ Peak resident set size of this process so far, in KB """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes there
+        return usage // 1024
+    return usage
+
+
+class QueryStats(object):
+    """
+    Counts and times the queries run on a connection, install it with ``connection.execute_wrapper``. The ``COPY``
+    statements of ``geonames.loading.writers.CopyWriter`` are counted too.
+    """
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+class Recorder(object):
+    """
+    Measures the phases run through ``run``. ``progress_file`` is the path of the JSON lines file the events are
+    appended to, ``callback`` a function called with each event and ``profile`` the names of the phases to profile
+    - or 'all' - whose stats are written to ``profile_dir/<phase>.prof``.
+    """
+    def __init__(self, progress_file=None, callback=None, profile=(), profile_dir='.'):
+        self.progress_file = os.path.abspath(progress_file) if progress_file else None
+        self.callback = callback
+        self.profile = set(profile)
+        self.profile_dir = os.path.abspath(profile_dir)
+        self.phase = None
+        self.rows = 0
+        self.start = time.perf_counter()
+
+    def emit(self, event, **values):
+        values['event'] = event
+        values['time'] = datetime.datetime.now().isoformat()
+        if self.phase is not None:
+            values.setdefault('phase', self.phase)
+        logger.info(json.dumps(values))
+        if self.progress_file is not None:
+            with open(self.progress_file, 'a') as fd:
+                fd.write(json.dumps(values) + '\n')
+        if self.callback is not None:
+            self.callback(values)
+
+    def add_rows(self, rows):
+        """ Counts ``rows`` more rows written by the current phase """
+        self.rows += rows
+
+    def progress(self, rows):
+        """ Reports the ``rows`` processed so far by the current phase """
+        self.emit('progress', rows=rows)
+
+    def run(self, function, *args, **kwargs):
+        """ Runs ``function``, a method of the command, as a phase named after it and returns its result """
+        name = function.__name__
+        # Days of the updates, ... but not the sets of geonameids
+        if args and all(isinstance(arg, (str, int)) for arg in args):
+            name = '{}:{}'.format(name, ','.join(str(arg) for arg in args))
+        self.phase = name
+        self.rows = 0
+        self.emit('start')
+        stats = QueryStats()
+        profiler = None
+        if 'all' in self.profile or function.__name__ in self.profile:
+            profiler = cProfile.Profile()
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        with connection.execute_wrapper(stats):
+            if profiler is not None:
+                profiler.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                wall = time.perf_counter() - wall
+                cpu = time.process_time() - cpu
+                values = {
+                    'wall_seconds': wall,
+                    'cpu_seconds': cpu,
+                    'rows': self.rows,
+                    'rows_per_second': self.rows / wall if wall else None,
+                    'queries': stats.count,
+                    'query_seconds': stats.seconds,
+                    'peak_rss_kb': peak_rss(),
+                }
+                if profiler is not None:
+                    values['profile'] = os.path.join(self.profile_dir, name.replace(':', '-') + '.prof')
+                    profiler.dump_stats(values['profile'])
+                self.emit('end', **values)
+                self.phase = None
+
+    def done(self):
+        self.emit('done', wall_seconds=time.perf_counter() - self.start, peak_rss_kb=peak_rss())
@@ -0,0 +1,106 @@
+"""
+Loads into shadow copies of the geonames tables and swaps them for the live ones at the end, so readers keep
+querying the old data, without waiting on locks, until a cut-over of a few statements.
+
+The shadow tables are created by Django, with their indexes and constraints, in a schema of their own placed first in
+the ``search_path`` of the connection: the loader queries, unqualified, then read and write them instead of the live
+tables. The swap moves the live tables to another schema and the shadow tables to theirs in one short transaction.
+Foreign keys of other tables to the geonames tables are created again on the new tables, which checks them: if rows
+they point to are gone the swap fails and the live tables are left as they were. Views over the geonames tables
+would follow the old tables and are dropped with them. PostgreSQL only.
+"""
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+# The table, and schema of the table, a name in the search_path refers to. NULL if there is no such table
+TABLE_SCHEMA = """
+    SELECT n.nspname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.oid = to_regclass(%s)
+"""
+# The foreign keys of other tables to the tables
+EXTERNAL_FOREIGN_KEYS = """
+    SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint
+    WHERE contype = 'f' AND confrelid IN (SELECT to_regclass(t.name) FROM unnest(%s::text[]) AS t(name))
+    AND conrelid NOT IN (SELECT to_regclass(t.name) FROM unnest(%s::text[]) AS t(name))
+"""
+
+
+class StagingTables(object):
+    """
+    Shadow tables of ``models`` - and of their many to many tables - in the ``schema`` schema, dropped and created
+    again by ``create``.
+    """
+    def __init__(self, models, schema='geonames_staging', using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.models = list(models)
+        self.tables = []
+        for model in self.models:
+            self.tables.append(model._meta.db_table)
+            for field in model._meta.local_many_to_many:
+                if field.remote_field.through._meta.auto_created:
+                    self.tables.append(field.remote_field.through._meta.db_table)
+        self.schema = schema
+        self.old_schema = '{}_old'.format(schema)
+        self.search_path = None
+
+    @property
+    def supported(self):
+        return self.connection.vendor == 'postgresql'
+
+    def activate(self):
+        """ Makes the unqualified table names refer to the shadow tables """
+        with self.connection.cursor() as cursor:
+            if self.search_path is None:
+                cursor.execute('SHOW search_path')
+                self.search_path = cursor.fetchone()[0]
+            cursor.execute('SET search_path TO {}, {}'.format(self.connection.ops.quote_name(self.schema),
+                                                              self.search_path))
+
+    def deactivate(self):
+        """ Makes the unqualified table names refer to the live tables again """
+        if self.search_path is not None:
+            with self.connection.cursor() as cursor:
+                cursor.execute('SET search_path TO {}'.format(self.search_path))
+
+    def create(self):
+        """ Creates the empty shadow tables and activates them """
+        quote = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            cursor.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(quote(self.schema)))
+            cursor.execute('CREATE SCHEMA {}'.format(quote(self.schema)))
+        # Outside of a transaction, a rollback would bring the previous search_path back
+        self.activate()
+        with self.connection.schema_editor() as editor:
+            for model in self.models:
+                editor.create_model(model)
+
+    def swap(self):
+        """ Replaces the live tables with the shadow tables and drops the old ones """
+        quote = self.connection.ops.quote_name
+        self.deactivate()
+        with transaction.atomic(using=self.connection.alias), self.connection.cursor() as cursor:
+            cursor.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(quote(self.old_schema)))
+            cursor.execute('CREATE SCHEMA {}'.format(quote(self.old_schema)))
+            # Read while the names still refer to the live tables
+            cursor.execute(EXTERNAL_FOREIGN_KEYS, [self.tables, self.tables])
+            foreign_keys = cursor.fetchall()
+            for table, name, definition in foreign_keys:
+                cursor.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(table, quote(name)))
+
+            for table in self.tables:
+                cursor.execute(TABLE_SCHEMA, [table])
+                row = cursor.fetchone()
+                if row is not None:
+                    schema = row[0]
+                    cursor.execute('ALTER TABLE {}.{} SET SCHEMA {}'.format(quote(schema), quote(table),
+                                                                            quote(self.old_schema)))
+                else:
+                    cursor.execute('SELECT current_schema()')
+                    schema = cursor.fetchone()[0]
+                cursor.execute('ALTER TABLE {}.{} SET SCHEMA {}'.format(quote(self.schema), quote(table),
+                                                                        quote(schema)))
+
+            for table, name, definition in foreign_keys:
+                cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(table, quote(name), definition))
+            cursor.execute('DROP SCHEMA {}'.format(quote(self.schema)))
+        # Once committed, readers no longer use the old tables
+        with self.connection.cursor() as cursor:
+            cursor.execute('DROP SCHEMA {} CASCADE'.format(quote(self.old_schema)))
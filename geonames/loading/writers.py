@@ -0,0 +1,159 @@
+"""
+Writers take the rows parsed from the geonames.org dumps - plain tuples in the order of the ``fields`` given to the
+writer - and store them in a model table:
+
+``CopyWriter`` streams them with PostgreSQL's ``COPY FROM STDIN``, ``BulkCreateWriter`` builds model instances and
+uses ``bulk_create``, which works with every data base. Geometries travel in the rows as EWKT strings.
+
+With ``ignore_conflicts`` the rows clashing with a unique constraint are silently skipped, which lets the data base
+do the deduplication the loader can not afford to keep in memory.
+"""
+from django.contrib.gis.geos import GEOSGeometry
+from django.db import DEFAULT_DB_ALIAS, connections
+import functools
+import io
+
+WRITERS = ('auto', 'copy', 'bulk')
+
+
+def point_ewkt(longitude, latitude, srid=4326):
+    """ EWKT representation of a point, understood both by PostGIS and ``GEOSGeometry`` """
+    return 'SRID={};POINT({!r} {!r})'.format(srid, longitude, latitude)
+
+
+def build_instance(model, fields, row):
+    """ Returns an unsaved ``model`` instance from a ``row`` of ``fields`` values """
+    kwargs = dict(zip(fields, row))
+    for name in fields:
+        if getattr(model._meta.get_field(name), 'geom_type', None) and kwargs[name] is not None:
+            kwargs[name] = GEOSGeometry(kwargs[name])
+    return model(**kwargs)
+
+
+class BulkCreateWriter(object):
+    """ Writes the rows through ``bulk_create`` in batches of ``batch`` rows """
+    def __init__(self, model, fields, batch=10000, using=DEFAULT_DB_ALIAS, ignore_conflicts=False):
+        self.model = model
+        self.fields = fields
+        self.batch = batch
+        self.using = using
+        self.ignore_conflicts = ignore_conflicts
+        self.objects = []
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write(self, row):
+        self.objects.append(build_instance(self.model, self.fields, row))
+        if len(self.objects) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.objects:
+            self.model.objects.using(self.using).bulk_create(self.objects, ignore_conflicts=self.ignore_conflicts)
+            self.written += len(self.objects)
+            self.objects = []
+
+    def close(self):
+        self.flush()
+
+
+class CopyWriter(object):
+    """
+    Streams the rows to PostgreSQL as ``COPY`` text format in batches of ``batch`` rows. To ignore conflicts they
+    are copied into a temporary table and moved with ``INSERT ... ON CONFLICT DO NOTHING``.
+    """
+    def __init__(self, model, fields, batch=10000, using=DEFAULT_DB_ALIAS, ignore_conflicts=False):
+        self.connection = connections[using]
+        self.batch = batch
+        self.buffer = io.StringIO()
+        self.pending = 0
+        self.written = 0
+        quote = self.connection.ops.quote_name
+        table = quote(model._meta.db_table)
+        columns = ', '.join(quote(model._meta.get_field(name).column) for name in fields)
+        self.setup_sql = []
+        if ignore_conflicts:
+            staging = quote('{}_copy'.format(model._meta.db_table))
+            self.setup_sql = [
+                'CREATE TEMPORARY TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS)'.format(staging, table),
+                'TRUNCATE {}'.format(staging),
+            ]
+            self.sql = 'COPY {} ({}) FROM STDIN'.format(staging, columns)
+            self.finish_sql = 'INSERT INTO {0} ({1}) SELECT {1} FROM {2} ON CONFLICT DO NOTHING'.format(
+                table, columns, staging)
+        else:
+            self.sql = 'COPY {} ({}) FROM STDIN'.format(table, columns)
+            self.finish_sql = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    @staticmethod
+    def format(value):
+        if value is None:
+            return '\\N'
+        if isinstance(value, str):
+            return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+        return str(value)
+
+    def write(self, row):
+        self.buffer.write('\t'.join([self.format(value) for value in row]))
+        self.buffer.write('\n')
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.flush()
+
+    def copy(self, sql, params, many, context):
+        raw_cursor = context['cursor'].cursor
+        if hasattr(raw_cursor, 'copy_expert'):
+            # psycopg2
+            raw_cursor.copy_expert(sql, self.buffer)
+        else:
+            # psycopg 3
+            with raw_cursor.copy(sql) as copy:
+                copy.write(self.buffer.getvalue())
+
+    def flush(self):
+        if self.pending == 0:
+            return
+        self.buffer.seek(0)
+        with self.connection.cursor() as cursor:
+            for sql in self.setup_sql:
+                cursor.execute(sql)
+            # COPY skips cursor.execute, so it goes through the execute wrappers - the query counts - here
+            execute = self.copy
+            for wrapper in reversed(self.connection.execute_wrappers):
+                execute = functools.partial(wrapper, execute)
+            execute(self.sql, None, False, {'connection': self.connection, 'cursor': cursor})
+            if self.finish_sql:
+                cursor.execute(self.finish_sql)
+        self.written += self.pending
+        self.pending = 0
+        self.buffer = io.StringIO()
+
+    def close(self):
+        self.flush()
+
+
+def get_writer(model, fields, kind='auto', batch=10000, using=DEFAULT_DB_ALIAS, ignore_conflicts=False):
+    """
+    Returns the writer of ``kind`` for ``model`` - 'copy', 'bulk', or 'auto' to use ``COPY`` when the data base
+    is PostgreSQL
+    """
+    if kind not in WRITERS:
+        raise ValueError("Unknown writer '{}', choose one of {}".format(kind, ', '.join(WRITERS)))
+    if kind == 'auto':
+        kind = 'copy' if connections[using].vendor == 'postgresql' else 'bulk'
+    if kind == 'copy':
+        return CopyWriter(model, fields, batch=batch, using=using, ignore_conflicts=ignore_conflicts)
+    return BulkCreateWriter(model, fields, batch=batch, using=using, ignore_conflicts=ignore_conflicts)
@@ -0,0 +1,136 @@
+"""
+Process-local indexes over the geonames tables, built once per process and built again when a new
+``GeonamesUpdate`` is saved - right away in this process, and within ``GEONAMES_INDEX_TTL`` seconds (60 by default)
+in the others.
+
+Indexes can also be built again when an instance of some models is saved or deleted. With the ``GEONAMES_CACHE``
+setting naming a Django cache, those changes reach the other processes through a version stamp kept in that cache,
+and the ``shared`` indexes are stored there too so each version is only built from the data base once.
+"""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.signals import post_delete, post_save
+
+
+def current_version():
+    from geonames.models import GeonamesUpdate
+    return GeonamesUpdate.objects.order_by('-pk').values_list('pk', flat=True).first()
+
+
+def shared_cache():
+    """ The Django cache named by the ``GEONAMES_CACHE`` setting, if any """
+    alias = getattr(settings, 'GEONAMES_CACHE', None)
+    if alias is None:
+        return None
+    from django.core.cache import caches
+    return caches[alias]
+
+
+class LocalIndex(object):
+    """ Holds the index returned by ``build``, built again when an instance of ``senders`` changes """
+    instances = []
+
+    def __init__(self, build, senders=(), name=None, shared=False):
+        self.build = build
+        self.name = name or '{}.{}'.format(build.__module__, build.__name__)
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.index = None
+        self.version = None
+        self.checked = 0
+        LocalIndex.instances.append(self)
+        post_save.connect(self.invalidate, sender='geonames.GeonamesUpdate', weak=False,
+                          dispatch_uid='geonames.local_index.{}'.format(self.name))
+        for sender in senders:
+            for signal in (post_save, post_delete):
+                signal.connect(self.changed, sender=sender, weak=False,
+                               dispatch_uid='geonames.local_index.{}.{}'.format(self.name, sender._meta.label))
+
+    def stamp_key(self):
+        return 'geonames:stamp:{}'.format(self.name)
+
+    def current_version(self):
+        cache = shared_cache()
+        if cache is None:
+            return current_version(), None
+        return current_version(), cache.get(self.stamp_key())
+
+    def load(self, version):
+        cache = shared_cache()
+        if cache is None or not self.shared:
+            return self.build()
+        key = 'geonames:index:{}:{}:{}'.format(self.name, *version)
+        index = cache.get(key)
+        if index is None:
+            index = self.build()
+            cache.set(key, index)
+        return index
+
+    def get(self):
+        """ Returns the index, building it when missing or outdated """
+        with self.lock:
+            now = time.monotonic()
+            if self.index is not None and now - self.checked < getattr(settings, 'GEONAMES_INDEX_TTL', 60):
+                return self.index
+            version = self.current_version()
+            self.checked = now
+            if self.index is None or version != self.version:
+                self.index = self.load(version)
+                self.version = version
+            return self.index
+
+    def warm(self):
+        """ Builds the index in a background thread, for the first request not to wait for it """
+        def build():
+            try:
+                self.get()
+            finally:
+                connections.close_all()
+        thread = threading.Thread(target=build, name='geonames-{}'.format(self.name), daemon=True)
+        thread.start()
+        return thread
+
+    def changed(self, **kwargs):
+        cache = shared_cache()
+        if cache is not None:
+            cache.set(self.stamp_key(), uuid.uuid4().hex, None)
+        self.invalidate()
+
+    def invalidate(self, **kwargs):
+        with self.lock:
+            self.index = None
+
+
+def invalidate_all():
+    """ Drops every index of this process, after changes that sent no signal - bulk writes, rollbacks, ... """
+    for index in LocalIndex.instances:
+        index.invalidate()
+
+
+def warm_all():
+    """ Builds every index of this process in background threads, returned """
+    return [index.warm() for index in LocalIndex.instances]
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def cached_table(name, build, senders):
+    """ Returns the shared index ``name`` returned by ``build``, built again when an instance of ``senders`` changes """
+    with _tables_lock:
+        if name not in _tables:
+            _tables[name] = LocalIndex(build, senders, name, shared=True)
+    return _tables[name].get()
+
+
+def invalidate_tables(label):
+    """ Drops the cached tables of this process named ``label`` or ``label.<something>``, found outdated """
+    with _tables_lock:
+        tables = [table for name, table in _tables.items() if name == label or name.startswith(label + '.')]
+    for table in tables:
+        table.invalidate()
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from geonames.benchmarks import run
+from geonames.loading.writers import WRITERS
+import json
+import os
+import shutil
+import tempfile
+
+
+class Command(BaseCommand):
+    help = "Benchmarks geonames on a synthetic dump loaded into the empty data base, and rolled back afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--localities', type=int, default=5000,
+                            help="Number of localities of the synthetic dump.")
+        parser.add_argument('--seed', type=int, default=0,
+                            help="Seed of the synthetic dump and of the samples, the same seed gives the same data.")
+        parser.add_argument('--iterations', type=int, default=100,
+                            help="Number of calls of each benchmark.")
+        parser.add_argument('--miles', type=float, default=50,
+                            help="Radius of the radius searches.")
+        parser.add_argument('--writer', choices=WRITERS, default='auto',
+                            help="Writer of the loader, see loadgeonames.")
+        parser.add_argument('--data-dir', dest='data_dir', default=None,
+                            help="Directory to write the synthetic dump to and keep, a temporary one by default.")
+        parser.add_argument('--output', default='geonames-benchmark.json',
+                            help="File to write the JSON report to, '-' for the standard output.")
+
+    def handle(self, *args, **options):
+        directory = os.path.abspath(options['data_dir'] or tempfile.mkdtemp(prefix='django-geonames-benchmark-'))
+        # The loader changes to the data directory
+        cwd = os.getcwd()
+        try:
+            report = run(directory, localities=options['localities'], seed=options['seed'],
+                         iterations=options['iterations'], miles=options['miles'], writer=options['writer'])
+        except ValueError as error:
+            raise CommandError(error)
+        finally:
+            os.chdir(cwd)
+            if options['data_dir'] is None:
+                shutil.rmtree(directory)
+
+        if options['output'] == '-':
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            with open(options['output'], 'w') as fd:
+                json.dump(report, fd, indent=2)
+            print('Report written to {}'.format(options['output']))
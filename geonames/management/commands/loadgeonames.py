@@ -1,43 +1,195 @@
-from django.contrib.gis.geos import Point
+from collections import namedtuple
 from django.core.management.base import BaseCommand
 from django.db import transaction
-from django.db.models import Count
+from django.db.models import Count, OuterRef, Subquery
 import traceback
+from geonames.loading.checkpoints import Checkpoints
+from geonames.loading.downloads import DownloadError, download_all
+from geonames.loading.indexes import DeferredIndexes
+from geonames.loading.instrumentation import Recorder
+from geonames.loading.parsing import AlternateNameParser, GeonameParser, GeonameidSet, RecentNames, parse_file
+from geonames.loading.staging import StagingTables
+from geonames.loading.writers import WRITERS, build_instance, get_writer, point_ewkt
+from geonames.local_index import invalidate_all
+from geonames.search import normalize_name
 from geonames.models import Timezone, Language, Country, Currency, Locality, \
-    Admin1Code, Admin2Code, AlternateName, GeonamesUpdate
+    Admin1Code, Admin2Code, AlternateName, GeonamesCheckpoint, GeonamesUpdate, build_display_name, build_long_name
 import datetime
 import os
 import sys
 import tempfile
 import shutil
-import glob
 FILES = [
     'http://download.geonames.org/export/dump/timeZones.txt',
     'http://download.geonames.org/export/dump/iso-languagecodes.txt',
     'http://download.geonames.org/export/dump/countryInfo.txt',
     'http://download.geonames.org/export/dump/admin1CodesASCII.txt',
     'http://download.geonames.org/export/dump/admin2Codes.txt',
-    'http://download.geonames.org/export/dump/cities500.zip',
     'http://download.geonames.org/export/dump/alternateNames.zip',
 ]
 
+# The localities dump, formatted with one of LOCALITIES_FILES
+LOCALITIES_URL = 'http://download.geonames.org/export/dump/{}.zip'
+# Dumps with the same format and their minimum population besides administrative seats
+LOCALITIES_FILES = {
+    'cities500': 500,
+    'cities1000': 1000,
+    'cities5000': 5000,
+    'cities15000': 15000,
+    'allCountries': 0,
+}
+
+# Daily incremental files, formatted with the file kind and the 'YYYY-MM-DD' day they cover
+# see http://download.geonames.org/export/dump/readme.txt
+UPDATE_FILES_URL = 'http://download.geonames.org/export/dump/{}-{}.txt'
+UPDATE_FILES = ['modifications', 'deletes', 'alternateNamesModifications', 'alternateNamesDeletes']
+
+# Corrections to the names of iso-languagecodes.txt by ISO 639-1 code
+LANGUAGE_NAMES = {
+    'km': 'Khmer',
+    'ia': 'Interlingua',
+    'ms': 'Malay',
+    'el': 'Greek',
+    'se': 'Sami',
+    'oc': 'Occitan',
+    'st': 'Sotho',
+    'sw': 'Swahili',
+    'to': 'Tonga',
+    'fy': 'Frisian',
+}
+
 # See http://www.geonames.org/export/codes.html
 city_types = ['PPL','PPLA','PPLC','PPLA2','PPLA3','PPLA4', 'PPLG']
 
+# Rows handed to the writers, see ``geonames.loading.writers``
+LocalityRow = namedtuple('LocalityRow', ['status', 'geonameid', 'name', 'search_name', 'long_name', 'display_name',
+                                         'country_id', 'admin1_id', 'admin2_id', 'timezone_id', 'population',
+                                         'latitude', 'longitude', 'point', 'modification_date'])
+AlternateNameRow = namedtuple('AlternateNameRow', ['status', 'alternatenameid', 'locality_id', 'name', 'search_name'])
+
+
+def chunks(items, size):
+    """ Yields successive lists of at most ``size`` elements from ``items`` """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 
 class Command(BaseCommand):
     help = "Geonames import command."
     temp_dir_path = os.path.join(tempfile.gettempdir(), 'django-geonames-downloads')
-    countries = {}
-    localities = set()
+    batch = 10000
+    writer = 'auto'
+    workers = 1
+    localities_file = 'cities500'
+    low_memory = False
+    # Drop the indexes and constraints of the big tables while loading, see --defer-indexes
+    defer_indexes = False
+    # Load into shadow tables in this schema and swap them in at the end, see --staging
+    staging = False
+    staging_schema = 'geonames_staging'
+    # Checkpoints of the full load, see --resume. Phases run by themselves, as the benchmarks do, keep none
+    checkpoints = None
+    # Phases committing by themselves, batch by batch, instead of in one transaction
+    batched_phases = ('load_altnames', 'swap_tables')
+    download_workers = 4
+    # Directory with the dumps already downloaded, see --data-dir
+    data_dir = None
+    # Called with each instrumentation event, see geonames.loading.instrumentation
+    progress_callback = None
+
+    # Number of localities whose alternate names are remembered to skip duplicates in low memory mode
+    altnames_window = 10000
+
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        # Filled by the load, of this instance only
+        self.countries = {}
+        self.admin_names = {}
+        self.country_names = {}
+        self.localities = set()
+        self.recorder = Recorder(callback=self.progress_callback)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--update', action='store_true', dest='update', default=False,
+                            help="Apply the changes published by geonames.org since the last load instead of "
+                                 "importing everything into an empty database.")
+        parser.add_argument('--rebuild-names', action='store_true', dest='rebuild_names', default=False,
+                            help="Recompute the long, display and search names of the stored Localities and the "
+                                 "search names of the AlternateNames, e.g. after upgrading from a version without "
+                                 "those columns.")
+        parser.add_argument('--writer', choices=WRITERS, default=self.writer,
+                            help="How Localities and AlternateNames are written: 'copy' streams them with "
+                                 "PostgreSQL's COPY, 'bulk' uses bulk_create and 'auto' picks 'copy' on PostgreSQL.")
+        parser.add_argument('--localities-file', choices=sorted(LOCALITIES_FILES), default=self.localities_file,
+                            help="geonames.org dump the Localities are loaded from.")
+        parser.add_argument('--workers', type=int, default=self.workers,
+                            help="Number of processes parsing the Localities and AlternateNames files.")
+        parser.add_argument('--low-memory', action='store_true', dest='low_memory', default=False,
+                            help="Load the AlternateNames with bounded memory, leaving to the database the "
+                                 "duplicates it does not remember.")
+        parser.add_argument('--defer-indexes', action='store_true', dest='defer_indexes', default=False,
+                            help="Drop the indexes and constraints of the Admin1Code, Admin2Code, Locality and "
+                                 "AlternateName tables during a full load and build them again at the end. "
+                                 "PostgreSQL and SQLite only.")
+        parser.add_argument('--staging', action='store_true', dest='staging', default=False,
+                            help="Refresh a loaded database: load into new tables, committing each step, and swap "
+                                 "them for the current ones at the end in a short transaction. PostgreSQL only.")
+        parser.add_argument('--resume', action='store_true', dest='resume', default=False,
+                            help="Continue an interrupted full load from its last checkpoint, with the options it "
+                                 "was started with.")
+        parser.add_argument('--data-dir', dest='data_dir', default=None,
+                            help="Read the geonames.org files from this directory instead of downloading them.")
+        parser.add_argument('--progress-file', dest='progress_file', default=None,
+                            help="Append the measures of each phase - time, rows, queries, memory - to this file "
+                                 "as JSON lines. They are also logged to the 'geonames.loading' logger.")
+        parser.add_argument('--profile', default='',
+                            help="Comma separated phases to run under cProfile, 'all' for every phase, e.g. "
+                                 "'load_localities,check_errors'.")
+        parser.add_argument('--profile-dir', dest='profile_dir', default='.',
+                            help="Directory the <phase>.prof files of --profile are written to.")
 
     def handle(self, *args, **options):
         start_time = datetime.datetime.now()
-        self.load()
+        self.writer = options['writer']
+        self.workers = options['workers']
+        self.localities_file = options['localities_file']
+        self.low_memory = options['low_memory']
+        self.defer_indexes = options['defer_indexes']
+        self.staging = options['staging']
+        if options['data_dir']:
+            self.data_dir = self.temp_dir_path = os.path.abspath(options['data_dir'])
+        self.resume = options['resume'] and not options['update']
+        if self.resume:
+            self.resume_options()
+        if self.low_memory:
+            self.localities = GeonameidSet()
+        self.recorder = Recorder(options['progress_file'], self.progress_callback,
+                                 [phase for phase in options['profile'].split(',') if phase], options['profile_dir'])
+        if options['rebuild_names']:
+            self.rebuild_names()
+        elif options['update']:
+            self.update()
+        elif self.staging:
+            self.load_staged()
+        else:
+            self.load()
+        self.recorder.done()
         print('\nCompleted in {}'.format(datetime.datetime.now() - start_time))
 
-    @transaction.atomic
     def load(self):
+        """ Loads everything into an empty data base, committing each phase, see run_phases """
+        if self.resume:
+            self.restore_state()
+            self.run_phases([self.download_files] + self.load_phases())
+            GeonamesUpdate.objects.create()
+            self.checkpoints.finish()
+            return
+
+        if GeonamesCheckpoint.objects.exists() and Timezone.objects.exists():
+            print('ERROR a previous load was interrupted, run again with --resume to continue it')
+            sys.exit(1)
+
         if Timezone.objects.all().count() is not 0:
             print(' ERROR there are Timezones in the data base')
             sys.exit(1)
@@ -62,43 +214,186 @@ class Command(BaseCommand):
             print('ERROR there are Localities in the data base')
             sys.exit(1)
 
-        self.download_files()
-        self.unzip_files()
-        self.load_timezones()
-        self.load_languagecodes()
-        self.load_countries()
-        self.load_admin1()
-        self.load_admin2()
-        self.load_localities()
-        self.cleanup()
-        self.load_altnames()
-        self.check_errors()
+        self.checkpoints = Checkpoints.start(self.checkpoint_options())
+        self.run_phases([self.download_files] + self.load_phases())
         # Save the time when the load happened
         GeonamesUpdate.objects.create()
+        self.checkpoints.finish()
         # TODO add a --force to clean up files and do a complete a re-download
         #self.cleanup_files()
 
+    def load_staged(self):
+        """ Like load, but into shadow tables readers do not see until they are swapped in """
+        self.staging_tables = StagingTables([Timezone, Language, Currency, Country, Admin1Code, Admin2Code, Locality,
+                                             AlternateName], self.staging_schema)
+        if not self.staging_tables.supported:
+            print('ERROR --staging needs PostgreSQL')
+            sys.exit(1)
+
+        # The reference tables cached by this process are the live ones
+        invalidate_all()
+        if self.resume:
+            if self.checkpoints.completed('create_staging_tables'):
+                self.staging_tables.activate()
+            self.restore_state()
+        else:
+            self.checkpoints = Checkpoints.start(self.checkpoint_options())
+        try:
+            self.run_phases([self.download_files, self.create_staging_tables] + self.load_phases())
+        finally:
+            # The staging tables are kept to resume the load
+            self.staging_tables.deactivate()
+            invalidate_all()
+        self.run_phases([self.swap_tables])
+        # Save the time when the load happened, which also tells other processes to drop their cached data
+        GeonamesUpdate.objects.create()
+        self.checkpoints.finish()
+        invalidate_all()
+
+    def checkpoint_options(self):
+        """ The options a resumed load must keep """
+        return {
+            'localities_file': self.localities_file,
+            'low_memory': self.low_memory,
+            'defer_indexes': self.defer_indexes,
+            'staging': self.staging,
+            'data_dir': self.data_dir,
+        }
+
+    def resume_options(self):
+        self.checkpoints = Checkpoints.resume()
+        if self.checkpoints is None:
+            print('ERROR there is no interrupted load to resume')
+            sys.exit(1)
+        for name, value in self.checkpoints.options.items():
+            setattr(self, name, value)
+        if self.data_dir is not None:
+            self.temp_dir_path = self.data_dir
+
+    def restore_state(self):
+        """ Fills what the phases completed before the interruption left in memory for the next ones """
+        if self.checkpoints.completed('load_countries'):
+            self.load_reference_maps()
+        if self.checkpoints.completed('load_localities'):
+            for geonameid in Locality.objects.values_list('geonameid', flat=True).iterator():
+                self.localities.add(geonameid)
+        if self.checkpoints.completed('drop_indexes'):
+            self.deferred = self.deferred_indexes()
+            self.deferred.dropped = self.checkpoints.get_state('drop_indexes') or []
+
+    def run_phases(self, phases):
+        """
+        Runs each phase in a transaction of its own and records it as completed, skipping the ones an interrupted
+        load completed. The batched phases commit, and record, every batch themselves.
+        """
+        for phase in phases:
+            name = phase.__name__
+            if self.checkpoints.completed(name):
+                print('Skipping {}, completed before the interruption'.format(name))
+                continue
+            try:
+                if name in self.batched_phases:
+                    self.recorder.run(phase)
+                    self.checkpoints.complete(name)
+                else:
+                    with transaction.atomic():
+                        self.recorder.run(phase)
+                        self.checkpoints.complete(name)
+            except BaseException:
+                print('ERROR {} failed, run again with --resume to continue from the last checkpoint'.format(name))
+                raise
+
+    def create_staging_tables(self):
+        print('Creating tables in the {} schema'.format(self.staging_schema))
+        self.staging_tables.create()
+
+    def swap_tables(self):
+        print('Swapping the loaded tables in')
+        self.staging_tables.swap()
+
+    def update(self):
+        last_update = GeonamesUpdate.objects.order_by('-update_date', '-pk').first()
+        if last_update is None:
+            print('ERROR there is no previous load to update, run a full load first')
+            sys.exit(1)
+
+        # The dumps hold the changes made until the day before the load, so the daily files are applied from the
+        # day of the last update on - applying a change twice is harmless
+        days = []
+        day = last_update.update_date
+        while day < datetime.date.today():
+            days.append(day.isoformat())
+            day += datetime.timedelta(days=1)
+
+        if len(days) == 0:
+            print('Nothing to update, the last update was today')
+            return
+
+        run = self.recorder.run
+        # Downloaded before the transaction, so it is not kept open during the transfers
+        daily = run(self.download_update_files, days)
+        if not daily:
+            # geonames.org only keeps the daily files for a while, so we compare the whole dump instead
+            print('Daily files since {} are not available, comparing the whole dump'.format(days[0]))
+            run(self.download_files)
+
+        with transaction.atomic():
+            run(self.load_reference_maps)
+            if daily:
+                touched = set()
+                for day in days:
+                    touched |= run(self.update_localities, day)
+                    run(self.update_altnames, day)
+            else:
+                touched = run(self.update_localities_from_dump)
+
+            run(self.update_duplicated_localities, touched)
+            run(self.fill_missing_timezones)
+            run(self.check_errors)
+            # Save the time when the update happened
+            GeonamesUpdate.objects.create()
+
+    def load_phases(self):
+        """ The steps of a full load once the files are downloaded, in order """
+        phases = [self.load_timezones, self.load_languagecodes, self.load_countries, self.load_admin1,
+                  self.load_admin2, self.load_localities, self.cleanup, self.load_altnames, self.check_errors]
+        if self.defer_indexes:
+            # The indexes must be back before check_errors looks at the data
+            phases.insert(phases.index(self.load_admin1), self.drop_indexes)
+            phases.insert(phases.index(self.check_errors), self.restore_indexes)
+        return phases
+
+    def deferred_indexes(self):
+        # The low memory mode relies on the AlternateName unique constraint to skip the duplicates
+        return DeferredIndexes([Admin1Code, Admin2Code, Locality, AlternateName],
+                               keep_unique=[AlternateName] if self.low_memory else [])
+
+    def drop_indexes(self):
+        self.deferred = self.deferred_indexes()
+        if not self.deferred.supported:
+            print('Indexes can not be deferred on this data base, keeping them')
+            return
+        print('Dropping indexes')
+        print(' {0:8d} indexes and constraints dropped'.format(self.deferred.drop()))
+        if self.checkpoints is not None:
+            # To build them again if the load is resumed
+            self.checkpoints.set_state('drop_indexes', self.deferred.dropped)
+
+    def restore_indexes(self):
+        print('Building indexes')
+        self.deferred.restore()
+        self.deferred.verify()
+
     def download_files(self):
-        # make the temp folder if it dosen't exist
+        if self.data_dir is not None:
+            return
+        print('Downloading files')
         try:
-            os.mkdir(self.temp_dir_path)
-        except OSError:
-            pass
-        os.chdir(self.temp_dir_path)
-        for f in FILES:
-            # --timestamping (-N) will overwrite files rather then appending .1, .2 ...
-            # see http://stackoverflow.com/a/16840827/913223
-            if os.system('wget --timestamping %s' % f) != 0:
-                print("ERROR fetching %s. Perhaps you are missing the 'wget' utility." % os.path.basename(f))
-                sys.exit(1)
-
-    def unzip_files(self):
-        os.chdir(self.temp_dir_path)
-        print("Unzipping downloaded files as needed: ''." % glob.glob('*.zip'))
-        for f in glob.glob('*.zip'):
-            if os.system('unzip -o %s' % f) != 0:
-                print("ERROR unzipping %s. Perhaps you are missing the 'unzip' utility." % f)
-                sys.exit(1)
+            download_all(FILES + [LOCALITIES_URL.format(self.localities_file)], self.temp_dir_path,
+                         workers=self.download_workers)
+        except DownloadError as error:
+            print(error)
+            sys.exit(1)
 
     def cleanup_files(self):
         shutil.rmtree(self.temp_dir_path)
@@ -115,11 +410,12 @@ class Command(BaseCommand):
                     name, gmt_offset, dst_offset = fields[1:4]
                     objects.append(Timezone(name=name, gmt_offset=gmt_offset, dst_offset=dst_offset))
             except Exception as inst:
-                traceback.print_exc(inst)
+                traceback.print_exc()
                 raise Exception("ERROR parsing:\n {}\n The error was: {}".format(line, inst))
 
         Timezone.objects.bulk_create(objects)
-        print('{0:8d} Timezones loaded'.format(Timezone.objects.all().count()))
+        self.recorder.add_rows(len(objects))
+        print('{0:8d} Timezones loaded'.format(len(objects)))
 
     def load_languagecodes(self):
         print('Loading Languages')
@@ -133,34 +429,20 @@ class Command(BaseCommand):
                     iso_639_1, name = fields[2:4]
                     if iso_639_1 != '':
                         objects.append(Language(iso_639_1=iso_639_1,
-                                                name=name))
+                                                name=LANGUAGE_NAMES.get(iso_639_1, name)))
             except Exception as inst:
-                traceback.print_exc(inst)
+                traceback.print_exc()
                 raise Exception("ERROR parsing:\n {}\n The error was: {}".format(line, inst))
 
         Language.objects.bulk_create(objects)
-        print('{0:8d} Languages loaded'.format(Timezone.objects.all().count()))
-        self.fix_languagecodes()
-
-    def fix_languagecodes(self):
-        print('Fixing Language codes')
-        # Corrections
-        Language.objects.filter(iso_639_1='km').update(name='Khmer')
-        Language.objects.filter(iso_639_1='ia').update(name='Interlingua')
-        Language.objects.filter(iso_639_1='ms').update(name='Malay')
-        Language.objects.filter(iso_639_1='el').update(name='Greek')
-        Language.objects.filter(iso_639_1='se').update(name='Sami')
-        Language.objects.filter(iso_639_1='oc').update(name='Occitan')
-        Language.objects.filter(iso_639_1='st').update(name='Sotho')
-        Language.objects.filter(iso_639_1='sw').update(name='Swahili')
-        Language.objects.filter(iso_639_1='to').update(name='Tonga')
-        Language.objects.filter(iso_639_1='fy').update(name='Frisian')
+        self.recorder.add_rows(len(objects))
+        print('{0:8d} Languages loaded'.format(len(objects)))
 
     def load_countries(self):
         print('Loading Countries')
         objects = []
         langs_dic = {}
-        dollar = Currency.objects.create(code='USD', name='Dollar')
+        currencies = {'USD': Currency(code='USD', name='Dollar')}
         os.chdir(self.temp_dir_path)
         with open('countryInfo.txt', encoding="utf8") as fd:
             try:
@@ -172,39 +454,47 @@ class Command(BaseCommand):
                     code = fields[0]
                     self.countries[code] = {}
                     name = fields[4]#str(fields[4], 'utf-8')
-                    currency_code = fields[10]
+                    self.country_names[code] = name
+                    currency_code = fields[10] or 'USD'
                     currency_name = fields[11]
                     langs_dic[code] = fields[15]
-                    if currency_code == '':
-                        currency = dollar
-                    else:
-                        currency, created = Currency.objects.get_or_create(
-                                code=currency_code, defaults={'name': currency_name})
+                    if currency_code not in currencies:
+                        currencies[currency_code] = Currency(code=currency_code, name=currency_name)
 
                     objects.append(Country(code=code,
                                            name=name,
-                                           currency=currency))
+                                           currency_id=currency_code))
             except Exception as inst:
-                traceback.print_exc(inst)
+                traceback.print_exc()
                 raise Exception("ERROR parsing:\n {}\n The error was: {}".format(line, inst))
 
+        Currency.objects.bulk_create(currencies.values())
         Country.objects.bulk_create(objects)
-        print('{0:8d} Countries loaded'.format(Country.objects.all().count()))
+        self.recorder.add_rows(len(objects))
+        print('{0:8d} Countries loaded'.format(len(objects)))
 
         print('Adding Languages to Countries')
-        default_lang = Language.objects.get(iso_639_1='en')
-        for country in Country.objects.all():
+        languages = {}
+        for name, iso_639_1 in Language.objects.values_list('name', 'iso_639_1'):
+            languages.setdefault(iso_639_1, []).append(name)
+        default_lang = languages['en'][0]
+        CountryLanguage = Country.languages.through
+        country_languages = []
+        for country in objects:
+            names = []
             for code in langs_dic[country.code].split(','):
                 iso_639_1 = code.split("-")[0]
                 if len(iso_639_1) < 2:
                     continue
 
-                languages = Language.objects.filter(iso_639_1=iso_639_1)
-                if languages.count() == 1:
-                    country.languages.add(languages[0])
+                # Only the codes matching a single language
+                if len(languages.get(iso_639_1, [])) == 1 and languages[iso_639_1][0] not in names:
+                    names.append(languages[iso_639_1][0])
+
+            for name in names or [default_lang]:
+                country_languages.append(CountryLanguage(country_id=country.code, language_id=name))
 
-            if country.languages.count() == 0:
-                country.languages.add(default_lang)
+        CountryLanguage.objects.bulk_create(country_languages)
 
     def load_admin1(self):
         print('Loading Admin1Codes')
@@ -216,24 +506,26 @@ class Command(BaseCommand):
                     fields = [field.strip() for field in line[:-1].split('\t')]
                     codes, name = fields[0:2]
                     country_code, admin1_code = codes.split('.')
-                    geonameid = fields[3]
+                    geonameid = int(fields[3])
                     self.countries[country_code][admin1_code] = {'geonameid': geonameid, 'admins2': {}}
+                    self.admin_names[geonameid] = name
                     name = name #unicode(name, 'utf-8')
                     objects.append(Admin1Code(geonameid=geonameid,
                                               code=admin1_code,
                                               name=name,
                                               country_id=country_code))
             except Exception as inst:
-                traceback.print_exc(inst)
+                traceback.print_exc()
                 raise Exception("ERROR parsing:\n {}\n The error was: {}".format(line, inst))
 
         Admin1Code.objects.bulk_create(objects)
-        print('{0:8d} Admin1Codes loaded'.format(Admin1Code.objects.all().count()))
+        self.recorder.add_rows(len(objects))
+        print('{0:8d} Admin1Codes loaded'.format(len(objects)))
 
     def load_admin2(self):
         print('Loading Admin2Codes')
         objects = []
-        admin2_list = []  # to find duplicated
+        admin2_list = set()  # to find duplicated
         skipped_duplicated = 0
         os.chdir(self.temp_dir_path)
         with open('admin2Codes.txt', encoding="utf8") as fd:
@@ -249,9 +541,9 @@ class Command(BaseCommand):
                         skipped_duplicated += 1
                         continue
 
-                    admin2_list.append(long_code)
+                    admin2_list.add(long_code)
 
-                    geonameid = fields[3]
+                    geonameid = int(fields[3])
                     admin1_dic = self.countries[country_code].get(admin1_code)
 
                     # if there is not admin1 level we save it but we don't keep it for the localities
@@ -261,6 +553,7 @@ class Command(BaseCommand):
                         # If not, we get the id of admin1 and we save geonameid for filling in Localities later
                         admin1_id = admin1_dic['geonameid']
                         admin1_dic['admins2'][admin2_code] = geonameid
+                        self.admin_names[geonameid] = name
 
                     name = name #unicode(name, 'utf-8')
                     objects.append(Admin2Code(geonameid=geonameid,
@@ -269,94 +562,161 @@ class Command(BaseCommand):
                                               country_id=country_code,
                                               admin1_id=admin1_id))
             except Exception as inst:
-                traceback.print_exc(inst)
+                traceback.print_exc()
                 raise Exception("ERROR parsing:\n {}\n The error was: {}".format(line, inst))
 
         Admin2Code.objects.bulk_create(objects)
-        print('{0:8d} Admin2Codes loaded'.format(Admin2Code.objects.all().count()))
+        self.recorder.add_rows(len(objects))
+        print('{0:8d} Admin2Codes loaded'.format(len(objects)))
         print('{0:8d} Admin2Codes skipped because duplicated'.format(skipped_duplicated))
 
+    def get_writer(self, model, fields, **kwargs):
+        return get_writer(model, fields, kind=self.writer, batch=self.batch, **kwargs)
+
+    def generate_long_name(self, name, admin1_id, admin2_id):
+        """ Same as ``Locality.generate_long_name`` but with the admin names kept in memory """
+        return build_long_name(name, self.admin_names.get(admin1_id), self.admin_names.get(admin2_id))
+
+    @property
+    def min_population(self):
+        return LOCALITIES_FILES[self.localities_file]
+
+    def parse_localities(self):
+        """ Yields the ``GeonameRecord`` of the localities in the localities file """
+        return parse_file('{}.zip'.format(self.localities_file), GeonameParser(city_types), workers=self.workers)
+
+    def locality_row(self, record):
+        """ Returns the ``LocalityRow`` of a ``GeonameRecord`` """
+        admin1_dic = self.countries[record.country_code].get(record.admin1_code)
+        if admin1_dic:
+            admin1_id = admin1_dic['geonameid']
+            admin2_id = admin1_dic['admins2'].get(record.admin2_code)
+        else:
+            admin1_id = None
+            admin2_id = None
+        long_name = self.generate_long_name(record.name, admin1_id, admin2_id)
+        return LocalityRow(
+            status=Locality.objects.STATUS_ENABLED,
+            geonameid=record.geonameid,
+            name=record.name,
+            search_name=normalize_name(record.name),
+            long_name=long_name,
+            display_name=build_display_name(long_name, self.country_names[record.country_code]),
+            country_id=record.country_code,
+            admin1_id=admin1_id,
+            admin2_id=admin2_id,
+            timezone_id=record.timezone or None,
+            population=record.population,
+            latitude=record.latitude,
+            longitude=record.longitude,
+            point=point_ewkt(record.longitude, record.latitude),
+            modification_date=record.modification_date)
+
     def load_localities(self):
         print('Loading Localities')
-        objects = []
-        batch = 10000
+        batch = self.batch
         processed = 0
+        # Most populated locality time zone per admin2, admin1 and country, to fill the missing ones
+        timezones = {}
+        missing = []
+        # Population and geonameid of the first locality written per country and long name, the next localities
+        # with the same long name are only written once we know which one of them is the most populated
+        written = {}
+        duplicated = []
+
+        def write(row):
+            key = (row.country_id, row.long_name)
+            if key in written:
+                duplicated.append(row)
+            else:
+                written[key] = (row.population, row.geonameid)
+                writer.write(row)
+
         os.chdir(self.temp_dir_path)
-        with open('cities500.txt', 'r', encoding="utf8") as fd:
-            for line in fd:
+        with self.get_writer(Locality, LocalityRow._fields) as writer:
+            for record in self.parse_localities():
                 try:
-                    fields = [field.strip() for field in line[:-1].split('\t')]
-                    type = fields[7]
-                    if type not in city_types:
+                    row = self.locality_row(record)
+                    self.localities.add(row.geonameid)
+                    if row.timezone_id is None:
+                        # We write it once we know the time zones of all the others
+                        missing.append(row)
                         continue
-                    population = int(fields[14])
-                    country_code = fields[8]
-                    geonameid, name = fields[:2]
-                    admin1_code = fields[10]
-                    admin2_code = fields[11]
-                    admin1_dic = self.countries[country_code].get(admin1_code)
-                    if admin1_dic:
-                        admin1_id = admin1_dic['geonameid']
-                        admin2_id = admin1_dic['admins2'].get(admin2_code)
-                    else:
-                        admin1_id = None
-                        admin2_id = None
-                    timezone_name = fields[17]
-                    name = name #unicode(name, 'utf-8')
-                    latitude = float(fields[4])
-                    longitude = float(fields[5])
-                    modification_date = fields[18]
-                    locality = Locality(
-                        geonameid=geonameid,
-                        name=name,
-                        country_id=country_code,
-                        admin1_id=admin1_id,
-                        admin2_id=admin2_id,
-                        latitude=latitude,
-                        longitude=longitude,
-                        point=Point(longitude, latitude),
-                        timezone_id=timezone_name,
-                        population=population,
-                        modification_date=modification_date)
-                    locality.long_name = locality.generate_long_name()
-                    objects.append(locality)
+                    for key in self.timezone_keys(row):
+                        if row.population > timezones.get(key, (-1, None))[0]:
+                            timezones[key] = (row.population, row.timezone_id)
+                    write(row)
                     processed += 1
-                    self.localities.add(geonameid)
                 except Exception as inst:
-                    traceback.print_exc(inst)
-                    raise Exception("ERROR parsing:\n {}\n The error was: {}".format(line, inst))
+                    traceback.print_exc()
+                    raise Exception("ERROR loading:\n {}\n The error was: {}".format(record, inst))
 
                 if processed % batch == 0:
-                    Locality.objects.bulk_create(objects)
                     print("{0:8d} Localities loaded".format(processed))
-                    objects = []
+                    self.recorder.progress(processed)
+
+            print('Filling missed timezones in localities')
+            for row in missing:
+                # We assign the time zone of the most populated locality in the same admin2, admin1 or country
+                for key in self.timezone_keys(row):
+                    if key in timezones:
+                        row = row._replace(timezone_id=timezones[key][1])
+                        break
+                else:
+                    print(" ERROR locality with no timezone {}".format(row.long_name))
+                    raise Exception()
+                write(row)
+                processed += 1
+
+            print("Setting as deleted duplicated localities")
+            # Keep enabled the most populated locality of each long name, the lowest geonameid on a tie
+            winners = {}
+            for row in duplicated:
+                key = (row.country_id, row.long_name)
+                population, geonameid = winners.get(key, written[key])
+                if (-row.population, row.geonameid) < (-population, geonameid):
+                    winners[key] = (row.population, row.geonameid)
+            # The written localities that lost must be disabled before their winners get in
+            writer.flush()
+            self.set_localities_status([written[key][1] for key in winners], Locality.objects.STATUS_DISABLED)
+            enabled = set(geonameid for population, geonameid in winners.values())
+            for row in duplicated:
+                if row.geonameid not in enabled:
+                    row = row._replace(status=Locality.objects.STATUS_DISABLED)
+                writer.write(row)
 
-        Locality.objects.bulk_create(objects)
+        self.recorder.add_rows(processed)
         print("{0:8d} Localities loaded".format(processed))
+        print(" {0:8d} localities set as 'STATUS_DISABLED'".format(len(duplicated)))
 
+    @staticmethod
+    def timezone_keys(row):
+        """ Keys of the levels a locality takes its missing time zone from, the closest first """
+        keys = []
+        if row.admin2_id is not None:
+            keys.append(('admin2', row.admin2_id))
+        if row.admin1_id is not None:
+            keys.append(('admin1', row.admin1_id))
+        keys.append(('country', row.country_id))
+        return keys
+
+    def fill_missing_timezones(self):
+        """
+        Same as the filling done by ``load_localities`` but with one UPDATE per level for the localities in the
+        data base. Note MySQL does not allow the subquery on the updated table.
+        """
         print('Filling missed timezones in localities')
-        # Try to find the missing timezones
-        for locality in Locality.objects.filter(timezone__isnull=True):
-            # We assign the time zone of the most populated locality in the same admin2
-            near_localities = Locality.objects.filter(admin2=locality.admin2)
-            near_localities = near_localities.exclude(timezone__isnull=True)
-            if not near_localities.exists():
-                # We assign the time zone of the most populated locality in the same admin1
-                near_localities = Locality.objects.filter(admin1=locality.admin1)
-                near_localities = near_localities.exclude(timezone__isnull=True)
-
-            if not near_localities.exists():
-                # We assign the time zone of the most populated locality in the same country
-                near_localities = Locality.objects.filter(country=locality.country)
-                near_localities = near_localities.exclude(timezone__isnull=True)
-
-            if near_localities.exists():
-                near_localities = near_localities.order_by('-population')
-                locality.timezone = near_localities[0].timezone
-                locality.save()
-            else:
-                print(" ERROR locality with no timezone {}".format(locality))
-                raise Exception()
+        # We assign the time zone of the most populated locality in the same admin2, then admin1, then country
+        for level in ('admin2', 'admin1', 'country'):
+            near_localities = Locality.objects.filter(**{level: OuterRef(level)})
+            near_localities = near_localities.exclude(timezone__isnull=True).order_by('-population')
+            Locality.objects.filter(timezone__isnull=True, **{level + '__isnull': False}).update(
+                timezone=Subquery(near_localities.values('timezone')[:1]))
+
+        missing = Locality.objects.filter(timezone__isnull=True).values_list('long_name', flat=True)
+        if missing.exists():
+            print(" ERROR localities with no timezone {}".format(', '.join(missing[:10])))
+            raise Exception()
 
     def cleanup(self):
         self.delete_empty_countries()
@@ -366,68 +726,78 @@ class Command(BaseCommand):
     def delete_empty_countries(self):
         print('Setting as deleted empty Countries')
         # Countries
-        countries = Country.objects.annotate(Count("locality_set")).filter(locality_set__count=0)
-        for c in countries:
-            c.status = Country.objects.STATUS_DISABLED
-            c.save()
-
-        print(" {0:8d} Countries set status 'STATUS_DISABLED'".format(countries.count()))
+        disabled = Country.objects.filter(locality_set__isnull=True).update(status=Country.objects.STATUS_DISABLED)
+        print(" {0:8d} Countries set status 'STATUS_DISABLED'".format(disabled))
 
     def delete_duplicated_localities(self):
+        """
+        Disables all but the most populated of the enabled localities sharing a long name in a country. The full
+        load already does it while loading, this catches what the data base got otherwise.
+        """
         print("Setting as deleted duplicated localities")
-        total = 0
-        for c in Country.objects.all():
-            prev_name = ""
-            for loc in c.locality_set.order_by("long_name", "-population"):
-                if loc.long_name == prev_name:
-                    loc.status = Locality.objects.STATUS_DISABLED
-                    loc.save(check_duplicated_longname=False)
-                    total += 1
-
-                prev_name = loc.long_name
+        losers = []
+        prev_key = None
+        for geonameid, country_code, long_name in Locality.objects.public().order_by(
+                'country', 'long_name', '-population', 'geonameid').values_list(
+                'geonameid', 'country_id', 'long_name').iterator():
+            key = (country_code, long_name)
+            if key == prev_key:
+                losers.append(geonameid)
+            prev_key = key
 
+        total = self.set_localities_status(losers, Locality.objects.STATUS_DISABLED)
         print(" {0:8d} localities set as 'STATUS_DISABLED'".format(total))
 
     def load_altnames(self):
         print('Loading alternate names')
-        objects = []
-        allobjects = {}
-        batch = 10000
+        batch = self.batch
         processed = 0
         os.chdir(self.temp_dir_path)
-        with open('alternateNames.txt', 'r', encoding="utf8") as fd:
-            for line in fd:
-                try:
-                    fields = [field.strip() for field in line.split('\t')]
-                    alternatenameid = fields[0]
-                    locality_geonameid = fields[1]
-                    if locality_geonameid not in self.localities:
-                        continue
-
-                    name = fields[3]
-                    if locality_geonameid in allobjects:
-                        if name in allobjects[locality_geonameid]:
-                            continue
-                    else:
-                        allobjects[locality_geonameid] = set()
+        if self.low_memory:
+            # The duplicates older than the window are discarded by the data base unique constraint
+            names = RecentNames(self.altnames_window)
+        else:
+            names = RecentNames()
+        # Records of the file loaded before the interruption
+        skip = 0
+        if self.checkpoints is not None:
+            skip = self.checkpoints.position('load_altnames', 'alternateNames.zip')
+            if skip:
+                print(' Resuming after {} records'.format(skip))
+            if skip and not self.low_memory:
+                # The names loaded, also the ones after the checkpoint, are the duplicates to skip
+                for locality_id, name in AlternateName.objects.values_list('locality_id', 'name').iterator():
+                    names.seen(locality_id, name)
 
-                    allobjects[locality_geonameid].add(name)
-                    objects.append(AlternateName(
-                        alternatenameid = alternatenameid,
+        with self.get_writer(AlternateName, AlternateNameRow._fields, ignore_conflicts=self.low_memory) as writer:
+            records = parse_file('alternateNames.zip', AlternateNameParser(self.localities), workers=self.workers)
+            for position, record in enumerate(records, 1):
+                if position <= skip:
+                    continue
+                alternatenameid, locality_geonameid, name = record
+                if not names.seen(locality_geonameid, name):
+                    writer.write(AlternateNameRow(
+                        status=AlternateName.objects.STATUS_ENABLED,
+                        alternatenameid=alternatenameid,
                         locality_id=locality_geonameid,
-                        name=name))
+                        name=name,
+                        search_name=normalize_name(name)))
                     processed += 1
-                except Exception as inst:
-                    traceback.print_exc(inst)
-                    raise Exception("ERROR parsing:\n {}\n The error was: {}".format(line, inst))
 
-                if processed % batch == 0:
-                    AlternateName.objects.bulk_create(objects)
-                    print("{0:8d} AlternateNames loaded".format(processed))
-                    objects = []
+                    if processed % batch == 0:
+                        print("{0:8d} AlternateNames loaded".format(processed))
+                        self.recorder.progress(processed)
 
-        AlternateName.objects.bulk_create(objects)
-        print("{0:8d} AlternateNames loaded".format(processed))
+                if self.checkpoints is not None and position % batch == 0:
+                    with transaction.atomic():
+                        writer.flush()
+                        self.checkpoints.advance('load_altnames', position)
+
+        self.recorder.add_rows(processed)
+        if self.low_memory:
+            print("{0:8d} AlternateNames loaded".format(AlternateName.objects.count()))
+        else:
+            print("{0:8d} AlternateNames loaded".format(processed))
 
     def check_errors(self):
         print('Checking errors')
@@ -450,4 +820,205 @@ class Command(BaseCommand):
                 print(duplicated)
                 raise Exception()
 
+    def load_reference_maps(self):
+        """ Fills ``self.countries`` from the data base as the load does from the admin codes files """
+        print('Loading admin codes from the data base')
+        self.country_names = dict(Country.objects.values_list('code', 'name'))
+        self.countries = dict((code, {}) for code in self.country_names)
+        admin1_codes = {}
+        for geonameid, code, name, country_code in Admin1Code.objects.values_list(
+                'geonameid', 'code', 'name', 'country_id'):
+            self.countries[country_code][code] = {'geonameid': geonameid, 'admins2': {}}
+            self.admin_names[geonameid] = name
+            admin1_codes[geonameid] = code
+
+        for geonameid, code, name, country_code, admin1_id in Admin2Code.objects.filter(
+                admin1__isnull=False).values_list('geonameid', 'code', 'name', 'country_id', 'admin1_id'):
+            self.countries[country_code][admin1_codes[admin1_id]]['admins2'][code] = geonameid
+            self.admin_names[geonameid] = name
+
+    def download_update_files(self, days):
+        """ Downloads the daily files of ``days``, returns False if any of them is not available """
+        urls = [UPDATE_FILES_URL.format(kind, day) for day in days for kind in UPDATE_FILES]
+        if self.data_dir is not None:
+            return all(os.path.exists(os.path.join(self.data_dir, url.rsplit('/', 1)[1])) for url in urls)
+        print('Downloading daily files')
+        try:
+            download_all(urls, self.temp_dir_path, workers=self.download_workers)
+        except DownloadError as error:
+            print(error)
+            if error.status == 404:
+                return False
+            sys.exit(1)
+        return True
+
+    def upsert_localities(self, rows):
+        """
+        Inserts or updates the localities of ``rows`` and returns their geonameids. They are all saved as
+        disabled, ``update_duplicated_localities`` enables the right ones afterwards.
+        """
+        localities = [build_instance(Locality, LocalityRow._fields,
+                                     row._replace(status=Locality.objects.STATUS_DISABLED)) for row in rows]
+        existing = set(Locality.objects.filter(geonameid__in=[l.geonameid for l in localities]).values_list(
+            'geonameid', flat=True))
+        Locality.objects.bulk_create([l for l in localities if l.geonameid not in existing])
+        Locality.objects.bulk_update([l for l in localities if l.geonameid in existing],
+                                     ['status', 'name', 'search_name', 'long_name', 'display_name', 'country', 'admin1',
+                                      'admin2', 'timezone', 'population', 'latitude', 'longitude', 'point',
+                                      'modification_date'])
+        return set(l.geonameid for l in localities)
+
+    def set_localities_status(self, geonameids, status):
+        updated = 0
+        for ids in chunks(geonameids, self.batch):
+            updated += Locality.objects.filter(geonameid__in=ids).exclude(status=status).update(status=status)
+        return updated
+
+    def update_localities(self, day):
+        print('Updating Localities modified on {}'.format(day))
+        touched = set()
+        gone = set()
+        objects = []
+        os.chdir(self.temp_dir_path)
+        for record in parse_file('modifications-{}.txt'.format(day), GeonameParser()):
+            if (record.type not in city_types or record.country_code not in self.countries or
+                    (record.type == 'PPL' and record.population < self.min_population)):
+                # It could have been one of our localities before the change
+                gone.add(record.geonameid)
+                continue
+            objects.append(self.locality_row(record))
+
+            if len(objects) == self.batch:
+                touched |= self.upsert_localities(objects)
+                objects = []
+
+        if objects:
+            touched |= self.upsert_localities(objects)
+
+        with open('deletes-{}.txt'.format(day), 'r', encoding="utf8") as fd:
+            for line in fd:
+                gone.add(int(line.split('\t')[0]))
+
+        touched -= gone
+        disabled = self.set_localities_status(gone, Locality.objects.STATUS_DISABLED)
+        self.recorder.add_rows(len(touched))
+        print("{0:8d} Localities updated".format(len(touched)))
+        print("{0:8d} Localities set status 'STATUS_DISABLED'".format(disabled))
+        return touched
+
+    def update_localities_from_dump(self):
+        """ Updates the localities whose modification date in the dump is newer than the stored one """
+        print('Updating Localities from the dump')
+        stored = dict(Locality.objects.values_list('geonameid', 'modification_date'))
+        seen = set()
+        touched = set()
+        objects = []
+        os.chdir(self.temp_dir_path)
+        for record in self.parse_localities():
+            if record.country_code not in self.countries:
+                continue
+            seen.add(record.geonameid)
+            if record.geonameid in stored and stored[record.geonameid].isoformat() >= record.modification_date:
+                continue
+            objects.append(self.locality_row(record))
+
+            if len(objects) == self.batch:
+                touched |= self.upsert_localities(objects)
+                objects = []
+
+        if objects:
+            touched |= self.upsert_localities(objects)
+
+        gone = set(Locality.objects.public().values_list('geonameid', flat=True)) - seen
+        disabled = self.set_localities_status(gone, Locality.objects.STATUS_DISABLED)
+        self.recorder.add_rows(len(touched))
+        print("{0:8d} Localities updated".format(len(touched)))
+        print("{0:8d} Localities set status 'STATUS_DISABLED'".format(disabled))
+        return touched
+
+    def update_duplicated_localities(self, geonameids):
+        """
+        For every long name of the ``geonameids`` localities enables the most populated locality among them and
+        the already enabled ones, and disables the rest. Localities disabled by a previous run stay disabled.
+        """
+        print('Setting as deleted duplicated updated localities')
+        keys = set()
+        for ids in chunks(geonameids, self.batch):
+            keys.update(Locality.objects.filter(geonameid__in=ids).values_list('country_id', 'long_name'))
+
+        winners = set()
+        losers = set()
+        for names in chunks(set(key[1] for key in keys), 500):
+            prev_key = None
+            for geonameid, country_code, long_name, status in Locality.objects.filter(
+                    long_name__in=names).order_by('country', 'long_name', '-population', 'geonameid').values_list(
+                    'geonameid', 'country_id', 'long_name', 'status'):
+                key = (country_code, long_name)
+                if key not in keys or (geonameid not in geonameids and status < Locality.objects.STATUS_ENABLED):
+                    continue
+                if key == prev_key:
+                    losers.add(geonameid)
+                else:
+                    winners.add(geonameid)
+                prev_key = key
+
+        # Disable first so there are never two enabled localities with the same long name
+        disabled = self.set_localities_status(losers, Locality.objects.STATUS_DISABLED)
+        self.set_localities_status(winners, Locality.objects.STATUS_ENABLED)
+        print(" {0:8d} localities set as 'STATUS_DISABLED'".format(disabled))
+
+    def update_altnames(self, day):
+        print('Updating alternate names modified on {}'.format(day))
+        rows = {}
+        os.chdir(self.temp_dir_path)
+        with open('alternateNamesModifications-{}.txt'.format(day), 'r', encoding="utf8") as fd:
+            for line in fd:
+                fields = [field.strip() for field in line.split('\t')]
+                rows[int(fields[0])] = (int(fields[1]), fields[3])
+
+        deleted = set()
+        with open('alternateNamesDeletes-{}.txt'.format(day), 'r', encoding="utf8") as fd:
+            for line in fd:
+                deleted.add(int(line.split('\t')[0]))
+
+        processed = 0
+        for ids in chunks(set(rows) | deleted, self.batch):
+            AlternateName.objects.filter(alternatenameid__in=ids).delete()
+            ids = [i for i in ids if i in rows and i not in deleted]
+            localities = set(Locality.objects.filter(geonameid__in=set(rows[i][0] for i in ids)).values_list(
+                'geonameid', flat=True))
+            # The same name of a locality can only be stored once
+            existing = set(AlternateName.objects.filter(
+                locality_id__in=localities, name__in=set(rows[i][1] for i in ids)).values_list('locality_id', 'name'))
+            objects = []
+            for i in ids:
+                if rows[i][0] in localities and rows[i] not in existing:
+                    existing.add(rows[i])
+                    objects.append(AlternateName(alternatenameid=i, locality_id=rows[i][0], name=rows[i][1],
+                                                 search_name=normalize_name(rows[i][1])))
+            AlternateName.objects.bulk_create(objects)
+            processed += len(objects)
+
+        self.recorder.add_rows(processed)
+        print("{0:8d} AlternateNames updated".format(processed))
+
+    @transaction.atomic
+    def rebuild_names(self):
+        """ Fills the name columns computed by the loader in the stored rows, without downloading anything """
+        run = self.recorder.run
+        run(self.rebuild_locality_names)
+        run(self.rebuild_alternate_names)
+        # The names were changed with bulk updates, which send no signals
+        invalidate_all()
+
+    def rebuild_locality_names(self):
+        print('Rebuilding Locality names')
+        changed = Locality.objects.update_long_names(batch=self.batch)
+        self.recorder.add_rows(changed)
+        print("{0:8d} Localities updated".format(changed))
 
+    def rebuild_alternate_names(self):
+        print('Rebuilding AlternateName search names')
+        changed = AlternateName.objects.update_search_names(batch=self.batch)
+        self.recorder.add_rows(changed)
+        print("{0:8d} AlternateNames updated".format(changed))
@@ -1,12 +1,31 @@
 from django.conf import settings
 # from django.contrib.gis.db import models
-from django.db.models import Manager as GeoManager
+from django.db.models import Manager as GeoManager, QuerySet
 
-class BaseManager(GeoManager):
+
+class BaseQuerySet(QuerySet):
+    """
+    Chainable filters of every geonames model, also available on their managers:
+
+    ``Locality.objects.public().filter(...).active()``
+    """
+    def public(self):
+        """ Returns all entries someway accessible through front end site"""
+        return self.filter(**BaseManager.QUERYSET_PUBLIC_KWARGS)
+    def active(self):
+        """ Returns all entries that are considered active, i.e. aviable in forms, selections, choices, etc """
+        return self.filter(**BaseManager.QUERYSET_ACTIVE_KWARGS)
+    def for_display(self):
+        """ Loads in the same query the related instances the string representation of the model uses """
+        return self.select_related(*getattr(self.model, 'display_related', ()))
+
+
+class BaseManager(GeoManager.from_queryset(BaseQuerySet)):
     """
     Additional methods / constants to Base's objects manager - using a GeoManager is fine even for plain models:
 
     ``BaseManager.objects.public()`` - all instances that are asccessible through front end
+    ``BaseManager.objects.for_display()`` - all instances, ready to be rendered without more queries
     """
     # Model (db table) wide constants - we put these and not in model definition to avoid circular imports.
     # one can access these constants through <foo>.objects.STATUS_DISABLED or ImageManager.STATUS_DISABLED
@@ -19,30 +38,418 @@ class BaseManager(GeoManager):
         (STATUS_ARCHIVED, "Archived"),
     )
     # We keep status field and custom queries naming a little different as it is not one-to-one mapping in all situations
-    QUERYSET_PUBLIC_KWARGS = {'status__gte': STATUS_ENABLED} # Because you can't yet chain custom manager filters ex.
-                                                             #'public().open()' we provide access this way.
-                                                             # workaround - http://stackoverflow.com/questions/2163151/custom-queryset-and-manager-without-breaking-dry
+    QUERYSET_PUBLIC_KWARGS = {'status__gte': STATUS_ENABLED} # Used by BaseQuerySet.public(), also handy in
+                                                             # filters across relations
     QUERYSET_ACTIVE_KWARGS = {'status': STATUS_ENABLED}
 
-    def public(self):
-        """ Returns all entries someway accessible through front end site"""
-        return self.filter(**self.QUERYSET_PUBLIC_KWARGS)
-    def active(self):
-        """ Returns all entries that are considered active, i.e. aviable in forms, selections, choices, etc """
-        return self.filter(**self.QUERYSET_ACTIVE_KWARGS)
-
 from decimal import Decimal
 from django.contrib.gis.db import models
 from django.contrib.gis.measure import D
-from django.db.models import Q
-from math import degrees, radians, cos, sin, acos, pi, fabs
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import Count, F, Q, Value
+from math import degrees, radians, cos, fabs
+from django.contrib.gis.db.models.functions import GeometryDistance
 from django.contrib.gis.geos import Point
+from geonames.local_index import cached_table, invalidate_tables
+from geonames.distance import EARTH_RADIUS_MI, haversine, within_radius
+# Defined here before geonames.distance, still importable from geonames.models
+from geonames.distance import KM_TO_MI, DEGREES_TO_RADIANS  # noqa: F401
+from geonames.search import get_index as get_autocomplete_index, get_trigram_index, normalize_name, rank_similarities
+from geonames.spatial_index import get_index
+
+# Store Locality.point as a PostGIS geography so distance filters can use the spatial index through ST_DWithin
+POINT_GEOGRAPHY = getattr(settings, 'GEONAMES_POINT_GEOGRAPHY', False)
+# Index the search names with pg_trgm for Locality.objects.fuzzy_search, needs the PostgreSQL pg_trgm extension
+TRIGRAM_INDEX = getattr(settings, 'GEONAMES_TRIGRAM_INDEX', False)
+
+
+def trigram_indexes(name):
+    """ The pg_trgm index of the search names, if enabled """
+    if not TRIGRAM_INDEX:
+        return []
+    from django.contrib.postgres.indexes import GinIndex
+    return [GinIndex(fields=['search_name'], opclasses=['gin_trgm_ops'], name=name)]
+
+
+def build_long_name(name, admin1_name=None, admin2_name=None):
+    """ Long name of a locality from its name and the names of its admin levels """
+    long_name = u"{}".format(name)
+    if admin2_name is not None:
+        long_name = u"{}, {}".format(long_name, admin2_name)
+
+    if admin1_name is not None:
+        long_name = u"{}, {}".format(long_name, admin1_name)
+
+    return long_name
+
+
+def build_display_name(long_name, country_name):
+    """ Display name of a locality from its long name and the name of its country """
+    return u"{}, {}".format(long_name, country_name)
+
+
+def cached_related(instance, field):
+    """ The ``field`` related instance of ``instance``, from the reference cache unless already loaded """
+    descriptor = getattr(type(instance), field)
+    if descriptor.is_cached(instance):
+        return getattr(instance, field)
+    pk = getattr(instance, field + '_id')
+    if pk is None:
+        return None
+    return descriptor.field.related_model.objects.cached_get(pk)
+
+
+def related_values(instance, field, names, using=None):
+    """
+    The ``names`` values of the ``field`` related instance of ``instance``, read from the data base unless already
+    loaded. For the writes, which can not trust a cache another process may have left outdated
+    """
+    descriptor = getattr(type(instance), field)
+    if descriptor.is_cached(instance):
+        related = getattr(instance, field)
+        return related and tuple(getattr(related, name) for name in names)
+    pk = getattr(instance, field + '_id')
+    if pk is None:
+        return None
+    model = descriptor.field.related_model
+    return model._base_manager.db_manager(using).filter(pk=pk).values_list(*names).first()
+
+
+class ReferenceManager(BaseManager):
+    """
+    Additional methods to the managers of the small reference tables, whose instances are cached by each process
+    until one of them is saved or deleted or geonames is updated, see ``geonames.local_index``. The cached
+    instances are shared, do not modify them. The instances missing from the cache, created by another process or
+    without signals, are read from the data base, and the cache is built again:
+
+    ``Country.objects.cached_all()`` - all the instances by primary key
+    ``Country.objects.cached_get(pk)`` - the instance with primary key ``pk``
+    """
+    def cached_all(self):
+        model = self.model
+        return cached_table(model._meta.label, lambda: dict((obj.pk, obj) for obj in model._base_manager.all()),
+                            [model])
+
+    def cached_get(self, pk):
+        try:
+            return self.cached_all()[pk]
+        except KeyError:
+            return self.get_missing(pk=pk)
+
+    def get_missing(self, **kwargs):
+        """ The instance matching ``kwargs`` the cache misses, from the data base """
+        instance = self.model._base_manager.get(**kwargs)
+        invalidate_tables(self.model._meta.label)
+        return instance
+
+
+class Admin1CodeManager(ReferenceManager):
+    """
+    Additional methods to Admin1Code's objects manager:
+
+    ``Admin1Code.objects.cached_by_country_code(country_code, code)`` - the cached Admin1Code with that code
+    """
+    def cached_by_country_code(self, country_code, code):
+        codes = cached_table(self.model._meta.label + '.codes', lambda: dict(
+            ((admin1.country_id, admin1.code), admin1) for admin1 in self.cached_all().values()), [self.model])
+        try:
+            return codes[(country_code, code)]
+        except KeyError:
+            return self.get_missing(country_id=country_code, code=code)
+
+
+class Admin2CodeManager(ReferenceManager):
+    """
+    Additional methods to Admin2Code's objects manager:
+
+    ``Admin2Code.objects.cached_by_country_code(country_code, admin1_code, code)`` - the cached Admin2Code with
+    that code
+    """
+    def cached_by_country_code(self, country_code, admin1_code, code):
+        def build():
+            admins1 = Admin1Code.objects.cached_all()
+            return dict(((admin2.country_id, admins1[admin2.admin1_id].code if admin2.admin1_id else None,
+                          admin2.code), admin2) for admin2 in self.cached_all().values())
+        codes = cached_table(self.model._meta.label + '.codes', build, [self.model, Admin1Code])
+        try:
+            return codes[(country_code, admin1_code, code)]
+        except KeyError:
+            if admin1_code is None:
+                return self.get_missing(country_id=country_code, admin1__isnull=True, code=code)
+            return self.get_missing(country_id=country_code, admin1__code=admin1_code, code=code)
+
+
+class AlternateNameManager(BaseManager):
+    """
+    Additional methods to AlternateName's objects manager:
+
+    ``AlternateName.objects.update_search_names(**filters)`` - fills the search names, after upgrading
+    """
+    def update_search_names(self, batch=1000, **filters):
+        """ Recomputes the search names of the alternate names matching ``filters`` with batched updates """
+        changed = []
+        for alternatenameid, name, search_name in self.filter(**filters).order_by().values_list(
+                'alternatenameid', 'name', 'search_name').iterator():
+            new_search_name = normalize_name(name)
+            if new_search_name != search_name:
+                changed.append(self.model(alternatenameid=alternatenameid, search_name=new_search_name))
+        self.bulk_update(changed, ['search_name'], batch_size=batch)
+        return len(changed)
+
+
+class LocalityManager(BaseManager):
+    """
+    Additional methods to Locality's objects manager:
+
+    ``Locality.objects.update_long_names(**filters)`` - recomputes the long and search names after renaming admin
+    levels or upgrading
+    ``Locality.objects.validate_many(localities)`` - checks many localities before saving them
+    ``Locality.objects.within_radius(latitude, longitude, miles)`` - public localities around a point
+    ``Locality.objects.nearest(latitude, longitude, k)`` - public localities closest to a point
+    ``Locality.objects.reverse_geocode(latitude, longitude)`` - closest public localities with their admin levels
+    ``Locality.objects.reverse_geocode_many(points)`` - closest public locality of each point
+    ``Locality.objects.autocomplete(prefix)`` - most populated public localities named starting with a prefix
+    ``Locality.objects.fuzzy_search(name)`` - public localities with the most similar names
+    ``Locality.objects.resolve_many(names)`` - ``Country.search_locality`` for many names at once
+    """
+    def update_long_names(self, batch=1000, **filters):
+        """
+        Recomputes the long, display and search names of the localities matching ``filters`` with batched updates,
+        which also fills them in the rows stored before those columns existed. Raises ``ValueError`` if that makes two
+        enabled localities of a country share a long name.
+        """
+        changed = []
+        for geonameid, name, long_name, display_name, search_name, admin1_name, admin2_name, country_name in \
+                self.filter(**filters).order_by().values_list(
+                    'geonameid', 'name', 'long_name', 'display_name', 'search_name', 'admin1__name', 'admin2__name',
+                    'country__name').iterator():
+            new_long_name = build_long_name(name, admin1_name, admin2_name)
+            new_display_name = build_display_name(new_long_name, country_name)
+            new_search_name = normalize_name(name)
+            if new_long_name != long_name or new_display_name != display_name or new_search_name != search_name:
+                changed.append(self.model(geonameid=geonameid, long_name=new_long_name,
+                                          display_name=new_display_name, search_name=new_search_name))
+
+        try:
+            with transaction.atomic(using=self.db):
+                self.bulk_update(changed, ['long_name', 'display_name', 'search_name'], batch_size=batch)
+                # The unique constraint already catches them where partial indexes are supported
+                long_names = sorted(set(locality.long_name for locality in changed))
+                for i in range(0, len(long_names), batch):
+                    duplicated = self.public().filter(long_name__in=long_names[i:i + batch]).values(
+                        'country', 'long_name').annotate(total=Count('pk')).filter(total__gt=1)
+                    for locality in duplicated[:1]:
+                        raise ValueError("Duplicated locality long name '{}'".format(locality['long_name']))
+        except IntegrityError:
+            raise ValueError("Duplicated locality long name after updating the long names of {}".format(filters))
+
+        return len(changed)
+
+    def within_radius(self, latitude, longitude, miles, min_population=None):
+        """
+        geonameids of the public localities within ``miles`` of the point and their distances, sorted by distance,
+        from the in-process spatial index
+        """
+        return get_index().within_radius(float(latitude), float(longitude), miles, min_population)
 
+    def nearest(self, latitude, longitude, k=1, min_population=None):
+        """
+        geonameids of the ``k`` public localities closest to the point and their distances, sorted by distance,
+        from the in-process spatial index
+        """
+        return get_index().nearest(float(latitude), float(longitude), k, min_population)
 
-# Some constants for the geo maths
-EARTH_RADIUS_MI = 3959.0
-KM_TO_MI = 0.621371192
-DEGREES_TO_RADIANS = pi / 180.0
+    def reverse_geocode(self, latitude, longitude, k=1, min_population=None):
+        """
+        The ``k`` public localities closest to the point, nearest first, with their admin levels, country and timezone
+        in the same query. Uses the KNN ordering of the point index on PostGIS and the in-process spatial index on
+        other data bases.
+        """
+        localities = self.public().select_related('admin1', 'admin2', 'country', 'timezone')
+        if getattr(connections[self.db].ops, 'postgis', False):
+            if min_population is not None:
+                localities = localities.filter(population__gte=min_population)
+            point = Point(float(longitude), float(latitude), srid=4326)
+            return list(localities.order_by(GeometryDistance('point', point))[:k])
+
+        geonameids = self.nearest(latitude, longitude, k, min_population)[0]
+        found = localities.in_bulk(geonameids)
+        return [found[geonameid] for geonameid in geonameids if geonameid in found]
+
+    def reverse_geocode_many(self, points, min_population=None, batch=1000):
+        """
+        The closest public locality of each ``(latitude, longitude)`` of ``points``, or None when there is none, in
+        the same order. The neighbours come from the in-process spatial index and the localities are fetched with
+        one query per ``batch`` points.
+        """
+        index = get_index()
+        points = list(points)
+        result = []
+        for i in range(0, len(points), batch):
+            nearest = []
+            for latitude, longitude in points[i:i + batch]:
+                geonameids = index.nearest(float(latitude), float(longitude), 1, min_population)[0]
+                nearest.append(geonameids[0] if geonameids else None)
+            found = self.public().select_related('admin1', 'admin2', 'country', 'timezone').in_bulk(
+                set(geonameid for geonameid in nearest if geonameid is not None))
+            result.extend(found.get(geonameid) for geonameid in nearest)
+        return result
+
+    def autocomplete(self, prefix, limit=10, country=None, admin1=None):
+        """
+        The ``limit`` most populated public localities, of ``country`` and ``admin1`` if given, with a name or an
+        alternate name starting with ``prefix`` regardless of case and accents. Uses the in-process prefix index, or
+        LIKE queries on the indexed search names when the ``GEONAMES_AUTOCOMPLETE_INDEX`` setting is False.
+        """
+        country_id = getattr(country, 'pk', country)
+        admin1_id = getattr(admin1, 'pk', admin1)
+        localities = self.public().select_related('admin1', 'admin2', 'country')
+        if getattr(settings, 'GEONAMES_AUTOCOMPLETE_INDEX', True):
+            geonameids = get_autocomplete_index().search(prefix, limit, country_id, admin1_id)
+            found = localities.in_bulk(geonameids)
+            return [found[geonameid] for geonameid in geonameids if geonameid in found]
+
+        search_name = normalize_name(prefix)
+        if not search_name:
+            return []
+        alternates = AlternateName.objects.public().filter(search_name__startswith=search_name).values('locality_id')
+        localities = localities.filter(Q(search_name__startswith=search_name) | Q(pk__in=alternates))
+        if country_id is not None:
+            localities = localities.filter(country_id=country_id)
+        if admin1_id is not None:
+            localities = localities.filter(admin1_id=admin1_id)
+        return list(localities.order_by('-population', 'geonameid')[:limit])
+
+    def fuzzy_search(self, name, limit=10, country=None, threshold=0.3, population_weight=0):
+        """
+        The ``limit`` public localities, of ``country`` if given, whose name or alternate name is the most similar to
+        ``name`` by trigrams, with that similarity as their ``similarity`` attribute. The similarity, from 0 to 1,
+        must reach ``threshold`` and is weighted by population with ``population_weight``, see
+        ``geonames.search.rank_similarities``. Uses the pg_trgm indexes when the ``GEONAMES_TRIGRAM_INDEX`` setting
+        is True on PostgreSQL, and the in-process trigram index otherwise.
+        """
+        country_id = getattr(country, 'pk', country)
+        if TRIGRAM_INDEX and connections[self.db].vendor == 'postgresql':
+            similarities, populations = self.trigram_similarities(name, country_id, threshold, limit)
+            ranked = rank_similarities(similarities, populations, limit, population_weight)
+        else:
+            ranked = get_trigram_index().search(name, limit, country_id, threshold, population_weight)
+
+        found = self.public().select_related('admin1', 'admin2', 'country').in_bulk(
+            [geonameid for geonameid, similarity in ranked])
+        localities = []
+        for geonameid, similarity in ranked:
+            if geonameid in found:
+                found[geonameid].similarity = similarity
+                localities.append(found[geonameid])
+        return localities
+
+    def trigram_similarities(self, name, country_id=None, threshold=0.3, limit=10):
+        """
+        Best pg_trgm similarity to ``name`` and population of the public localities most similar to it. The ``%``
+        operator uses the GIN indexes, so thresholds under ``pg_trgm.similarity_threshold`` (0.3) do not add more.
+        """
+        from django.contrib.postgres.lookups import TrigramSimilar
+        from django.contrib.postgres.search import TrigramSimilarity
+        search_name = normalize_name(name)
+        # Weighting by population can promote less similar localities
+        candidates = limit * 10
+        localities = self.public()
+        alternates = AlternateName.objects.public().filter(locality__status__gte=self.STATUS_ENABLED)
+        if country_id is not None:
+            localities = localities.filter(country_id=country_id)
+            alternates = alternates.filter(locality__country_id=country_id)
+
+        similarities = {}
+        populations = {}
+        for queryset, fields in ((localities, ('geonameid', 'population')),
+                                 (alternates, ('locality_id', 'locality__population'))):
+            queryset = queryset.filter(TrigramSimilar(F('search_name'), Value(search_name)))
+            queryset = queryset.annotate(similarity=TrigramSimilarity('search_name', search_name))
+            queryset = queryset.filter(similarity__gte=threshold).order_by('-similarity')
+            for geonameid, population, similarity in queryset.values_list(*fields + ('similarity',))[:candidates]:
+                populations[geonameid] = population
+                similarities[geonameid] = max(similarity, similarities.get(geonameid, 0))
+        return similarities, populations
+
+    def resolve_many(self, names, batch=1000):
+        """
+        The localities named or alternatively named like each ``(country code, name)`` of ``names``, as returned
+        by ``Country.search_locality``: a dict from each pair to its list of localities, most populated first.
+        Issues three queries per ``batch`` distinct names.
+        """
+        keys = {}
+        for country_code, name in names:
+            if len(name) > 0:
+                keys.setdefault((country_code, normalize_name(name)), []).append((country_code, name))
+
+        resolved = dict((pair, []) for pairs in keys.values() for pair in pairs)
+        keys = sorted(keys.items())
+        for i in range(0, len(keys), batch):
+            chunk = dict(keys[i:i + batch])
+            countries = set(key[0] for key in chunk)
+            search_names = set(key[1] for key in chunk)
+            candidates = {}
+            for geonameid, country_code, search_name in self.filter(
+                    country_id__in=countries, search_name__in=search_names).values_list(
+                    'geonameid', 'country_id', 'search_name'):
+                candidates.setdefault((country_code, search_name), set()).add(geonameid)
+            for geonameid, country_code, search_name in AlternateName.objects.filter(
+                    locality__country_id__in=countries, search_name__in=search_names).values_list(
+                    'locality_id', 'locality__country_id', 'search_name'):
+                candidates.setdefault((country_code, search_name), set()).add(geonameid)
+
+            # The country and name combinations that were not asked for are left out
+            candidates = dict((key, geonameids) for key, geonameids in candidates.items() if key in chunk)
+            found = self.select_related('admin1', 'admin2', 'country').in_bulk(
+                set(geonameid for geonameids in candidates.values() for geonameid in geonameids))
+            for key, geonameids in candidates.items():
+                localities = sorted((found[geonameid] for geonameid in geonameids),
+                                    key=lambda locality: (-locality.population, locality.geonameid))
+                for pair in chunk[key]:
+                    resolved[pair] = localities
+        return resolved
+
+    def validate_many(self, localities, batch=1000):
+        """
+        Checks many localities at once with a few queries: the country of their admin levels and the long names
+        they share among them or with the enabled localities in the data base. Sets their long names and returns
+        the ``(locality, error message)`` of the ones that would fail to save.
+        """
+        admins = {}
+        for model, field in ((Admin1Code, 'admin1_id'), (Admin2Code, 'admin2_id')):
+            ids = sorted(set(getattr(locality, field) for locality in localities) - set([None]))
+            for i in range(0, len(ids), batch):
+                for geonameid, name, country_code in model.objects.filter(pk__in=ids[i:i + batch]).values_list(
+                        'geonameid', 'name', 'country_id'):
+                    admins[(field, geonameid)] = (name, country_code)
+
+        errors = []
+        long_names = {}
+        for locality in localities:
+            admin1 = admins.get(('admin1_id', locality.admin1_id))
+            admin2 = admins.get(('admin2_id', locality.admin2_id))
+            locality.long_name = build_long_name(locality.name, admin1 and admin1[0], admin2 and admin2[0])
+            for level, admin in (('Admin1', admin1), ('Admin2', admin2)):
+                if admin is not None and admin[1] != locality.country_id:
+                    errors.append((locality, "The country '{}' from the {} '{}' is different than the country '{}' from the locality '{}'".format(
+                                  admin[1], level, admin[0], locality.country_id, locality.long_name)))
+            if locality.status >= self.STATUS_ENABLED:
+                long_names.setdefault((locality.country_id, locality.long_name), []).append(locality)
+
+        duplicated = set(key for key, same in long_names.items() if len(same) > 1)
+        names = sorted(set(key[1] for key in long_names))
+        for i in range(0, len(names), batch):
+            for geonameid, country_code, long_name in self.public().filter(long_name__in=names[i:i + batch]).values_list(
+                    'geonameid', 'country_id', 'long_name'):
+                key = (country_code, long_name)
+                if key in long_names and any(locality.pk != geonameid for locality in long_names[key]):
+                    duplicated.add(key)
+
+        for key in sorted(duplicated):
+            for locality in long_names[key]:
+                errors.append((locality, "Duplicated locality long name '{}'".format(locality.long_name)))
+        return errors
 
 
 class GeonamesUpdate(models.Model):
@@ -52,6 +459,20 @@ class GeonamesUpdate(models.Model):
     update_date = models.DateField(auto_now_add=True)
 
 
+class GeonamesCheckpoint(models.Model):
+    """
+    Progress of a full load, to resume it once interrupted: a row per phase, see ``loadgeonames --resume``
+    """
+    phase = models.CharField(max_length=100, unique=True)
+    completed = models.BooleanField(default=False)
+    # The file read by a phase committing batch by batch, and how many of its records are loaded
+    checksum = models.CharField(max_length=64, blank=True, default='')
+    offset = models.BigIntegerField(default=0)
+    # JSON of what the phase leaves to the next ones
+    state = models.TextField(blank=True, default='')
+    modification_date = models.DateTimeField(auto_now=True)
+
+
 class Timezone(models.Model):
     """ Stores the Timezone information """
     ### model options - "anything that's not a field"
@@ -71,9 +492,10 @@ class Timezone(models.Model):
         if settings.DEBUG:
             return u"PK{0} UTC{1}{2:02d}:{3:02d}".format('PK' + self.pk, sign, hours, minutes)
         return u"{0} UTC{1}{2:02d}:{3:02d}".format(self.name, sign, hours, minutes)
+    __str__ = __unicode__
 
     ### custom managers
-    objects = BaseManager()
+    objects = ReferenceManager()
 
     ### model DB fields
     status = models.IntegerField(blank=False, default=BaseManager.STATUS_ENABLED,
@@ -94,6 +516,7 @@ class Language(models.Model):
         if settings.DEBUG:
             return u"PK{0}".format(self.name)
         return u"{0}".format(self.name)
+    __str__ = __unicode__
 
     ### model DB fields
     status = models.IntegerField(blank=False, default=BaseManager.STATUS_ENABLED,
@@ -103,7 +526,7 @@ class Language(models.Model):
     iso_639_1 = models.CharField(max_length=50, blank=True)
 
     ### custom managers
-    objects = BaseManager()
+    objects = ReferenceManager()
 
 class Currency(models.Model):
     """ Model to hold Currency related information """
@@ -117,10 +540,11 @@ class Currency(models.Model):
         if settings.DEBUG:
             return u"PK{0}: {1}".format(self.code, self.name)
         return u"{0} - {1}".format(self.code, self.name)
+    __str__ = __unicode__
 
 
     ### custom managers
-    objects = BaseManager()
+    objects = ReferenceManager()
 
     ### model DB fields
     status = models.IntegerField(blank=False, default=BaseManager.STATUS_ENABLED,
@@ -143,17 +567,38 @@ class Country(models.Model):
         if settings.DEBUG:
             return u'PK{0}: {1}'.format(self.code, self.name)
         return u'{0}'.format(self.name)
+    __str__ = __unicode__
+
+    ### Django established method
+    def save(self, *args, **kwargs):
+        old_name = Country.objects.filter(pk=self.pk).values_list('name', flat=True).first()
+        with transaction.atomic():
+            # Call the "real" save() method.
+            super(Country, self).save(*args, **kwargs)
+
+            # Update child localities display name
+            if old_name is not None and old_name != self.name:
+                Locality.objects.update_long_names(country=self)
 
     ### extra model functions
-    def search_locality(self, locality_name):
+    def search_locality(self, locality_name, fuzzy=False, **kwargs):
+        """
+        Localities of the country named or alternatively named ``locality_name``, most populated first. With
+        ``fuzzy`` the public localities with similar names, see ``Locality.objects.fuzzy_search``.
+        """
         if len(locality_name) == 0:
             return []
+        if fuzzy:
+            return Locality.objects.fuzzy_search(locality_name, country=self.code, **kwargs)
+        search_name = normalize_name(locality_name)
+        # A subquery instead of a join, so each locality comes once without DISTINCT
+        alternates = AlternateName.objects.filter(search_name=search_name).values('locality_id')
         q = Q(country_id=self.code)
-        q &= (Q(name__iexact=locality_name) | Q(alternatenames__name__iexact=locality_name))
-        return Locality.objects.filter(q).distinct()
+        q &= (Q(search_name=search_name) | Q(pk__in=alternates))
+        return Locality.objects.filter(q).order_by('-population', 'geonameid')
 
     ### custom managers
-    objects = BaseManager()
+    objects = ReferenceManager()
 
     ### model DB fields
     status = models.IntegerField(blank=False, default=BaseManager.STATUS_ENABLED,
@@ -170,25 +615,30 @@ class Admin1Code(models.Model):
     ### model options - "anything that's not a field"
     class Meta:
         unique_together = (("country", "name"),)
-        ordering = ['country', 'name']
+        ordering = ['country_id', 'name']
 
     ### Python convention class methods
     def __unicode__(self):
         if settings.DEBUG:
-            return u'PK{0}: {1} > {2}'.format(self.geonameid, self.country.name, self.name)
-        return u'{0}, {1}'.format(self.name, self.country.name)
+            return u'PK{0}: {1} > {2}'.format(self.geonameid, cached_related(self, 'country').name, self.name)
+        return u'{0}, {1}'.format(self.name, cached_related(self, 'country').name)
+    __str__ = __unicode__
 
     ### Django established method
     def save(self, *args, **kwargs):
-        # Call the "real" save() method.
-        super(Admin1Code, self).save(*args, **kwargs)
+        old_name = Admin1Code.objects.filter(pk=self.pk).values_list('name', flat=True).first()
+        with transaction.atomic():
+            # Call the "real" save() method.
+            super(Admin1Code, self).save(*args, **kwargs)
 
-        # Update child localities long name
-        for loc in self.localities.all():
-            loc.save()
+            # Update child localities long name
+            if old_name is not None and old_name != self.name:
+                Locality.objects.update_long_names(admin1=self)
 
     ### custom managers
-    objects = BaseManager()
+    objects = Admin1CodeManager()
+    # see BaseQuerySet.for_display
+    display_related = ('country',)
 
     ### model DB fields
     status = models.IntegerField(blank=False, default=BaseManager.STATUS_ENABLED,
@@ -204,36 +654,44 @@ class Admin2Code(models.Model):
     ### model options - "anything that's not a field"
     class Meta:
         unique_together = (("country", "admin1", "name"),)
-        ordering = ['country', 'admin1', 'name']
+        ordering = ['country_id', 'admin1_id', 'name']
 
     ### Python convention class methods
     def __unicode__(self):
         admin1_name = None
-        if self.admin1: admin1_name = self.admin1.name
+        admin1 = cached_related(self, 'admin1')
+        if admin1: admin1_name = admin1.name
+        country_name = cached_related(self, 'country').name
         if settings.DEBUG:
-            return u'PK{0}: {1}{2} > {3}'.format(self.geonameid, self.country.name,
+            return u'PK{0}: {1}{2} > {3}'.format(self.geonameid, country_name,
                                                     ' > ' + admin1_name if admin1_name else '',
                                                     self.name)
         return u'{0}, {1}{2}'.format(self.name,
                                         admin1_name + ', ' if admin1_name else '',
-                                        self.country.name)
+                                        country_name)
+    __str__ = __unicode__
 
     ### Django established method
     def save(self, *args, **kwargs):
         # Check consistency
-        if self.admin1 is not None and self.admin1.country != self.country:
+        admin1 = related_values(self, 'admin1', ('country_id',), kwargs.get('using'))
+        if admin1 is not None and admin1[0] != self.country_id:
             raise ValueError("The country '{}' from the Admin1 '{}' is different than the country '{}' from the Admin2 '{}' and geonameid {}".format(
                                 self.admin1.country, self.admin1, self.country, self.name, self.geonameid))
 
-        # Call the "real" save() method.
-        super(Admin2Code, self).save(*args, **kwargs)
+        old_name = Admin2Code.objects.filter(pk=self.pk).values_list('name', flat=True).first()
+        with transaction.atomic():
+            # Call the "real" save() method.
+            super(Admin2Code, self).save(*args, **kwargs)
 
-        # Update child localities long name
-        for loc in self.localities.all():
-            loc.save()
+            # Update child localities long name
+            if old_name is not None and old_name != self.name:
+                Locality.objects.update_long_names(admin2=self)
 
     ### custom managers
-    objects = BaseManager()
+    objects = Admin2CodeManager()
+    # see BaseQuerySet.for_display
+    display_related = ('country', 'admin1')
 
     ### model DB fields
     status = models.IntegerField(blank=False, default=BaseManager.STATUS_ENABLED,
@@ -251,62 +709,100 @@ class Locality(models.Model):
     """ Hold locality information - cities, towns, villages, etc """
     ### model options - "anything that's not a field"
     class Meta:
-        ordering = ['country', 'admin1', 'admin2', 'long_name']
+        ordering = ['country_id', 'admin1_id', 'admin2_id', 'long_name']
         verbose_name_plural = 'Localities'
+        constraints = [
+            # Duplicated localities are kept disabled, see loadgeonames
+            models.UniqueConstraint(fields=['country', 'long_name'], condition=Q(status__gte=BaseManager.STATUS_ENABLED),
+                                    name='geonames_locality_unique_long_name'),
+        ]
+        # point has its own spatial index
+        indexes = [
+            models.Index(fields=['latitude', 'longitude'], name='geonames_locality_lat_lon'),
+            models.Index(fields=['country', 'status', 'long_name'], name='geonames_locality_country'),
+            models.Index(fields=['latitude', 'longitude'], condition=Q(status__gte=BaseManager.STATUS_ENABLED),
+                         name='geonames_locality_public_pos'),
+            models.Index(fields=['-population'], condition=Q(status__gte=BaseManager.STATUS_ENABLED),
+                         name='geonames_locality_public_pop'),
+            models.Index(fields=['country', 'search_name'], name='geonames_locality_search'),
+        ] + trigram_indexes('geonames_locality_trigram')
 
     ### Python class methods
     def __unicode__(self):
+        if self.display_name and not settings.DEBUG:
+            return self.display_name
         admin1_name = None
-        if self.admin1: admin1_name = self.admin1.name
+        admin1 = cached_related(self, 'admin1')
+        if admin1: admin1_name = admin1.name
         admin2_name = None
-        if self.admin2: admin2_name = self.admin2.name
+        admin2 = cached_related(self, 'admin2')
+        if admin2: admin2_name = admin2.name
+        country_name = cached_related(self, 'country').name
         if settings.DEBUG:
-            return u'PK{0}: {1}{2}{3} > {4}'.format(self.geonameid, self.country.name,
+            return u'PK{0}: {1}{2}{3} > {4}'.format(self.geonameid, country_name,
                                         ' > ' + admin1_name  if admin1_name else '',
                                         ' > ' + admin2_name + ' > ' if admin2_name else '',
                                         self.name)
         return u'{0}{1}{2}, {3}'.format(self.name,
                                         ', ' + admin2_name if admin2_name else '',
                                         ', ' + admin1_name if admin1_name else '',
-                                        self.country.name)
+                                        country_name)
+    __str__ = __unicode__
 
     ### Python convention class methods
     def save(self, check_duplicated_longname=True, *args, **kwargs):
-        # Update long_name
-        self.long_name = self.generate_long_name()
-
-        if check_duplicated_longname is True:
-            # and check if already exists other locality with the same long name
-            other_localities = Locality.objects.filter(long_name=self.long_name)
-            other_localities = other_localities.exclude(geonameid=self.geonameid)
-
-            if other_localities.count() > 0:
-                raise ValueError("Duplicated locality long name '{}'".format(self.long_name))
+        using = kwargs.get('using') or router.db_for_write(Locality, instance=self)
+        admin1 = self.admin_values('admin1', using)
+        admin2 = self.admin_values('admin2', using)
+        country = related_values(self, 'country', ('name',), using)
+        # Update long_name, display_name and search_name
+        self.long_name = build_long_name(self.name, admin1 and admin1[0], admin2 and admin2[0])
+        self.display_name = build_display_name(self.long_name, country[0] if country else '')
+        self.search_name = normalize_name(self.name)
 
         # Check consistency
-        if self.admin1 is not None and self.admin1.country != self.country:
+        if admin1 is not None and admin1[1] != self.country_id:
             raise ValueError("The country '{}' from the Admin1 '{}' is different than the country '{}' from the locality '{}'".format(
                             self.admin1.country, self.admin1, self.country, self.long_name))
 
-        if self.admin2 is not None and self.admin2.country != self.country:
+        if admin2 is not None and admin2[1] != self.country_id:
             raise ValueError("The country '{}' from the Admin2 '{}' is different than the country '{}' from the locality '{}'".format(
                             self.admin2.country, self.admin2, self.country, self.long_name))
 
-        self.point = Point(float(self.longitude), float(self.latitude))
+        point = (float(self.longitude), float(self.latitude))
+        if self.point is None or self.point.coords != point:
+            self.point = Point(*point)
+
+        if check_duplicated_longname is True and not connections[using].features.supports_partial_indexes:
+            # There is no unique constraint to rely on
+            if self.is_duplicated_long_name(using):
+                raise ValueError("Duplicated locality long name '{}'".format(self.long_name))
 
         # Call the "real" save() method.
-        super(Locality, self).save(*args, **kwargs)
+        try:
+            with transaction.atomic(using=using):
+                super(Locality, self).save(*args, **kwargs)
+        except IntegrityError:
+            if self.is_duplicated_long_name(using):
+                raise ValueError("Duplicated locality long name '{}'".format(self.long_name))
+            raise
 
     ### extra model functions
-    def generate_long_name(self):
-        long_name = u"{}".format(self.name)
-        if self.admin2 is not None:
-            long_name = u"{}, {}".format(long_name, self.admin2.name)
+    def admin_values(self, field, using=None):
+        """ Returns the ``(name, country code)`` of the ``field`` admin level, from the data base if not loaded """
+        return related_values(self, field, ('name', 'country_id'), using)
 
-        if self.admin1 is not None:
-            long_name = u"{}, {}".format(long_name, self.admin1.name)
+    def is_duplicated_long_name(self, using=None):
+        if self.status < BaseManager.STATUS_ENABLED:
+            return False
+        other_localities = Locality.objects.db_manager(using).public().filter(country_id=self.country_id,
+                                                                             long_name=self.long_name)
+        return other_localities.exclude(geonameid=self.geonameid).exists()
 
-        return long_name
+    def generate_long_name(self):
+        admin1 = self.admin_values('admin1')
+        admin2 = self.admin_values('admin2')
+        return build_long_name(self.name, admin1 and admin1[0], admin2 and admin2[0])
 
     def near_localities_rough(self, miles):
         """
@@ -328,50 +824,39 @@ class Locality(models.Model):
         return near_localities
 
     def near_locals_nogis(self, miles):
-        ids = []
-        for loc in self.near_localities_rough(miles).values_list("geonameid", "latitude", "longitude"):
-            other_geonameid = loc[0]
-            if self.geonameid == other_geonameid:
-                distance = 0
-                ids.append(other_geonameid)
-            else:
-                distance = self.calc_distance_nogis(loc[1], loc[2])
-                if distance <= miles:
-                    ids.append(other_geonameid)
-
-        return ids
+        """ geonameids of the localities at ``miles`` miles of this one, sorted by distance """
+        return self.near_locals_distances_nogis(miles)[0]
+
+    def near_locals_distances_nogis(self, miles):
+        """ geonameids of the localities at ``miles`` miles of this one and their distances, sorted by distance """
+        candidates = list(self.near_localities_rough(miles).values_list("geonameid", "latitude", "longitude"))
+        ids = [loc[0] for loc in candidates]
+        latitudes = [float(loc[1]) for loc in candidates]
+        longitudes = [float(loc[2]) for loc in candidates]
+        return within_radius(float(self.latitude), float(self.longitude), ids, latitudes, longitudes, miles)
+
+    def near_locals_indexed(self, miles):
+        """ geonameids of the public localities at ``miles`` miles of this one, sorted by distance """
+        return Locality.objects.within_radius(self.latitude, self.longitude, miles)[0]
 
     def calc_distance_nogis(self, la2, lo2):
-        # Convert latitude and longitude to
-        # spherical coordinates in radians.
-        # phi = 90 - latitude
-        phi1 = (90.0 - float(self.latitude)) * DEGREES_TO_RADIANS
-        phi2 = (90.0 - float(la2)) * DEGREES_TO_RADIANS
-
-        # theta = longitude
-        theta1 = float(self.longitude) * DEGREES_TO_RADIANS
-        theta2 = float(lo2) * DEGREES_TO_RADIANS
-
-        # Compute spherical distance from spherical coordinates.
-        # For two localities in spherical coordinates
-        # (1, theta, phi) and (1, theta, phi)
-        # cosine( arc length ) =
-        #    sin phi sin phi' cos(theta-theta') + cos phi cos phi'
-        # distance = rho * arc length
-        cosinus = sin(phi1) * sin(phi2) * cos(theta1 - theta2) + cos(phi1) * cos(phi2)
-        cosinus = round(cosinus, 14)  # to avoid math domain error in acos
-        arc = acos(cosinus)
-
-        # Multiply arc by the radius of the earth
-        return arc * EARTH_RADIUS_MI
+        """ Distance in miles to the point ``la2``, ``lo2`` """
+        return haversine(float(self.latitude), float(self.longitude), float(la2), float(lo2))
 
     def near_localities(self, miles):
+        if POINT_GEOGRAPHY:
+            # ST_DWithin on a geography uses the spatial index and measures on the spheroid
+            localities = Locality.objects.filter(point__dwithin=(self.point, D(mi=miles)))
+            return localities.values_list("geonameid", flat=True)
+
         localities = self.near_localities_rough(miles)
         localities = localities.filter(point__distance_lte=(self.point, D(mi=miles)))
         return localities.values_list("geonameid", flat=True)
 
     ### custom managers
-    objects = BaseManager()
+    objects = LocalityManager()
+    # see BaseQuerySet.for_display, display_name is enough out of DEBUG mode
+    display_related = ('country', 'admin1', 'admin2')
 
     ### model DB fields
     status = models.IntegerField(blank=False, default=BaseManager.STATUS_ENABLED,
@@ -379,7 +864,11 @@ class Locality(models.Model):
                                 choices=BaseManager.STATUS_CHOICES)
     geonameid = models.PositiveIntegerField(primary_key=True)
     name = models.CharField(max_length=200, db_index=True)
+    # Lower-cased and unaccented name, see geonames.search. PostgreSQL also indexes it for prefix matching
+    search_name = models.CharField(max_length=200, db_index=True, editable=False, default='')
     long_name = models.CharField(max_length=200)
+    # Long name and country name, as rendered out of DEBUG mode
+    display_name = models.CharField(max_length=400, editable=False, default='')
     country = models.ForeignKey(Country, related_name="locality_set", on_delete=models.CASCADE)
     admin1 = models.ForeignKey(Admin1Code, null=True, blank=True, related_name="locality_set", on_delete=models.CASCADE)
     admin2 = models.ForeignKey(Admin2Code, null=True, blank=True, related_name="locality_set", on_delete=models.CASCADE)
@@ -387,7 +876,7 @@ class Locality(models.Model):
     population = models.PositiveIntegerField()
     latitude = models.DecimalField(max_digits=7, decimal_places=2)
     longitude = models.DecimalField(max_digits=7, decimal_places=2)
-    point = models.PointField(geography=False)
+    point = models.PointField(geography=POINT_GEOGRAPHY)
     modification_date = models.DateField()
 
 
@@ -396,13 +885,20 @@ class AlternateName(models.Model):
     ### model options - "anything that's not a field"
     class Meta:
         unique_together = (("locality", "name"),)
-        ordering = ['locality__pk', 'name']
+        ordering = ['locality_id', 'name']
+        indexes = trigram_indexes('geonames_alternatename_trigram')
 
     ### Python class methods
     def __unicode__(self):
         if settings.DEBUG:
             return u'PK{0}: {1} ({2})'.format(self.alternatenameid, self.name, self.locality.name)
         return u'{0} ({1})'.format(self.name, self.locality.name)
+    __str__ = __unicode__
+
+    ### Python convention class methods
+    def save(self, *args, **kwargs):
+        self.search_name = normalize_name(self.name)
+        super(AlternateName, self).save(*args, **kwargs)
 
     ### model DB fields
     status = models.IntegerField(blank=False, default=BaseManager.STATUS_ENABLED,
@@ -411,7 +907,11 @@ class AlternateName(models.Model):
     alternatenameid = models.PositiveIntegerField(primary_key=True)
     locality = models.ForeignKey(Locality, related_name="alternatename_set", on_delete=models.CASCADE)
     name = models.CharField(max_length=200, db_index=True)
+    # Lower-cased and unaccented name, see geonames.search
+    search_name = models.CharField(max_length=200, db_index=True, editable=False, default='')
     # TODO include localization code
 
     ### custom managers
-    objects = BaseManager()
+    objects = AlternateNameManager()
+    # see BaseQuerySet.for_display
+    display_related = ('locality',)
@@ -0,0 +1,266 @@
+"""
+Name normalization shared by the search columns of the models and the loader, and the process-local indexes behind
+``Locality.objects.autocomplete`` and ``Locality.objects.fuzzy_search``.
+"""
+from array import array
+from bisect import bisect_left
+from collections import Counter
+import heapq
+from math import log10
+from operator import itemgetter
+import re
+import unicodedata
+
+from geonames.local_index import LocalIndex
+
+WORD = re.compile(r'[^\W_]+')
+
+# Letters with no decomposition into a base letter and a combining mark
+LETTERS = str.maketrans({u'ł': u'l', u'ø': u'o', u'đ': u'd', u'ħ': u'h', u'ı': u'i', u'æ': u'ae', u'œ': u'oe',
+                         u'þ': u'th', u'ð': u'd'})
+
+
+def normalize_name(name):
+    """
+    Case and accent insensitive form of ``name``: 'Málaga' and 'MALAGA' are both 'malaga'. The accents are
+    removed by decomposing the characters and dropping the combining marks.
+    """
+    decomposed = unicodedata.normalize('NFKD', name)
+    name = u''.join(c for c in decomposed if not unicodedata.combining(c))
+    return u' '.join(name.casefold().translate(LETTERS).split())
+
+
+def trigrams(name):
+    """ Trigrams of ``name`` as pg_trgm counts them: of each word padded with two spaces before and one after """
+    grams = set()
+    for word in WORD.findall(name):
+        word = u'  {} '.format(word)
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def rank_similarities(similarities, populations, limit, population_weight=0):
+    """
+    The ``limit`` best ``(geonameid, similarity)`` of ``similarities``. With a ``population_weight`` the similarity
+    is multiplied by ``1 + population_weight * log10(population + 1)``, ties go to the most populated.
+    """
+    def key(geonameid):
+        population = populations[geonameid]
+        return (-similarities[geonameid] * (1 + population_weight * log10(population + 1)), -population, geonameid)
+    return [(geonameid, similarities[geonameid]) for geonameid in heapq.nsmallest(limit, similarities, key=key)]
+
+
+class PrefixIndex(object):
+    """
+    Array of the distinct ``(search name, geonameid)`` pairs of ``names``, sorted by name: the names starting with a
+    prefix are a contiguous range found by bisection. A segment tree over the array holds the position of the most
+    populated locality of each node, so the top localities of any range are taken one by one in ``O(log n)`` each,
+    however long the range. ``ranks`` maps the geonameids to their place by decreasing population.
+    """
+    # Ranges filtered by admin1 up to this length are scanned, as are the longer ones once this many names were
+    # taken from the tree without finding enough localities of the admin1
+    scan_length = 2000
+
+    def __init__(self, names, ranks, admins1):
+        self.names = [name for name, geonameid in names]
+        self.geonameids = array('I', (geonameid for name, geonameid in names))
+        self.admins1 = admins1
+        # The extra position, ranked last, stands for no name
+        self.ranks = array('I', (ranks[geonameid] for geonameid in self.geonameids))
+        self.ranks.append(len(ranks))
+        self.tree = self.build_tree()
+
+    def __len__(self):
+        return len(self.names)
+
+    def build_tree(self):
+        """ Node ``i`` covers its children ``2i`` and ``2i + 1``, the leaves ``n`` to ``2n - 1`` are the positions """
+        size = len(self.names)
+        ranks = self.ranks
+        tree = array('I', bytes(4 * size)) + array('I', range(size))
+        for node in range(size - 1, 0, -1):
+            left = tree[2 * node]
+            right = tree[2 * node + 1]
+            tree[node] = left if ranks[left] <= ranks[right] else right
+        return tree
+
+    def best(self, start, end):
+        """ Position of the most populated locality of the ``start:end`` range """
+        ranks = self.ranks
+        tree = self.tree
+        best = len(self.names)
+        start += len(self.names)
+        end += len(self.names)
+        while start < end:
+            if start & 1:
+                if ranks[tree[start]] < ranks[best]:
+                    best = tree[start]
+                start += 1
+            if end & 1:
+                end -= 1
+                if ranks[tree[end]] < ranks[best]:
+                    best = tree[end]
+            start >>= 1
+            end >>= 1
+        return best
+
+    def scan(self, start, end, limit, admin1):
+        """ The ``search`` of the ``start:end`` range by going through all of it """
+        geonameids = set(geonameid for geonameid in self.geonameids[start:end] if self.admins1[geonameid] == admin1)
+        ranks = dict((self.geonameids[position], self.ranks[position]) for position in range(start, end)
+                     if self.geonameids[position] in geonameids)
+        return heapq.nsmallest(limit, ranks, key=ranks.get)
+
+    def search(self, prefix, limit=10, admin1=None):
+        """ geonameids of the ``limit`` most populated localities with a name starting with ``prefix`` """
+        start = bisect_left(self.names, prefix)
+        end = bisect_left(self.names, prefix + u'\U0010ffff', start)
+        if admin1 is not None and end - start <= self.scan_length:
+            return self.scan(start, end, limit, admin1)
+
+        found = []
+        seen = set()
+        taken = 0
+        heap = []
+        if start < end:
+            position = self.best(start, end)
+            heap.append((self.ranks[position], position, start, end))
+        while heap and len(found) < limit:
+            if admin1 is not None and taken >= self.scan_length:
+                return self.scan(start, end, limit, admin1)
+            rank, position, range_start, range_end = heapq.heappop(heap)
+            taken += 1
+            geonameid = self.geonameids[position]
+            if geonameid not in seen:
+                seen.add(geonameid)
+                if admin1 is None or self.admins1[geonameid] == admin1:
+                    found.append(geonameid)
+            # The rest of the range, on both sides of the position taken
+            for left, right in ((range_start, position), (position + 1, range_end)):
+                if left < right:
+                    best = self.best(left, right)
+                    heapq.heappush(heap, (self.ranks[best], best, left, right))
+        return found
+
+
+class AutocompleteIndex(object):
+    """ Prefix indexes over the names and alternate names of the public localities, worldwide and per country """
+    def __init__(self, localities, alternate_names):
+        populations = {}
+        admins1 = {}
+        countries = {}
+        names = []
+        for geonameid, search_name, population, country_id, admin1_id in localities:
+            populations[geonameid] = population
+            admins1[geonameid] = admin1_id
+            countries[geonameid] = country_id
+            names.append((search_name, geonameid))
+        names.extend((search_name, locality_id) for locality_id, search_name in alternate_names
+                     if locality_id in countries)
+        # Sorting by name alone is enough for the bisection, and faster than by pair
+        names = sorted(set(names), key=itemgetter(0))
+
+        ranks = dict((geonameid, rank) for rank, geonameid in
+                     enumerate(sorted(populations, key=lambda geonameid: (-populations[geonameid], geonameid))))
+        # The names of each country are taken from the sorted ones, already in order
+        country_names = {}
+        for name in names:
+            country_names.setdefault(countries[name[1]], []).append(name)
+        self.countries = dict((country_id, PrefixIndex(country_names[country_id], ranks, admins1))
+                              for country_id in country_names)
+        self.world = PrefixIndex(names, ranks, admins1)
+
+    def search(self, prefix, limit=10, country=None, admin1=None):
+        """ geonameids of the ``limit`` most populated localities with a name starting with ``prefix`` """
+        prefix = normalize_name(prefix)
+        if not prefix:
+            return []
+        if country is None:
+            return self.world.search(prefix, limit, admin1)
+        if country not in self.countries:
+            return []
+        return self.countries[country].search(prefix, limit, admin1)
+
+
+class TrigramIndex(object):
+    """ Inverted index from the trigrams to the names and alternate names of the public localities """
+    def __init__(self, localities, alternate_names):
+        self.populations = {}
+        self.countries = {}
+        names = []
+        for geonameid, search_name, population, country_id, admin1_id in localities:
+            self.populations[geonameid] = population
+            self.countries[geonameid] = country_id
+            names.append((search_name, geonameid))
+        names.extend((search_name, locality_id) for locality_id, search_name in alternate_names
+                     if locality_id in self.countries)
+
+        self.geonameids = array('I')
+        self.sizes = array('H')
+        self.postings = {}
+        for position, (name, geonameid) in enumerate(sorted(set(names))):
+            grams = trigrams(name)
+            self.geonameids.append(geonameid)
+            self.sizes.append(len(grams))
+            for gram in grams:
+                self.postings.setdefault(gram, array('I')).append(position)
+
+    def similarities(self, name, country=None, threshold=0.3):
+        """ Best pg_trgm similarity to ``name`` of each locality reaching ``threshold`` """
+        grams = trigrams(normalize_name(name))
+        shared = Counter()
+        for gram in grams:
+            if gram in self.postings:
+                shared.update(self.postings[gram])
+
+        similarities = {}
+        # similarity = shared / (len(grams) + size - shared) can only reach the threshold from this many shared
+        least = threshold * len(grams)
+        for position, count in shared.items():
+            if count < least:
+                continue
+            similarity = count / float(len(grams) + self.sizes[position] - count)
+            geonameid = self.geonameids[position]
+            if similarity < threshold or (country is not None and self.countries[geonameid] != country):
+                continue
+            if similarity > similarities.get(geonameid, 0):
+                similarities[geonameid] = similarity
+        return similarities
+
+    def search(self, name, limit=10, country=None, threshold=0.3, population_weight=0):
+        """ The ``limit`` best ``(geonameid, similarity)``, see ``rank_similarities`` """
+        return rank_similarities(self.similarities(name, country, threshold), self.populations, limit,
+                                 population_weight)
+
+
+def public_names():
+    """ Names and alternate names of the public localities, for the indexes """
+    from geonames.models import AlternateName, Locality
+    localities = Locality.objects.public().order_by().values_list('geonameid', 'search_name', 'population',
+                                                                  'country_id', 'admin1_id')
+    alternate_names = AlternateName.objects.public().order_by().values_list('locality_id', 'search_name')
+    return localities.iterator(), alternate_names.iterator()
+
+
+def build_index():
+    """ Builds the autocomplete index of the public localities with two queries """
+    return AutocompleteIndex(*public_names())
+
+
+def build_trigram_index():
+    """ Builds the trigram index of the public localities with two queries """
+    return TrigramIndex(*public_names())
+
+
+_index = LocalIndex(build_index)
+_trigram_index = LocalIndex(build_trigram_index)
+
+
+def get_index():
+    """ Returns the autocomplete index of this process, building it when missing or outdated """
+    return _index.get()
+
+
+def get_trigram_index():
+    """ Returns the trigram index of this process, building it when missing or outdated """
+    return _trigram_index.get()
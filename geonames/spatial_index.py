@@ -0,0 +1,118 @@
+"""
+Process-local spatial index over the public localities, answering radius and k-nearest-neighbour queries without
+hitting the data base.
+
+Localities are bucketed in a grid of ``cell_degrees`` latitude/longitude cells and kept sorted by cell in compact
+NumPy arrays, so a query only computes the distances of the few cells its circle touches. The index is built once
+per process with a single query, see ``geonames.local_index``. It needs NumPy.
+"""
+from math import ceil, cos, degrees, pi, radians
+
+from django.core.exceptions import ImproperlyConfigured
+
+from geonames.distance import EARTH_RADIUS_MI, distances, np
+from geonames.local_index import LocalIndex
+
+MILES_PER_DEGREE = EARTH_RADIUS_MI * pi / 180.0
+
+
+class GridIndex(object):
+    """ Grid index over the points ``latitudes``, ``longitudes`` identified by ``ids`` """
+    def __init__(self, ids, latitudes, longitudes, populations=None, cell_degrees=1.0):
+        if np is None:
+            raise ImproperlyConfigured("The spatial index needs NumPy, install it with 'pip install numpy'")
+        self.cell_degrees = cell_degrees
+        self.rows = int(ceil(180.0 / cell_degrees))
+        self.cols = int(ceil(360.0 / cell_degrees))
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        if populations is None:
+            populations = np.zeros(len(latitudes))
+        cells = self.row(latitudes) * self.cols + self.col(longitudes)
+        order = np.argsort(cells, kind='stable')
+        self.ids = np.asarray(ids, dtype=np.uint32)[order]
+        self.latitudes = latitudes[order]
+        self.longitudes = longitudes[order]
+        self.populations = np.asarray(populations, dtype=np.uint32)[order]
+        # Position of the first point of each cell in the sorted arrays
+        self.starts = np.searchsorted(cells[order], np.arange(self.rows * self.cols + 1))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, latitude):
+        return np.clip(np.floor((np.asarray(latitude) + 90.0) / self.cell_degrees), 0, self.rows - 1).astype(np.int64)
+
+    def col(self, longitude):
+        return np.clip(np.floor(((np.asarray(longitude) + 180.0) % 360.0) / self.cell_degrees),
+                       0, self.cols - 1).astype(np.int64)
+
+    def candidates(self, latitude, longitude, miles):
+        """ Positions of the points in the cells touched by the circle of ``miles`` around the point """
+        delta_lat = degrees(miles / EARTH_RADIUS_MI)
+        first_row = int(self.row(latitude - delta_lat))
+        last_row = int(self.row(latitude + delta_lat))
+        all_cols = latitude + delta_lat >= 90.0 or latitude - delta_lat <= -90.0
+        if not all_cols:
+            # The circle is the widest at its edge closest to a pole
+            edge = radians(max(abs(latitude - delta_lat), abs(latitude + delta_lat)))
+            delta_lon = degrees(miles / EARTH_RADIUS_MI / cos(edge))
+            all_cols = delta_lon >= 180.0
+        if not all_cols:
+            first_col = int(self.col(longitude - delta_lon))
+            last_col = int(self.col(longitude + delta_lon))
+
+        slices = []
+        for row in range(first_row, last_row + 1):
+            base = row * self.cols
+            if all_cols:
+                slices.append((base, base + self.cols))
+            elif first_col <= last_col:
+                slices.append((base + first_col, base + last_col + 1))
+            else:
+                # around the antimeridian
+                slices.append((base + first_col, base + self.cols))
+                slices.append((base, base + last_col + 1))
+
+        ranges = [np.arange(self.starts[start], self.starts[end]) for start, end in slices
+                  if self.starts[end] > self.starts[start]]
+        if not ranges:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(ranges)
+
+    def within_radius(self, latitude, longitude, miles, min_population=None):
+        """ Returns the ids of the points within ``miles`` and their distances, sorted by distance """
+        positions = self.candidates(latitude, longitude, miles)
+        if min_population is not None:
+            positions = positions[self.populations[positions] >= min_population]
+        found = distances(latitude, longitude, self.latitudes[positions], self.longitudes[positions])
+        near = found <= miles
+        positions, found = positions[near], found[near]
+        order = np.argsort(found, kind='stable')
+        return self.ids[positions[order]].tolist(), found[order].tolist()
+
+    def nearest(self, latitude, longitude, k=1, min_population=None):
+        """ Returns the ids of the ``k`` nearest points and their distances, sorted by distance """
+        miles = self.cell_degrees * MILES_PER_DEGREE
+        while True:
+            ids, found = self.within_radius(latitude, longitude, miles, min_population)
+            # Every point closer than the radius was found, so these are the nearest ones
+            if len(ids) >= k or miles >= pi * EARTH_RADIUS_MI:
+                return ids[:k], found[:k]
+            miles *= 2
+
+
+def build_index():
+    """ Builds the index of the public localities with one query """
+    from geonames.models import Locality
+    rows = list(Locality.objects.public().order_by().values_list('geonameid', 'latitude', 'longitude', 'population'))
+    return GridIndex([row[0] for row in rows], [float(row[1]) for row in rows], [float(row[2]) for row in rows],
+                     [row[3] for row in rows])
+
+
+_index = LocalIndex(build_index)
+
+
+def get_index():
+    """ Returns the index of this process, building it when missing or outdated """
+    return _index.get()
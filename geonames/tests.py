@@ -1,4 +1,1054 @@
-#TODO: tests
+import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+from math import pi
+import os
+import pstats
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+import zipfile
+
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import SimpleTestCase, TestCase
+
+import geonames.distance
+from geonames.loading.downloads import DownloadError, download
+from geonames.loading.fixtures import generate_dumps, write_zip
+from geonames.loading.indexes import DeferredIndexes
+from geonames.loading.instrumentation import QueryStats, Recorder
+from geonames.loading.parsing import AlternateNameParser, GeonameidSet, GeonameParser, RecentNames, parse_file
+from geonames.loading.writers import BulkCreateWriter, CopyWriter, build_instance, get_writer, point_ewkt
+from geonames.distance import EARTH_RADIUS_MI, haversine, np
+from geonames.local_index import invalidate_all
+from geonames.management.commands.loadgeonames import Command
+from geonames.models import Admin1Code, Admin2Code, AlternateName, Country, Currency, GeonamesCheckpoint, \
+    GeonamesUpdate, Language, Locality, Timezone, build_display_name, build_long_name
+from geonames.search import AutocompleteIndex
+from geonames.spatial_index import GridIndex
+
+
+class DumpHandler(BaseHTTPRequestHandler):
+    """ Serves the ``files`` of the server like geonames.org does, with conditional and range requests """
+    def do_GET(self):
+        name = self.path.lstrip('/')
+        self.server.requests.append((name, dict(self.headers)))
+        if name not in self.server.files:
+            return self.answer(404)
+        data, modified = self.server.files[name]
+        last_modified = formatdate(modified, usegmt=True)
+
+        since = self.headers.get('If-Modified-Since')
+        if since and parsedate_to_datetime(since).timestamp() >= modified:
+            return self.answer(304)
+        status = 200
+        ranges = self.headers.get('Range')
+        if ranges and self.headers.get('If-Range') == last_modified:
+            start = int(ranges[len('bytes='):-1])
+            if start >= len(data):
+                return self.answer(416)
+            status = 206
+            data = data[start:]
+        length = len(data)
+        if name in self.server.truncate:
+            # The connection drops halfway
+            data = data[:len(data) // 2]
+        self.answer(status, data, {'Content-Length': str(length), 'Last-Modified': last_modified})
+
+    def answer(self, status, data=b'', headers=None):
+        self.server.statuses.append(status)
+        self.send_response(status)
+        for name, value in (headers or {'Content-Length': '0'}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadTest(SimpleTestCase):
+    modified = 1500000000
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), DumpHandler)
+        self.server.files = {}
+        self.server.truncate = set()
+        self.server.requests = []
+        self.server.statuses = []
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def serve(self, name, data, modified=None):
+        self.server.files[name] = (data, modified or self.modified)
+        return 'http://127.0.0.1:{}/{}'.format(self.server.server_address[1], name)
+
+    def zip_data(self, name, size=100000):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(name, os.urandom(size))
+        return buffer.getvalue()
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as fd:
+            return fd.read()
+
+    def write_part(self, name, data, modified):
+        part = os.path.join(self.directory, name + '.part')
+        with open(part, 'wb') as fd:
+            fd.write(data)
+        os.utime(part, (modified, modified))
+        return part
+
+    def test_download(self):
+        data = self.zip_data('a.txt')
+        path = download(self.serve('a.zip', data), self.directory)
+        self.assertEqual(path, os.path.join(self.directory, 'a.zip'))
+        self.assertEqual(self.read('a.zip'), data)
+        self.assertEqual(os.path.getmtime(path), self.modified)
+        self.assertNotIn('If-Modified-Since', self.server.requests[0][1])
+        self.assertEqual(self.server.statuses, [200])
+
+    def test_not_modified(self):
+        url = self.serve('a.txt', b'a' * 1000)
+        download(url, self.directory)
+        download(url, self.directory)
+        self.assertIn('If-Modified-Since', self.server.requests[1][1])
+        self.assertEqual(self.server.statuses, [200, 304])
+        self.assertEqual(self.read('a.txt'), b'a' * 1000)
+
+    def test_resume(self):
+        data = self.zip_data('a.txt')
+        self.write_part('a.zip', data[:1000], self.modified)
+        download(self.serve('a.zip', data), self.directory)
+        self.assertEqual(self.server.requests[0][1]['Range'], 'bytes=1000-')
+        self.assertEqual(self.server.statuses, [206])
+        self.assertEqual(self.read('a.zip'), data)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'a.zip.part')))
+
+    def test_resume_changed_file(self):
+        # The partial download is from an older copy, If-Range makes the server send the whole file again
+        data = self.zip_data('a.txt')
+        self.write_part('a.zip', b'x' * 1000, self.modified - 3600)
+        download(self.serve('a.zip', data), self.directory)
+        self.assertEqual(self.server.statuses, [200])
+        self.assertEqual(self.read('a.zip'), data)
+
+    def test_stale_part(self):
+        data = b'a' * 1000
+        self.write_part('a.txt', data, self.modified)
+        download(self.serve('a.txt', data), self.directory)
+        self.assertEqual(self.server.statuses, [416, 200])
+        self.assertEqual(self.read('a.txt'), data)
+
+    def test_not_found(self):
+        url = self.serve('a.txt', b'a')
+        with self.assertRaises(DownloadError) as raised:
+            download(url.replace('a.txt', 'b.txt'), self.directory)
+        self.assertEqual(raised.exception.status, 404)
+
+    def test_truncated(self):
+        data = self.zip_data('a.txt')
+        url = self.serve('a.zip', data)
+        self.server.truncate.add('a.zip')
+        with self.assertRaises(DownloadError):
+            download(url, self.directory)
+        # What was received is kept and the next download resumes it
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'a.zip')))
+        self.assertEqual(self.read('a.zip.part'), data[:len(data) // 2])
+        self.server.truncate.clear()
+        download(url, self.directory)
+        self.assertEqual(self.server.statuses, [200, 206])
+        self.assertEqual(self.read('a.zip'), data)
+
+    def test_corrupted_zip(self):
+        url = self.serve('c.zip', b'x' * 100)
+        with self.assertRaises(DownloadError):
+            download(url, self.directory)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class ParsingTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_workers(self):
+        # Line breaks to str.splitlines, but not to the dumps
+        separators = [u'\x85', u'\u2028', u'\u2029', u'\x0b', u'\x0c', u'\x1c', u'\x1d', u'\x1e', u'\r']
+        lines = [u'{0}\t{1}\ten\tName{2}{1}\t\t\t\t\t\t\n'.format(i, 1000 + i, separators[i % len(separators)])
+                 for i in range(500)]
+        names = [u'Name{}{}'.format(separators[i % len(separators)], 1000 + i) for i in range(500)]
+        path = os.path.join(self.directory, 'alternateNames.txt')
+        with open(path, 'w', encoding='utf8', newline='') as fd:
+            fd.write(u''.join(lines))
+        with zipfile.ZipFile(path[:-len('.txt')] + '.zip', 'w') as archive:
+            archive.write(path, 'alternateNames.txt')
+
+        for path in (path, path[:-len('.txt')] + '.zip'):
+            serial = list(parse_file(path, AlternateNameParser()))
+            self.assertEqual([record.name for record in serial], names)
+            # Several blocks, cut in the middle of lines
+            self.assertEqual(list(parse_file(path, AlternateNameParser(), workers=2, chunk_size=1000)), serial)
+
+    def test_skip_lines(self):
+        path = os.path.join(self.directory, 'cities500.txt')
+        with open(path, 'w', encoding='utf8') as fd:
+            fd.write(u'header\u2028line\n')
+            for i in range(3):
+                fd.write(u'{}\tName\u2028{}\t\t\t1.5\t2.5\tP\tPPL\tES\t\t29\t\t\t\t{}\t\t10\tEurope/Madrid\t'
+                         u'2020-01-01\n'.format(i + 1, i, 1000 * i))
+        serial = list(parse_file(path, GeonameParser(), skip_lines=1))
+        self.assertEqual([record.name for record in serial], [u'Name\u20280', u'Name\u20281', u'Name\u20282'])
+        self.assertEqual(list(parse_file(path, GeonameParser(), workers=2, chunk_size=64, skip_lines=1)), serial)
+
+
+class LowMemoryTest(SimpleTestCase):
+    def test_geonameid_set(self):
+        geonameids = GeonameidSet([5, 3])
+        geonameids.add(9)
+        geonameids.add(3)
+        self.assertEqual(len(geonameids), 3)
+        self.assertEqual([geonameid in geonameids for geonameid in (1, 3, 5, 7, 9, 10)],
+                         [False, True, True, False, True, False])
+        geonameids.add(1)
+        self.assertIn(1, geonameids)
+        self.assertEqual(list(geonameids.geonameids), [1, 3, 5, 9])
+        self.assertNotIn(1, GeonameidSet())
+
+    def test_recent_names(self):
+        names = RecentNames()
+        self.assertFalse(names.seen(1, 'Madrid'))
+        self.assertTrue(names.seen(1, 'Madrid'))
+        self.assertFalse(names.seen(1, 'Madrid City'))
+        self.assertFalse(names.seen(2, 'Madrid'))
+
+    def test_recent_names_window(self):
+        names = RecentNames(2)
+        self.assertFalse(names.seen(1, 'a'))
+        self.assertFalse(names.seen(2, 'b'))
+        # Using 1 again keeps it among the last two
+        self.assertTrue(names.seen(1, 'a'))
+        self.assertFalse(names.seen(3, 'c'))
+        self.assertEqual(list(names.names), [1, 3])
+        self.assertTrue(names.seen(1, 'a'))
+        # 2 was forgotten
+        self.assertFalse(names.seen(2, 'b'))
+
+
+class RecorderTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.events = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load_things(self, day=None):
+        self.recorder.progress(3)
+        self.recorder.add_rows(3)
+        self.recorder.add_rows(2)
+        return day
+
+    def test_events(self):
+        path = os.path.join(self.directory, 'progress.jsonl')
+        self.recorder = Recorder(path, self.events.append, ['load_things'], self.directory)
+        with self.assertLogs('geonames.loading', 'INFO') as logs:
+            self.assertEqual(self.recorder.run(self.load_things, '2020-01-01'), '2020-01-01')
+            self.recorder.done()
+
+        self.assertEqual([(event['event'], event.get('phase')) for event in self.events],
+                         [('start', 'load_things:2020-01-01'), ('progress', 'load_things:2020-01-01'),
+                          ('end', 'load_things:2020-01-01'), ('done', None)])
+        self.assertEqual(self.events[1]['rows'], 3)
+        end = self.events[2]
+        self.assertEqual(end['rows'], 5)
+        self.assertEqual(end['queries'], 0)
+        for key in ('wall_seconds', 'cpu_seconds', 'rows_per_second', 'query_seconds', 'peak_rss_kb', 'time'):
+            self.assertIn(key, end)
+        self.assertGreater(self.events[3]['peak_rss_kb'], 0)
+
+        # The same events logged and in the progress file, one JSON per line
+        self.assertEqual([json.loads(record.split(':', 2)[2]) for record in logs.output], self.events)
+        with open(path) as fd:
+            self.assertEqual([json.loads(line) for line in fd], self.events)
+
+        # The profile of the phase
+        self.assertEqual(end['profile'], os.path.join(self.directory, 'load_things-2020-01-01.prof'))
+        self.assertIn('load_things', str(pstats.Stats(end['profile']).stats))
+
+    def test_failed_phase(self):
+        self.recorder = Recorder(callback=self.events.append)
+
+        def fail():
+            self.recorder.add_rows(1)
+            raise ValueError('broken')
+        with self.assertRaises(ValueError):
+            self.recorder.run(fail)
+        self.assertEqual([event['event'] for event in self.events], ['start', 'end'])
+        self.assertEqual(self.events[1]['rows'], 1)
+        self.assertNotIn('profile', self.events[1])
+        self.assertIsNone(self.recorder.phase)
+
+    def test_query_stats(self):
+        stats = QueryStats()
+        self.assertEqual(stats(lambda *args: 'result', 'SELECT 1', None, False, {}), 'result')
+        with self.assertRaises(ValueError):
+            stats(lambda *args: int('x'), 'SELECT x', None, False, {})
+        self.assertEqual(stats.count, 2)
+        self.assertGreaterEqual(stats.seconds, 0)
+
+
+class StringTest(SimpleTestCase):
+    def test_str(self):
+        country = Country(code='ES', name='Spain')
+        admin1 = Admin1Code(geonameid=1, code='29', name='Madrid', country=country)
+        admin2 = Admin2Code(geonameid=2, code='28', name='Getafe area', country=country, admin1=admin1)
+        self.assertEqual(str(country), 'Spain')
+        self.assertEqual(str(admin1), 'Madrid, Spain')
+        self.assertEqual(str(admin2), 'Getafe area, Madrid, Spain')
+        # Rendered from the stored display name, without queries
+        self.assertEqual(str(Locality(name='Getafe', display_name='Getafe, Madrid, Spain')), 'Getafe, Madrid, Spain')
+
+
+class AutocompleteIndexTest(SimpleTestCase):
+    def setUp(self):
+        rnd = random.Random(0)
+        syllables = ['ma', 'mo', 'sa', 'san', 'to', 'la', 'ri']
+        self.localities = [(geonameid, u''.join(rnd.choice(syllables) for i in range(3)), rnd.randint(0, 1000),
+                            rnd.choice(['ES', 'FR']), rnd.randint(1, 5)) for geonameid in range(1, 1001)]
+        self.alternate_names = [(rnd.randint(1, 1000), u''.join(rnd.choice(syllables) for i in range(2)))
+                                for i in range(2000)]
+        self.index = AutocompleteIndex(iter(self.localities), iter(self.alternate_names))
+
+    def expected(self, prefix, limit=10, country=None, admin1=None):
+        names = dict((geonameid, set([name])) for geonameid, name, population, country_id, admin1_id in self.localities)
+        for geonameid, name in self.alternate_names:
+            names[geonameid].add(name)
+        found = [(-population, geonameid) for geonameid, name, population, country_id, admin1_id in self.localities
+                 if any(name.startswith(prefix) for name in names[geonameid])
+                 and country in (None, country_id) and admin1 in (None, admin1_id)]
+        return [geonameid for population, geonameid in sorted(found)[:limit]]
+
+    def test_search(self):
+        for prefix in ['m', 'ma', 'san', 'sanma', 'tolari', 'x']:
+            self.assertEqual(self.index.search(prefix), self.expected(prefix))
+            self.assertEqual(self.index.search(prefix, 50, country='FR'), self.expected(prefix, 50, country='FR'))
+            self.assertEqual(self.index.search(prefix, 5, country='ES', admin1=3),
+                             self.expected(prefix, 5, country='ES', admin1=3))
+        self.assertEqual(self.index.search(u'SÁN'), self.expected('san'))
+        self.assertEqual(self.index.search('ma', country='IT'), [])
+
+    def test_scan(self):
+        self.assertEqual(self.index.search('m', admin1=2), self.expected('m', admin1=2))
+        # Taken from the tree, then scanned when the admin1 is too rare
+        self.index.world.scan_length = 10
+        self.assertEqual(self.index.search('m', admin1=2), self.expected('m', admin1=2))
+        self.assertEqual(self.index.search('s', 3, admin1=4), self.expected('s', 3, admin1=4))
+
+
+class DistanceTest(SimpleTestCase):
+    # London, Paris, New York and the point opposite London
+    latitudes = [51.5074, 48.8566, 40.7128, -51.5074]
+    longitudes = [-0.1278, 2.3522, -74.0060, 179.8722]
+
+    def test_haversine(self):
+        self.assertAlmostEqual(haversine(51.5074, -0.1278, 48.8566, 2.3522), 213.5, delta=1)
+        self.assertAlmostEqual(haversine(51.5074, -0.1278, 40.7128, -74.0060), 3461, delta=5)
+        self.assertEqual(haversine(51.5074, -0.1278, 51.5074, -0.1278), 0)
+        # Half the circumference, for antipodal points and between the poles
+        self.assertAlmostEqual(haversine(51.5074, -0.1278, -51.5074, 179.8722), pi * EARTH_RADIUS_MI, places=6)
+        self.assertAlmostEqual(haversine(90, 0, -90, 0), pi * EARTH_RADIUS_MI, places=6)
+        self.assertAlmostEqual(haversine(0, 179.9, 0, -179.9), 0.2 * pi * EARTH_RADIUS_MI / 180, places=6)
+        self.assertAlmostEqual(haversine(51.5074, -0.1278, 48.8566, 2.3522, radius=6371.0), 343.5, delta=1)
+
+    def check(self):
+        from geonames.distance import distance_matrix, distances, within_radius, within_radius_many
+        matrix = distance_matrix(self.latitudes, self.longitudes, self.latitudes, self.longitudes)
+        for i in range(4):
+            for j in range(4):
+                self.assertAlmostEqual(float(matrix[i][j]), haversine(self.latitudes[i], self.longitudes[i],
+                                                                      self.latitudes[j], self.longitudes[j]),
+                                       places=6)
+        self.assertEqual([round(float(d), 6) for d in distances(51.5074, -0.1278, self.latitudes, self.longitudes)],
+                         [round(float(d), 6) for d in matrix[0]])
+
+        ids, found = within_radius(51.5074, -0.1278, [1, 2, 3, 4], self.latitudes, self.longitudes, 4000)
+        self.assertEqual(ids, [1, 2, 3])
+        self.assertEqual(found[0], 0)
+        self.assertAlmostEqual(found[1], 213.5, delta=1)
+        self.assertEqual(within_radius(51.5074, -0.1278, [], [], [], 4000), ([], []))
+        results = within_radius_many([48.8566, 0], [2.3522, 0], [1, 2, 3, 4], self.latitudes, self.longitudes, 300)
+        self.assertEqual([ids for ids, found in results], [[2, 1], []])
+
+    def test_numpy(self):
+        if np is None:
+            self.skipTest("NumPy is not installed")
+        self.check()
+
+    def test_python(self):
+        numpy = geonames.distance.np
+        geonames.distance.np = None
+        try:
+            self.check()
+        finally:
+            geonames.distance.np = numpy
+
+
+@unittest.skipIf(np is None, "The spatial index needs NumPy")
+class GridIndexTest(SimpleTestCase):
+    def setUp(self):
+        rnd = random.Random(0)
+        self.points = []
+        for geonameid in range(1, 3001):
+            kind = geonameid % 3
+            if kind == 0:
+                # Around the poles
+                latitude, longitude = rnd.choice([-1, 1]) * rnd.uniform(85, 90), rnd.uniform(-180, 180)
+            elif kind == 1:
+                # On both sides of the antimeridian
+                latitude, longitude = rnd.uniform(-80, 80), rnd.choice([-1, 1]) * rnd.uniform(175, 180)
+            else:
+                latitude, longitude = rnd.uniform(-90, 90), rnd.uniform(-180, 180)
+            self.points.append((geonameid, latitude, longitude, rnd.randint(0, 10000)))
+        self.index = GridIndex(*zip(*self.points))
+        self.queries = [(rnd.choice([-1, 1]) * rnd.uniform(80, 90), rnd.uniform(-180, 180)) for i in range(30)]
+        self.queries += [(rnd.uniform(-80, 80), rnd.choice([-1, 1]) * rnd.uniform(170, 180)) for i in range(30)]
+        self.queries += [(rnd.uniform(-90, 90), rnd.uniform(-180, 180)) for i in range(30)]
+        self.queries += [(90, 0), (-90, 0), (0, 180), (0, -180)]
+
+    def scan(self, latitude, longitude, min_population=None):
+        """ ``(distance, geonameid)`` of every point, the closest first """
+        return sorted((haversine(latitude, longitude, point_latitude, point_longitude), geonameid)
+                      for geonameid, point_latitude, point_longitude, population in self.points
+                      if min_population is None or population >= min_population)
+
+    def test_within_radius(self):
+        for latitude, longitude in self.queries:
+            scanned = self.scan(latitude, longitude)
+            for miles in (1, 50, 300, 1000, 6000):
+                ids, distances = self.index.within_radius(latitude, longitude, miles)
+                expected = [(distance, geonameid) for distance, geonameid in scanned if distance <= miles]
+                self.assertEqual(ids, [geonameid for distance, geonameid in expected])
+                for distance, (expected_distance, geonameid) in zip(distances, expected):
+                    self.assertAlmostEqual(distance, expected_distance, places=6)
+            self.assertEqual(len(self.index.within_radius(latitude, longitude, 13000)[0]), len(self.points))
+
+    def test_min_population(self):
+        for latitude, longitude in self.queries:
+            ids, distances = self.index.within_radius(latitude, longitude, 1000, min_population=5000)
+            self.assertEqual(ids, [geonameid for distance, geonameid in self.scan(latitude, longitude, 5000)
+                                   if distance <= 1000])
+
+    def test_nearest(self):
+        for latitude, longitude in self.queries:
+            for k, min_population in ((1, None), (5, None), (5, 9000), (20, 9900)):
+                ids, distances = self.index.nearest(latitude, longitude, k, min_population)
+                expected = self.scan(latitude, longitude, min_population)[:k]
+                self.assertEqual(ids, [geonameid for distance, geonameid in expected])
+        # Fewer points than asked for
+        self.assertEqual(len(self.index.nearest(0, 0, 5000)[0]), len(self.points))
+
+
+class ReferenceCacheTest(TestCase):
+    def setUp(self):
+        invalidate_all()
+        currency = Currency.objects.create(code='EUR', name='Euro')
+        self.country = Country.objects.create(code='ES', name='Spain', currency=currency)
+        self.timezone = Timezone.objects.create(name='Europe/Madrid', gmt_offset=1, dst_offset=2)
+
+    def tearDown(self):
+        invalidate_all()
+
+    def test_missing_instance(self):
+        self.assertEqual(Admin1Code.objects.cached_all(), {})
+        # Written without signals, as another process or a bulk load does
+        Admin1Code.objects.bulk_create([Admin1Code(geonameid=1, code='29', name='Madrid', country=self.country)])
+        self.assertEqual(Admin1Code.objects.cached_get(1).name, 'Madrid')
+        self.assertEqual(Admin1Code.objects.cached_by_country_code('ES', '29').pk, 1)
+        self.assertIn(1, Admin1Code.objects.cached_all())
+        with self.assertRaises(Admin1Code.DoesNotExist):
+            Admin1Code.objects.cached_get(2)
+
+    def test_save_reads_the_data_base(self):
+        Admin1Code.objects.create(geonameid=1, code='29', name='Madrid', country=self.country)
+        self.assertEqual(Admin1Code.objects.cached_get(1).name, 'Madrid')
+        # Renamed by another process
+        Admin1Code.objects.filter(pk=1).update(name='Comunidad de Madrid')
+        locality = Locality(geonameid=10, name='Getafe', country_id='ES', admin1_id=1, timezone=self.timezone,
+                            population=1, latitude=40.3, longitude=-3.7, modification_date='2020-01-01')
+        locality.save()
+        self.assertEqual(locality.long_name, 'Getafe, Comunidad de Madrid')
+        self.assertEqual(locality.display_name, 'Getafe, Comunidad de Madrid, Spain')
+
+
+class CommandTest(SimpleTestCase):
+    def test_state(self):
+        command = Command()
+        command.countries['ES'] = {}
+        command.admin_names[1] = 'Madrid'
+        command.country_names['ES'] = 'Spain'
+        command.localities.add(1)
+        # A second run in the same process starts empty
+        other = Command()
+        self.assertEqual((other.countries, other.admin_names, other.country_names, other.localities),
+                         ({}, {}, {}, set()))
+
+
+class ReverseGeocodeTest(TestCase):
+    def setUp(self):
+        invalidate_all()
+        currency = Currency.objects.create(code='EUR', name='Euro')
+        spain = Country.objects.create(code='ES', name='Spain', currency=currency)
+        france = Country.objects.create(code='FR', name='France', currency=currency)
+        madrid = Timezone.objects.create(name='Europe/Madrid', gmt_offset=1, dst_offset=2)
+        paris = Timezone.objects.create(name='Europe/Paris', gmt_offset=1, dst_offset=2)
+        admin1 = Admin1Code.objects.create(geonameid=1, code='29', name='Madrid', country=spain)
+        admin2 = Admin2Code.objects.create(geonameid=2, code='28', name='Madrid area', country=spain, admin1=admin1)
+        ile_de_france = Admin1Code.objects.create(geonameid=3, code='11', name='Ile-de-France', country=france)
+
+        def create(geonameid, name, country, admin1, admin2, timezone, population, latitude, longitude, **kwargs):
+            return Locality.objects.create(geonameid=geonameid, name=name, country=country, admin1=admin1,
+                                           admin2=admin2, timezone=timezone, population=population,
+                                           latitude=latitude, longitude=longitude,
+                                           modification_date='2020-01-01', **kwargs)
+        self.madrid = create(10, 'Madrid', spain, admin1, admin2, madrid, 3000000, 40.4168, -3.7038)
+        self.getafe = create(11, 'Getafe', spain, admin1, admin2, madrid, 180000, 40.3057, -3.7329)
+        self.toledo = create(12, 'Toledo', spain, None, None, madrid, 85000, 39.8628, -4.0273)
+        self.paris = create(13, 'Paris', france, ile_de_france, None, paris, 2000000, 48.8566, 2.3522)
+        # Not public, so never found
+        create(14, 'Getafe', spain, admin1, admin2, madrid, 1000, 40.30, -3.73,
+               status=Locality.objects.STATUS_DISABLED)
+
+    def tearDown(self):
+        invalidate_all()
+
+    def test_reverse_geocode(self):
+        self.assertEqual(Locality.objects.reverse_geocode(40.30, -3.73), [self.getafe])
+        self.assertEqual(Locality.objects.reverse_geocode(40.30, -3.73, k=3), [self.getafe, self.madrid, self.toledo])
+        self.assertEqual(Locality.objects.reverse_geocode(40.30, -3.73, min_population=1000000), [self.madrid])
+        # Far from all of them, from Sydney
+        self.assertEqual(Locality.objects.reverse_geocode(-33.9, 151.2, k=10),
+                         [self.paris, self.madrid, self.getafe, self.toledo])
+        # The admin levels, country and timezone come with the locality
+        locality = Locality.objects.reverse_geocode(48.85, 2.35)[0]
+        with self.assertNumQueries(0):
+            self.assertEqual((locality.admin1.name, locality.admin2, locality.country.name, locality.timezone.name),
+                             ('Ile-de-France', None, 'France', 'Europe/Paris'))
+
+    def test_nothing_found(self):
+        self.assertEqual(Locality.objects.reverse_geocode(40.30, -3.73, min_population=10 ** 9), [])
+        self.assertEqual(Locality.objects.reverse_geocode_many([(40.30, -3.73)], min_population=10 ** 9), [None])
+        self.assertEqual(Locality.objects.within_radius(0, 0, 100), ([], []))
+        self.assertEqual(Locality.objects.reverse_geocode_many([]), [])
+
+    def test_reverse_geocode_many(self):
+        points = [(40.30, -3.73), (48.85, 2.35), (39.86, -4.02), (40.30, -3.73)]
+        self.assertEqual(Locality.objects.reverse_geocode_many(points), [self.getafe, self.paris, self.toledo,
+                                                                         self.getafe])
+        self.assertEqual(Locality.objects.reverse_geocode_many(points, min_population=1000000),
+                         [self.madrid, self.paris, self.madrid, self.madrid])
+        # One query per batch
+        with self.assertNumQueries(2):
+            localities = Locality.objects.reverse_geocode_many(points, batch=2)
+        self.assertEqual(localities, [self.getafe, self.paris, self.toledo, self.getafe])
+        with self.assertNumQueries(0):
+            self.assertEqual([locality.country.name for locality in localities], ['Spain', 'France', 'Spain', 'Spain'])
+
+
+@unittest.skipUnless(connection.vendor in ('postgresql', 'sqlite'), "Only deferred on PostgreSQL and SQLite")
+class DeferredIndexesTest(TestCase):
+    models = [Admin1Code, Admin2Code, Locality, AlternateName]
+
+    def setUp(self):
+        invalidate_all()
+        currency = Currency.objects.create(code='EUR', name='Euro')
+        self.country = Country.objects.create(code='ES', name='Spain', currency=currency)
+        self.timezone = Timezone.objects.create(name='Europe/Madrid', gmt_offset=1, dst_offset=2)
+
+    def tearDown(self):
+        invalidate_all()
+
+    def constraints(self):
+        """ The names of the indexes and constraints of each table, as introspected """
+        with connection.cursor() as cursor:
+            return dict((model._meta.db_table, set(connection.introspection.get_constraints(
+                cursor, model._meta.db_table))) for model in self.models)
+
+    def create(self, geonameid, name, **kwargs):
+        locality = Locality(geonameid=geonameid, name=name, country=self.country, timezone=self.timezone,
+                            population=1000, latitude=40.4, longitude=-3.7, modification_date='2020-01-01', **kwargs)
+        locality.save()
+        return locality
+
+    def test_drop_and_restore(self):
+        before = self.constraints()
+        deferred = DeferredIndexes(self.models, keep_unique=[AlternateName])
+        self.assertGreater(deferred.drop(), 0)
+        dropped = self.constraints()
+        table = Locality._meta.db_table
+        for name in ('geonames_locality_unique_long_name', 'geonames_locality_search', 'geonames_locality_country'):
+            self.assertIn(name, before[table])
+            self.assertNotIn(name, dropped[table])
+        # The unique constraint the low memory load relies on stays
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, AlternateName._meta.db_table).values()
+        unique = [constraint['columns'] for constraint in constraints
+                  if constraint['unique'] and not constraint['primary_key']]
+        self.assertIn(['locality_id', 'name'], unique)
+
+        Admin1Code.objects.create(geonameid=1, code='29', name='Madrid', country=self.country)
+        for geonameid in range(10, 20):
+            locality = self.create(geonameid, 'Locality {}'.format(geonameid), admin1_id=1)
+            AlternateName.objects.create(alternatenameid=geonameid, locality=locality, name='Name')
+        # A disabled duplicate, allowed by the partial unique constraint
+        self.create(20, 'Locality 10', admin1_id=1, status=Locality.objects.STATUS_DISABLED)
+
+        deferred.restore()
+        deferred.verify()
+        self.assertEqual(deferred.dropped, [])
+        self.assertEqual(self.constraints(), before)
+        # The partial unique constraint is back
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.create(21, 'Locality 11', admin1_id=1)
+        self.create(22, 'Locality 11', admin1_id=1, status=Locality.objects.STATUS_DISABLED)
+
+    def test_restore_checks_the_rows(self):
+        deferred = DeferredIndexes(self.models)
+        deferred.drop()
+        self.create(10, 'Getafe')
+        self.create(11, 'Getafe')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            deferred.restore()
+
+    def test_verify(self):
+        deferred = DeferredIndexes(self.models)
+        deferred.drop()
+        deferred.dropped.append((Locality._meta.db_table, 'geonames_locality_missing', 'SELECT 1'))
+        deferred.restore()
+        with self.assertRaisesMessage(Exception, 'geonames_locality_missing'):
+            deferred.verify()
+
+
+class WriterTest(SimpleTestCase):
+    fields = ('status', 'code', 'name')
+
+    def test_format(self):
+        self.assertEqual(CopyWriter.format(None), '\\N')
+        self.assertEqual(CopyWriter.format(12), '12')
+        self.assertEqual(CopyWriter.format(1.5), '1.5')
+        self.assertEqual(CopyWriter.format(u'Málaga'), u'Málaga')
+        self.assertEqual(CopyWriter.format('a\tb'), 'a\\tb')
+        self.assertEqual(CopyWriter.format('a\\b'), 'a\\\\b')
+        self.assertEqual(CopyWriter.format('a\nb\r'), 'a\\nb\\r')
+        # The backslashes of the value are escaped before the ones added for the tabs
+        self.assertEqual(CopyWriter.format('\\t\t'), '\\\\t\\t')
+        # Only None is NULL, not its text
+        self.assertEqual(CopyWriter.format('\\N'), '\\\\N')
+
+    def test_copy_buffer(self):
+        writer = CopyWriter(Currency, self.fields, batch=10)
+        writer.write((1, 'EUR', 'Euro\tzone'))
+        writer.write((1, 'XXX', None))
+        self.assertEqual(writer.buffer.getvalue(), '1\tEUR\tEuro\\tzone\n1\tXXX\t\\N\n')
+        self.assertEqual(writer.pending, 2)
+        self.assertIn('COPY', writer.sql)
+        self.assertIsNone(writer.finish_sql)
+
+    def test_copy_ignore_conflicts(self):
+        writer = CopyWriter(Currency, self.fields, ignore_conflicts=True)
+        table = connection.ops.quote_name(Currency._meta.db_table)
+        staging = connection.ops.quote_name('{}_copy'.format(Currency._meta.db_table))
+        self.assertEqual(writer.sql.split(' ', 2)[1], staging)
+        self.assertTrue(writer.finish_sql.startswith('INSERT INTO {} '.format(table)))
+        self.assertTrue(writer.finish_sql.endswith('FROM {} ON CONFLICT DO NOTHING'.format(staging)))
+
+    def test_get_writer(self):
+        with self.assertRaises(ValueError):
+            get_writer(Currency, self.fields, 'csv')
+        self.assertIsInstance(get_writer(Currency, self.fields, 'bulk'), BulkCreateWriter)
+        self.assertIsInstance(get_writer(Currency, self.fields, 'copy'), CopyWriter)
+        writer = get_writer(Currency, self.fields, batch=5, ignore_conflicts=True)
+        self.assertEqual(writer.batch, 5)
+        if connection.vendor == 'postgresql':
+            self.assertIsInstance(writer, CopyWriter)
+            self.assertIsNotNone(writer.finish_sql)
+        else:
+            self.assertIsInstance(writer, BulkCreateWriter)
+            self.assertTrue(writer.ignore_conflicts)
+
+    def test_build_instance(self):
+        locality = build_instance(Locality, ('geonameid', 'name', 'point'), (1, u'Paris', point_ewkt(2.35, 48.85)))
+        self.assertEqual(locality.geonameid, 1)
+        self.assertEqual((locality.point.x, locality.point.y, locality.point.srid), (2.35, 48.85, 4326))
+        self.assertIsNone(build_instance(Locality, ('point',), (None,)).point)
+
+
+class BulkCreateWriterTest(TestCase):
+    fields = ('status', 'code', 'name')
+
+    def test_batches(self):
+        enabled = Currency.objects.STATUS_ENABLED
+        with BulkCreateWriter(Currency, self.fields, batch=2) as writer:
+            writer.write((enabled, 'EUR', 'Euro'))
+            writer.write((enabled, 'USD', 'Dollar'))
+            # Saved once the batch is full
+            self.assertEqual(writer.written, 2)
+            self.assertEqual(Currency.objects.count(), 2)
+            writer.write((enabled, 'GBP', 'Pound'))
+            self.assertEqual(writer.written, 2)
+        self.assertEqual(writer.written, 3)
+        self.assertEqual(sorted(Currency.objects.values_list('code', flat=True)), ['EUR', 'GBP', 'USD'])
+
+    def test_ignore_conflicts(self):
+        enabled = Currency.objects.STATUS_ENABLED
+        Currency.objects.create(code='EUR', name='Euro')
+        with BulkCreateWriter(Currency, self.fields, ignore_conflicts=True) as writer:
+            writer.write((enabled, 'EUR', 'Other'))
+            writer.write((enabled, 'USD', 'Dollar'))
+        self.assertEqual(dict(Currency.objects.values_list('code', 'name')), {'EUR': 'Euro', 'USD': 'Dollar'})
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                with BulkCreateWriter(Currency, self.fields) as writer:
+                    writer.write((enabled, 'EUR', 'Other'))
+
+    def test_error_discards_the_batch(self):
+        # Leaving with an error does not save what is pending
+        with self.assertRaises(Interrupted):
+            with BulkCreateWriter(Currency, self.fields) as writer:
+                writer.write((Currency.objects.STATUS_ENABLED, 'EUR', 'Euro'))
+                raise Interrupted()
+        self.assertFalse(Currency.objects.exists())
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "COPY is only used on PostgreSQL")
+class CopyQueryCountTest(TestCase):
+    fields = ('status', 'code', 'name')
+
+    def test_copy_is_counted(self):
+        enabled = Currency.objects.STATUS_ENABLED
+        stats = QueryStats()
+        with connection.execute_wrapper(stats):
+            with get_writer(Currency, self.fields, 'copy') as writer:
+                writer.write((enabled, 'EUR', 'Euro'))
+        self.assertEqual(stats.count, 1)
+        # Into a temporary table, then moved: two setup statements, the COPY and the INSERT
+        stats = QueryStats()
+        with connection.execute_wrapper(stats):
+            with get_writer(Currency, self.fields, 'copy', ignore_conflicts=True) as writer:
+                writer.write((enabled, 'EUR', 'Euro'))
+                writer.write((enabled, 'USD', 'Dollar'))
+        self.assertEqual(stats.count, 4)
+        self.assertEqual(sorted(Currency.objects.values_list('code', flat=True)), ['EUR', 'USD'])
+
+
+class BenchmarkTest(TestCase):
+    def test_report(self):
+        out = io.StringIO()
+        call_command('benchmarkgeonames', localities=200, iterations=5, output='-', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['meta']['localities'], 200)
+        self.assertIn('peak_rss_kb', report)
+        self.assertIn('load.load_localities', report['results'])
+        self.assertIn('search.autocomplete', report['results'])
+        self.assertIn('radius.near_localities', report['results'])
+        for name, result in report['results'].items():
+            self.assertNotIn('error', result, name)
+            self.assertEqual(list(result), ['calls', 'seconds', 'ops_per_second', 'p50_ms', 'p95_ms', 'p99_ms',
+                                            'max_ms', 'queries', 'query_seconds', 'peak_rss_kb'], name)
+        # Rolled back
+        self.assertFalse(Locality.objects.exists())
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptedCommand(Command):
+    """ Stops while loading the alternate names, once their first batch is committed """
+    batch = 100
+
+    def load_altnames(self):
+        advance = self.checkpoints.advance
+
+        def interrupt(phase, offset):
+            advance(phase, offset)
+            if offset > self.batch:
+                raise Interrupted()
+        self.checkpoints.advance = interrupt
+        super(InterruptedCommand, self).load_altnames()
+
+
+class LoaderTest(TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        self.names = generate_dumps(self.directory, localities=200)
+        invalidate_all()
+
+    def tearDown(self):
+        # The loader changes to the data directory
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+        invalidate_all()
+
+    def alternate_names(self):
+        """ The distinct names of the loaded localities in the alternate names dump """
+        geonameids = set(Locality.objects.values_list('geonameid', flat=True))
+        return set((geonameid, name) for alternatenameid, geonameid, name in parse_file(
+            os.path.join(self.directory, 'alternateNames.zip'), AlternateNameParser(geonameids)))
+
+    def assertLoaded(self):
+        self.assertEqual(Locality.objects.count(), len(self.names))
+        self.assertFalse(Locality.objects.filter(timezone__isnull=True).exists())
+        long_names = list(Locality.objects.public().values_list('country_id', 'long_name'))
+        self.assertEqual(len(set(long_names)), len(long_names))
+        self.assertEqual(set(AlternateName.objects.values_list('locality_id', 'name')), self.alternate_names())
+        self.assertEqual(GeonamesUpdate.objects.count(), 1)
+        self.assertFalse(GeonamesCheckpoint.objects.exists())
+
+    def test_load(self):
+        call_command('loadgeonames', data_dir=self.directory)
+        self.assertLoaded()
+        self.assertEqual(Country.objects.count(), 10)
+        self.assertEqual(Admin1Code.objects.count(), 50)
+        self.assertEqual(Admin2Code.objects.count(), 200)
+
+    def duplicate_names(self):
+        """ Repeats some names of the alternate names dump, right after them and at its end """
+        path = os.path.join(self.directory, 'alternateNames.zip')
+        with zipfile.ZipFile(path) as archive:
+            lines = archive.read('alternateNames.txt').decode('utf8').splitlines(True)
+        alternatenameid = max(int(line.split('\t')[0]) for line in lines)
+        duplicated = []
+        repeated = []
+        for i, line in enumerate(lines):
+            duplicated.append(line)
+            if i % 10 == 0:
+                alternatenameid += 1
+                duplicated.append(u'{}\t{}'.format(alternatenameid, line.split('\t', 1)[1]))
+            if i % 10 == 5:
+                repeated.append(line.split('\t', 1)[1])
+        for line in repeated:
+            alternatenameid += 1
+            duplicated.append(u'{}\t{}'.format(alternatenameid, line))
+        write_zip(self.directory, 'alternateNames', duplicated)
+
+    def loaded(self):
+        """ What the load wrote, to compare between its modes """
+        return (set(Locality.objects.values_list('geonameid', 'status', 'long_name', 'display_name', 'search_name',
+                                                 'timezone_id', 'admin1_id', 'admin2_id')),
+                set(AlternateName.objects.values_list('alternatenameid', 'locality_id', 'name', 'search_name')))
+
+    def test_low_memory(self):
+        self.duplicate_names()
+        call_command('loadgeonames', data_dir=self.directory)
+        self.assertLoaded()
+        loaded = self.loaded()
+        for model in (AlternateName, Locality, Admin2Code, Admin1Code, Country, Currency, Language, Timezone,
+                      GeonamesUpdate):
+            model.objects.all().delete()
+        invalidate_all()
+
+        # Only the names of the last two localities are remembered, the data base skips the older duplicates
+        command = Command()
+        command.altnames_window = 2
+        call_command(command, data_dir=self.directory, low_memory=True)
+        self.assertLoaded()
+        self.assertEqual(self.loaded(), loaded)
+
+    def test_progress_file(self):
+        path = os.path.join(self.directory, 'progress.jsonl')
+        call_command('loadgeonames', data_dir=self.directory, progress_file=path, profile='load_localities',
+                     profile_dir=self.directory)
+        with open(path) as fd:
+            events = [json.loads(line) for line in fd]
+        ends = dict((event['phase'], event) for event in events if event['event'] == 'end')
+        self.assertEqual(sorted(ends), ['check_errors', 'cleanup', 'download_files', 'load_admin1', 'load_admin2',
+                                        'load_altnames', 'load_countries', 'load_languagecodes', 'load_localities',
+                                        'load_timezones'])
+        self.assertEqual(events[-1]['event'], 'done')
+        self.assertEqual(ends['load_localities']['rows'], len(self.names))
+        self.assertGreater(ends['load_localities']['queries'], 0)
+        self.assertEqual(ends['load_altnames']['rows'], AlternateName.objects.count())
+        self.assertTrue(os.path.exists(ends['load_localities']['profile']))
+        self.assertNotIn('profile', ends['load_timezones'])
+
+    def test_update(self):
+        call_command('loadgeonames', data_dir=self.directory)
+        GeonamesUpdate.objects.update(update_date=datetime.date.today() - datetime.timedelta(days=1))
+        changed, removed = Locality.objects.public().order_by('geonameid')[:2]
+        Locality.objects.filter(pk=changed.pk).update(name='Renamed', modification_date=datetime.date(2019, 1, 1))
+        with zipfile.ZipFile(os.path.join(self.directory, 'cities500.zip')) as archive:
+            lines = archive.read('cities500.txt').decode('utf8').splitlines(True)
+        write_zip(self.directory, 'cities500', [line for line in lines
+                                                if not line.startswith('{}\t'.format(removed.pk))])
+
+        # Without the daily files, the localities are compared with the dump
+        call_command('loadgeonames', data_dir=self.directory, update=True)
+        self.assertEqual(Locality.objects.get(pk=changed.pk).name, changed.name)
+        self.assertEqual(Locality.objects.get(pk=changed.pk).status, Locality.objects.STATUS_ENABLED)
+        self.assertEqual(Locality.objects.get(pk=removed.pk).status, Locality.objects.STATUS_DISABLED)
+        self.assertEqual(GeonamesUpdate.objects.count(), 2)
+
+    def test_update_daily_files(self):
+        call_command('loadgeonames', data_dir=self.directory)
+        day = datetime.date.today() - datetime.timedelta(days=1)
+        GeonamesUpdate.objects.update(update_date=day)
+        changed, deleted, copied = Locality.objects.public().order_by('geonameid')[:3]
+        with zipfile.ZipFile(os.path.join(self.directory, 'cities500.zip')) as archive:
+            lines = dict((int(line.split('\t', 1)[0]), line.rstrip('\n').split('\t'))
+                         for line in archive.read('cities500.txt').decode('utf8').splitlines())
+        modified = lines[changed.pk]
+        modified[1] = modified[2] = 'Renamed Place'
+        modified[18] = day.isoformat()
+        added = lines[copied.pk]
+        added[0] = '99999999'
+        added[1] = added[2] = 'Brand New Place'
+        removed_name = AlternateName.objects.order_by('alternatenameid').first()
+
+        # Stand-ins for the daily files of geonames.org
+        def write(kind, rows):
+            with open(os.path.join(self.directory, '{}-{}.txt'.format(kind, day.isoformat())), 'w',
+                      encoding='utf8') as fd:
+                fd.writelines(u'\t'.join(row) + u'\n' for row in rows)
+        write('modifications', [modified, added])
+        write('deletes', [[str(deleted.pk), deleted.name, 'duplicate']])
+        write('alternateNamesModifications', [['99999999', '99999999', 'en', 'New Place', '', '', '', '', '', '']])
+        write('alternateNamesDeletes', [[str(removed_name.pk), str(removed_name.locality_id), 'wrong']])
+
+        call_command('loadgeonames', data_dir=self.directory, update=True)
+        self.assertEqual(Locality.objects.get(pk=changed.pk).name, 'Renamed Place')
+        self.assertEqual(Locality.objects.get(pk=changed.pk).search_name, 'renamed place')
+        self.assertEqual(Locality.objects.get(pk=deleted.pk).status, Locality.objects.STATUS_DISABLED)
+        new = Locality.objects.get(pk=99999999)
+        self.assertEqual(new.name, 'Brand New Place')
+        self.assertEqual(new.status, Locality.objects.STATUS_ENABLED)
+        self.assertEqual(new.country_id, copied.country_id)
+        self.assertEqual(list(new.alternatename_set.values_list('name', flat=True)), ['New Place'])
+        self.assertFalse(AlternateName.objects.filter(pk=removed_name.pk).exists())
+        self.assertEqual(GeonamesUpdate.objects.count(), 2)
+
+    def test_resume(self):
+        with self.assertRaises(Interrupted):
+            call_command(InterruptedCommand(), data_dir=self.directory)
+        self.assertTrue(GeonamesCheckpoint.objects.get(phase='load_localities').completed)
+        self.assertEqual(GeonamesCheckpoint.objects.get(phase='load_altnames').offset, 100)
+        self.assertFalse(GeonamesUpdate.objects.exists())
+
+        call_command('loadgeonames', resume=True)
+        self.assertLoaded()
+
+
+class SearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cwd = os.getcwd()
+        directory = tempfile.mkdtemp()
+        try:
+            generate_dumps(directory, localities=200)
+            call_command('loadgeonames', data_dir=directory)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+
+    def setUp(self):
+        invalidate_all()
+        self.localities = list(Locality.objects.public().select_related('admin1', 'admin2', 'country').order_by(
+            'geonameid')[:20])
+
+    def tearDown(self):
+        invalidate_all()
+
+    def test_resolve_many(self):
+        alternate = AlternateName.objects.select_related('locality').order_by('alternatenameid').first()
+        pairs = [(locality.country_id, locality.name.upper()) for locality in self.localities]
+        pairs.append((alternate.locality.country_id, alternate.name))
+        resolved = Locality.objects.resolve_many(pairs + [(self.localities[0].country_id, 'Nowhere at all')])
+        for country_code, name in pairs:
+            self.assertEqual(resolved[(country_code, name)],
+                             list(Country.objects.get(code=country_code).search_locality(name)))
+        for locality in self.localities:
+            self.assertIn(locality, resolved[(locality.country_id, locality.name.upper())])
+        self.assertIn(alternate.locality, resolved[(alternate.locality.country_id, alternate.name)])
+        self.assertEqual(resolved[(self.localities[0].country_id, 'Nowhere at all')], [])
+
+    def test_autocomplete(self):
+        for locality in self.localities:
+            prefix = locality.name[:3].upper()
+            found = Locality.objects.autocomplete(prefix)
+            in_admin1 = Locality.objects.autocomplete(prefix, 100, locality.country, locality.admin1)
+            self.assertIn(locality, in_admin1)
+            self.assertEqual([l.population for l in found], sorted((l.population for l in found), reverse=True))
+            # The data base gives the same results
+            with self.settings(GEONAMES_AUTOCOMPLETE_INDEX=False):
+                self.assertEqual(Locality.objects.autocomplete(prefix), found)
+                self.assertEqual(Locality.objects.autocomplete(prefix, 100, locality.country, locality.admin1),
+                                 in_admin1)
+        self.assertEqual(Locality.objects.autocomplete(''), [])
+
+    def test_fuzzy_search(self):
+        for locality in self.localities:
+            found = Locality.objects.fuzzy_search(locality.name, country=locality.country_id)
+            self.assertEqual(dict((l, l.similarity) for l in found)[locality], 1)
+            # Misspelled
+            found = Locality.objects.fuzzy_search(locality.name + 's', country=locality.country_id)
+            self.assertIn(locality, found)
+            self.assertTrue(all(l.country_id == locality.country_id for l in found))
+            self.assertTrue(all(l.similarity >= 0.3 for l in found))
+
+    def test_update_long_names(self):
+        locality = self.localities[0]
+        # Renamed without signals
+        Admin1Code.objects.filter(pk=locality.admin1_id).update(name='Renamed')
+        count = Locality.objects.filter(admin1_id=locality.admin1_id).count()
+        self.assertEqual(Locality.objects.update_long_names(admin1_id=locality.admin1_id), count)
+        self.assertEqual(Locality.objects.update_long_names(admin1_id=locality.admin1_id), 0)
+        updated = Locality.objects.get(pk=locality.pk)
+        long_name = build_long_name(locality.name, 'Renamed', locality.admin2.name)
+        self.assertEqual(updated.long_name, long_name)
+        self.assertEqual(updated.display_name, build_display_name(long_name, locality.country.name))
+
+        # Another public locality of the same country moved to the same admin levels, with the same name
+        other = Locality.objects.public().filter(country_id=locality.country_id).exclude(pk=locality.pk).first()
+        Locality.objects.filter(pk=other.pk).update(name=locality.name, admin1_id=locality.admin1_id,
+                                                    admin2_id=locality.admin2_id)
+        with self.assertRaises(ValueError):
+            Locality.objects.update_long_names(pk=other.pk)
+
+    def test_rebuild_names(self):
+        locality = self.localities[0]
+        alternate = AlternateName.objects.public().order_by('alternatenameid').first()
+        expected = (set(Locality.objects.values_list('geonameid', 'long_name', 'display_name', 'search_name')),
+                    set(AlternateName.objects.values_list('alternatenameid', 'search_name')))
+        # As stored before the columns existed
+        Locality.objects.update(display_name='', search_name='')
+        AlternateName.objects.update(search_name='')
+        self.assertEqual(Locality.objects.autocomplete(locality.name, country=locality.country_id), [])
+        self.assertFalse(alternate.locality.country.search_locality(alternate.name).exists())
+
+        call_command('loadgeonames', rebuild_names=True, stdout=io.StringIO())
+        self.assertEqual((set(Locality.objects.values_list('geonameid', 'long_name', 'display_name', 'search_name')),
+                          set(AlternateName.objects.values_list('alternatenameid', 'search_name'))), expected)
+        self.assertIn(locality, Locality.objects.autocomplete(locality.name, limit=200, country=locality.country_id))
+        self.assertIn(alternate.locality, alternate.locality.country.search_locality(alternate.name))
+        self.assertEqual(AlternateName.objects.update_search_names(), 0)
+        self.assertEqual(Locality.objects.update_long_names(), 0)
+
+
 # from django.test import TestCase
 # from geonames.models import Timezone, Language, Currency, Country, Admin1Code, Admin2Code, Locality,\
 #     AlternateName
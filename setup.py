@@ -18,6 +18,10 @@ setup(
     author = 'Daniel Blasco Calzada',
     author_email = 'projects@dablak.com',
     zip_safe = False,
+    extras_require = {
+        # vectorized distances and spatial index, see geonames.distance and geonames.spatial_index
+        'numpy': ['numpy'],
+    },
     classifiers = [
         'Environment :: Web Environment',
         'Framework :: Django',